@@ -1,21 +1,25 @@
 # coding=utf-8
 import traceback
-from datetime import timedelta, date
+from datetime import timedelta
 
-from django.db.models import Count, Q
+from django.conf import settings
 from django.utils import timezone
 from django_cron import CronJobBase, Schedule
 from django_cron.models import CronJobLog
 
 from booking.models import (
     VisitAutosend,
+    EmailTemplate,
     EmailTemplateType,
     Visit,
     Guest,
     SurveyXactEvaluation,
     KUEmailMessage,
     MultiProductVisitTemp,
-    EventTime
+    EventTime,
+    Calendar,
+    PendingAvailabilityUpdate,
+    PendingSearchReindex
 )
 from booking.utils import surveyxact_anonymize
 
@@ -25,6 +29,7 @@ class KuCronJob(CronJobBase):
     description = "base KU cron job"
     code = None
 
+    # May return a message, which is kept in the job's CronJobLog
     def run(self):
         pass
 
@@ -36,8 +41,11 @@ class KuCronJob(CronJobBase):
             self.description
         ))
         try:
-            self.run()
+            # Jobs may send many emails, so look up templates just once
+            with EmailTemplate.cached_template_maps():
+                message = self.run()
             print("CRON job complete")
+            return message
         except Exception:
             print(traceback.format_exc())
             print("CRON job failed")
@@ -54,6 +62,23 @@ class KuCronJob(CronJobBase):
             pass
 
 
+# Anonymizes the rows of model older than limit with its anonymize_batch,
+# a batch at a time, and returns a summary. Every batch is committed on its
+# own and anonymized rows are not selected again, so a run that is stopped
+# part way keeps its progress and the next run carries on from there.
+def anonymize_in_batches(model, name, limit):
+    last_pk = 0
+    total = 0
+    while True:
+        pks = model.anonymize_batch(limit, last_pk)
+        if not pks:
+            break
+        last_pk = pks[-1]
+        total += len(pks)
+        print("Anonymized %d %s, up to #%d" % (total, name, last_pk))
+    return "Anonymized %d %s created before %s" % (total, name, limit)
+
+
 class ReminderJob(KuCronJob):
     RUN_AT_TIMES = ['01:00']
 
@@ -61,67 +86,28 @@ class ReminderJob(KuCronJob):
     code = 'kubooking.reminders'
     description = "sends reminder emails"
 
-    def run(self):
-        emailtemplatetypes = [
+    # The autosends that are due on day (or today)
+    def get_due_autosends(self, day=None):
+        return list(VisitAutosend.due_before_start([
             EmailTemplateType.notity_all__booking_reminder,
             EmailTemplateType.notify_guest_reminder
-        ]
-        autosends = list(VisitAutosend.objects.filter(
-            enabled=True,
-            template_type__in=emailtemplatetypes,
-            days__isnull=False,
-            inherit=False,
-            visit__eventtime__start__isnull=False,
-            visit__eventtime__start__gte=timezone.now()
-        ))
-        print("Found %d enabled autosends" % len(autosends))
-
-        inheriting_autosends = list(VisitAutosend.objects.filter(
-            inherit=True,
-            template_type__in=emailtemplatetypes,
-            visit__eventtime__start__isnull=False,
-            visit__eventtime__start__gte=timezone.now()
-        ).all())
-
-        extra = []
-        for autosend in inheriting_autosends:
-            inherited = autosend.get_inherited()
-            if inherited is not None and \
-                    inherited.enabled and \
-                    inherited.days is not None:
-                autosend.days = inherited.days
-                autosend.enabled = inherited.enabled
-                extra.append(autosend)
-        print("Found %d enabled inheriting autosends" % len(extra))
-        autosends.extend(extra)
-
-        if len(autosends) > 0:
-            today = date.today()
-            print("Today is: %s" % today)
-
-            for autosend in autosends:
-                if autosend is not None:
-                    print(
-                            "Autosend %d for Visit %d:" %
-                            (autosend.id, autosend.visit.id)
-                    )
-                    start = autosend.visit.eventtime.start
-                    if start is not None:
-                        print("    Visit starts on %s" % start)
-                        reminderday = start.date() - timedelta(autosend.days)
-                        print(
-                                "    Autosend specifies to send %d days "
-                                "prior, on %s" % (autosend.days, reminderday)
-                        )
-                        if reminderday == today:
-                            print("    That's today; send reminder now")
-                            autosend.visit.autosend(
-                                autosend.template_type
-                            )
-                        else:
-                            print("    That's not today. Not sending reminder")
-                    else:
-                        print("    Visit has no start date")
+        ], day))
+
+    def run(self):
+        today = timezone.localdate()
+        print("Today is: %s" % today)
+        autosends = self.get_due_autosends(today)
+        print("Found %d enabled autosends due today" % len(autosends))
+
+        for autosend in autosends:
+            print(
+                "Autosend %d for Visit %d: visit starts on %s, %d days "
+                "later; send reminder now" % (
+                    autosend.id, autosend.visit.id,
+                    autosend.visit.eventtime.start, autosend.effective_days
+                )
+            )
+            autosend.visit.autosend(autosend.template_type)
 
 
 class IdleHostroleJob(KuCronJob):
@@ -130,87 +116,43 @@ class IdleHostroleJob(KuCronJob):
     code = 'kubooking.idlehost'
     description = "sends notification emails regarding idle host roles"
 
-    def run(self):
-
-        visit_qs = Visit.objects.annotate(
-            num_bookings=Count('bookings'),
-        ).filter(
-            num_bookings__gt=0,
-            workflow_status__in=[
-                Visit.WORKFLOW_STATUS_BEING_PLANNED,
-                Visit.WORKFLOW_STATUS_REJECTED,
-                Visit.WORKFLOW_STATUS_AUTOASSIGN_FAILED
-            ]
-        )
-        visits_needing_hosts = [
-            visit for visit in visit_qs if visit.needs_hosts
+    # The autosends that are due on day (or today), for visits that still
+    # need hosts
+    def get_due_autosends(self, day=None):
+        return [
+            autosend
+            for autosend in VisitAutosend.due_after_first_booking(
+                [EmailTemplateType.notify_host__hostrole_idle], day
+            ).filter(
+                visit__workflow_status__in=[
+                    Visit.WORKFLOW_STATUS_BEING_PLANNED,
+                    Visit.WORKFLOW_STATUS_REJECTED,
+                    Visit.WORKFLOW_STATUS_AUTOASSIGN_FAILED
+                ]
+            )
+            if autosend.visit.needs_hosts
         ]
 
-        autosends = list(VisitAutosend.objects.filter(
-            enabled=True,
-            template_type=EmailTemplateType.notify_host__hostrole_idle,
-            days__isnull=False,
-            inherit=False,
-            visit__in=visits_needing_hosts
-        ).all())
-        print("Found %d enabled autosends" % len(autosends))
-
-        inheriting_autosends = list(VisitAutosend.objects.filter(
-            inherit=True,
-            template_type=EmailTemplateType.notify_host__hostrole_idle,
-            visit__in=visits_needing_hosts
-        ).all())
-
-        extra = []
-        for autosend in inheriting_autosends:
-            inherited = autosend.get_inherited()
-            if inherited is not None and \
-                    inherited.enabled and \
-                    inherited.days is not None:
-                autosend.days = inherited.days
-                autosend.enabled = inherited.enabled
-                extra.append(autosend)
-        print("Found %d enabled inheriting autosends" % len(extra))
-        autosends.extend(extra)
+    def run(self):
+        today = timezone.localdate()
+        print("Today is: %s" % today)
+        autosends = self.get_due_autosends(today)
+        print("Found %d enabled autosends due today" % len(autosends))
 
-        try:
-            if len(autosends) > 0:
-                today = date.today()
-                print("Today is: %s" % today)
-
-                for autosend in autosends:
-                    if autosend is None:
-                        continue
-                    print(
-                            "Autosend %d for Visit %d:" %
-                            (autosend.id, autosend.visit.id)
-                    )
-                    first_booking = autosend.visit.\
-                        bookings.earliest('statistics__created_time')
-                    print(
-                            "    Visit has its first booking on %s" %
-                            first_booking.statistics.created_time.date()
-                    )
-
-                    alertday = first_booking.statistics.created_time.\
-                        date() + timedelta(autosend.days)
-                    print(
-                            "    Autosend specifies to send %d days after "
-                            "first booking, on %s" % (autosend.days, alertday)
-                    )
-                    if alertday == today:
-                        print("    That's today; send alert now")
-                        try:
-                            autosend.visit.autosend(
-                                EmailTemplateType.notify_host__hostrole_idle
-                            )
-                        except Exception as e:
-                            print(e)
-                    else:
-                        print("    That's not today. Not sending alert")
-        finally:
-            for autosend in autosends:
-                autosend.refresh_from_db()
+        for autosend in autosends:
+            print(
+                "Autosend %d for Visit %d: visit has its first booking on "
+                "%s, %d days earlier; send alert now" % (
+                    autosend.id, autosend.visit.id,
+                    autosend.first_booked.date(), autosend.effective_days
+                )
+            )
+            try:
+                autosend.visit.autosend(
+                    EmailTemplateType.notify_host__hostrole_idle
+                )
+            except Exception as e:
+                print(e)
 
 
 class RemoveOldMvpJob(KuCronJob):
@@ -225,6 +167,64 @@ class RemoveOldMvpJob(KuCronJob):
         ).delete()
 
 
+class CalculatedAvailableHorizonJob(KuCronJob):
+    RUN_AT_TIMES = ['03:00']
+    schedule = Schedule(run_at_times=RUN_AT_TIMES)
+    code = 'kubooking.calculatedavailablehorizon'
+    description = "extends calculated calendar availability into the future"
+
+    # Calendars are only recalculated in the windows touched by changes, so
+    # the end of the calculated range has to be moved forward as time
+    # passes. Overlap a few days in case a run is missed.
+    days = 3
+
+    def run(self):
+        range_end = Calendar.calculated_available_range()[1]
+        from_dt = range_end - timedelta(days=self.days)
+        for calendar in Calendar.objects.all():
+            calendar.recalculate_available(from_dt, range_end)
+
+
+class AvailabilityUpdateJob(KuCronJob):
+    schedule = Schedule(run_every_mins=0)
+    code = 'kubooking.availabilityupdates'
+    description = "processes deferred resource availability updates"
+
+    def run(self):
+        count = PendingAvailabilityUpdate.process_pending()
+        print("Processed %d pending availability updates" % count)
+
+
+class EmailOutboxJob(KuCronJob):
+    schedule = Schedule(run_every_mins=0)
+    code = 'kubooking.emailoutbox'
+    description = "sends queued emails"
+
+    def run(self):
+        total = 0
+        while True:
+            count = KUEmailMessage.send_queued()
+            total += count
+            if count < settings.EMAIL_BATCH_SIZE:
+                break
+        print("Attempted sending %d queued emails" % total)
+
+
+class SearchReindexJob(KuCronJob):
+    schedule = Schedule(run_every_mins=0)
+    code = 'kubooking.searchreindex'
+    description = "regenerates deferred search texts"
+
+    def run(self):
+        total = 0
+        while True:
+            count = PendingSearchReindex.process_pending()
+            total += count
+            if count < settings.SEARCH_REINDEX_BATCH_SIZE:
+                break
+        print("Reindexed %d products and visits" % total)
+
+
 class NotifyEventTimeJob(KuCronJob):
     schedule = Schedule(run_every_mins=0)
     code = 'kubooking.notifyeventtime'
@@ -236,19 +236,14 @@ class NotifyEventTimeJob(KuCronJob):
             end = timezone.now()
             print("Notifying eventtimes before %s" % end)
 
-            for eventtime in EventTime.objects.filter(
-                    has_notified_start=False,
-                    start__lt=end
-            ):
-                print("Notifying EventTime %d (starting)" % eventtime.id)
-                eventtime.on_start()
-
-            for eventtime in EventTime.objects.filter(
-                    has_notified_end=False,
-                    end__lt=end
-            ):
-                print("Notifying EventTime %d (ending)" % eventtime.id)
-                eventtime.on_end()
+            for field in ('start', 'end'):
+                total = 0
+                while True:
+                    count = EventTime.notify_pending(field, end)
+                    total += count
+                    if count < settings.NOTIFY_EVENTTIME_BATCH_SIZE:
+                        break
+                print("Notified %d eventtimes (%s)" % (total, field))
 
 
 class EvaluationReminderJob(KuCronJob):
@@ -258,74 +253,35 @@ class EvaluationReminderJob(KuCronJob):
     description = "sends evaluation reminder emails"
     days = 5
 
-    def run(self):
-        emailtemplate = [
+    # The autosends that are due on day (or today)
+    def get_due_autosends(self, day=None):
+        return list(VisitAutosend.due_after_end([
             EmailTemplateType.notify_guest__evaluation_second,
             EmailTemplateType.notify_guest__evaluation_second_students
-        ]
-        filter = {
-            'template_type__in': emailtemplate,
-        }
-
-        autosends = list(VisitAutosend.objects.filter(
-            inherit=False,
-            enabled=True,
-            days__isnull=False,
-        ).filter(**filter).all())
-        print("Found %d enabled autosends" % len(autosends))
-
-        inheriting_autosends = list(VisitAutosend.objects.filter(
-            inherit=True,
-        ).filter(**filter).all())
-
-        extra = []
-        for autosend in inheriting_autosends:
-            inherited = autosend.get_inherited()
-            if inherited is not None and inherited.enabled:
-                autosend.enabled = inherited.enabled
-                extra.append(autosend)
-        print("Found %d enabled inheriting autosends" % len(extra))
-        autosends.extend(extra)
+        ], self.days, day))
 
-        try:
-            if len(autosends):
-                today = date.today()
-                print("Today is: %s" % today)
-                for autosend in autosends:
-                    visit = autosend.visit
-                    print(
-                            "Autosend %d for Visit %d:" %
-                            (autosend.id, visit.id)
-                    )
-                    if visit.end_datetime is None:
-                        print(
-                                "Visit %d has no apparent "
-                                "end_datetime" % visit.id
-                        )
-                    else:
-                        print(
-                                "    Visit ends on %s" %
-                                visit.end_datetime.date()
-                        )
-                        alertday = visit.end_datetime.date() + \
-                            timedelta(self.days)
-                        print(
-                                "    Hardcoded to send %d days after "
-                                "completion, on %s" % (self.days, alertday)
-                        )
-                        if alertday == today:
-                            print("    That's today; sending messages now")
-                            product = visit.product
-                            if product is not None:
-                                evals = product.surveyxactevaluation_set.all()
-                                for evaluation in evals:
-                                    evaluation.send_second_notification(visit)
-
-                        else:
-                            print("    That's not today. Not sending messages")
-        finally:
-            for autosend in autosends:
-                autosend.refresh_from_db()
+    def run(self):
+        today = timezone.localdate()
+        print("Today is: %s" % today)
+        autosends = self.get_due_autosends(today)
+        print("Found %d enabled autosends due today" % len(autosends))
+
+        # Both template types may be enabled for a visit, but its guests
+        # are only sent one reminder
+        visits = []
+        for autosend in autosends:
+            if autosend.visit not in visits:
+                visits.append(autosend.visit)
+        for visit in visits:
+            print(
+                "Visit %d ended on %s, %d days ago; sending messages now" % (
+                    visit.id, visit.end_datetime.date(), self.days
+                )
+            )
+            product = visit.product
+            if product is not None:
+                for evaluation in product.surveyxactevaluation_set.all():
+                    evaluation.send_second_notification(visit)
 
 
 class AnonymizeGuestsJob(KuCronJob):
@@ -336,25 +292,7 @@ class AnonymizeGuestsJob(KuCronJob):
 
     def run(self):
         limit = timezone.now() - timedelta(days=365*2)
-        guests = Guest.objects.filter(
-            Q(booking__visit__eventtime__start__lt=limit) |
-            Q(booking__visit__cancelled_eventtime__start__lt=limit)
-        ).exclude(
-            Guest.filter_anonymized()
-        )
-        for guest in guests:
-            visit = guest.booking.visit
-            if hasattr(visit, 'eventtime'):
-                time = visit.eventtime.start
-            elif visit.cancelled_eventtime is not None:
-                time = visit.cancelled_eventtime.start
-            else:
-                time = None
-            print(
-                    "Anonymizing guest #%d on visit %d (starttime %s)" %
-                    (guest.id, visit.id, time)
-            )
-            guest.anonymize()
+        return anonymize_in_batches(Guest, "guests", limit)
 
 
 class AnonymizeEvaluationsJob(KuCronJob):
@@ -399,10 +337,4 @@ class AnonymizeEmailsJob(KuCronJob):
 
     def run(self):
         limit = timezone.now() - timedelta(days=365*2)
-        messages = KUEmailMessage.objects.filter(
-            created__lt=limit,
-        ).exclude(
-            **KUEmailMessage.anonymized_filter
-        )
-        for message in messages:
-            message.anonymize()
+        return anonymize_in_batches(KUEmailMessage, "emails", limit)
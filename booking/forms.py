@@ -912,22 +912,18 @@ class BookingForm(forms.ModelForm):
             product = products[0]
             choices = [(None, BLANK_LABEL)]
             qs = product.future_bookable_times(use_cutoff=True)\
-                .order_by('start', 'end')
+                .select_related('visit').order_by('start', 'end')
             options = {}
             for eventtime in qs:
                 date = eventtime.interval_display
 
                 visit = eventtime.visit
-                product = eventtime.product
 
-                if visit:
-                    available_seats = visit.available_seats
-                    waitinglist_capacity = visit.waiting_list_capacity
-                    bookings = visit.bookings.count
-                else:
-                    available_seats = product.maximum_number_of_visitors
-                    waitinglist_capacity = 0
-                    bookings = 0
+                # Annotated by bookable_times. The waiting list capacity is
+                # None when it is unlimited
+                available_seats = eventtime.seats_left
+                waitinglist_capacity = eventtime.waiting_left
+                bookings = visit.booking_count if visit else 0
 
                 if available_seats is None or \
                         available_seats == AVAILABLE_SEATS_NO_LIMIT:
@@ -937,7 +933,7 @@ class BookingForm(forms.ModelForm):
                         # There are no bookings at all - yet
                         capacity_text = "%d ledige pladser" % available_seats
                     elif available_seats > 0:
-                        if waitinglist_capacity > 0:
+                        if waitinglist_capacity != 0:
                             # There's some room on both
                             # regular and waiting list
                             capacity_text = _("%d ledige pladser + "
@@ -947,7 +943,10 @@ class BookingForm(forms.ModelForm):
                             capacity_text = _("%d ledige pladser") % \
                                             available_seats
                     else:
-                        if waitinglist_capacity > 0:
+                        if waitinglist_capacity is None:
+                            # There's only an unlimited waiting list
+                            capacity_text = _("venteliste")
+                        elif waitinglist_capacity > 0:
                             # There's only waitinglist seats
                             capacity_text = _("venteliste (%d pladser)") % \
                                             waitinglist_capacity
@@ -0,0 +1,223 @@
+# encoding: utf-8
+import datetime
+import heapq
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from booking.resource_based.models import Calendar, CalendarEventInstance
+
+
+# The merge used by Calendar.unavailable_list before it used heapq: scans
+# the pending item of every source for each item yielded.
+def linear_merge(generators):
+    pending_items = []
+    new_generators = []
+    for x in generators:
+        try:
+            pending_items.append(next(x))
+            new_generators.append(x)
+        except StopIteration:
+            continue
+    generators = new_generators
+
+    while len(generators) > 0:
+        item_idx = None
+        item = None
+        for idx, x in enumerate(pending_items):
+            if item is None or CalendarEventInstance.sort_key(x) < \
+                    CalendarEventInstance.sort_key(item):
+                item_idx = idx
+                item = x
+        try:
+            pending_items[item_idx] = next(generators[item_idx])
+        except StopIteration:
+            del generators[item_idx]
+            del pending_items[item_idx]
+        yield item
+
+
+# Calendar.has_available_time before it used IntervalList: compares every
+# available interval to every unavailable one.
+def nested_has_available_time(availables, unavailables, from_dt, to_dt,
+                              minutes):
+    needed = datetime.timedelta(minutes=minutes)
+    for available in availables:
+        avail_start_time = max(available.start, from_dt)
+        avail_end_time = min(available.end, to_dt)
+        for unavailable in unavailables:
+            next_unavailable = min(unavailable.start, avail_end_time)
+            if next_unavailable - avail_start_time >= needed:
+                return True
+            else:
+                avail_start_time = max(unavailable.end, avail_start_time)
+        if avail_end_time - avail_start_time >= needed:
+            return True
+    return False
+
+
+def indexed_has_available_time(availables, unavailables, from_dt, to_dt,
+                               minutes):
+    needed = datetime.timedelta(minutes=minutes)
+    free = Calendar.as_interval_list(availables).subtract(
+        Calendar.as_interval_list(unavailables)
+    )
+    return any(
+        end - start >= needed
+        for (start, end) in free.clip(from_dt, to_dt)
+    )
+
+
+class Command(BaseCommand):
+    help = "Compares the old and new calendar interval algorithms on " \
+           "synthetic calendars"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--sources', type=int, default=8)
+        parser.add_argument('--bookings-per-day', type=int, default=4)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def make_calendar(self, options):
+        rnd = random.Random(options['seed'])
+        start = timezone.now().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        end = start + datetime.timedelta(days=options['days'])
+
+        # Open 8-16 every weekday
+        availables = []
+        for day in range(options['days']):
+            day_start = start + datetime.timedelta(days=day)
+            if day_start.isoweekday() <= 5:
+                availables.append(CalendarEventInstance(
+                    day_start + datetime.timedelta(hours=8),
+                    day_start + datetime.timedelta(hours=16),
+                    available=True
+                ))
+
+        # Sorted sources of random bookings, like the generators that
+        # Calendar.unavailable_list merges
+        sources = [[] for x in range(options['sources'])]
+        for day in range(options['days']):
+            day_start = start + datetime.timedelta(days=day)
+            for x in range(options['bookings_per_day']):
+                booking_start = day_start + datetime.timedelta(
+                    minutes=rnd.randrange(6 * 60, 18 * 60, 15)
+                )
+                rnd.choice(sources).append(CalendarEventInstance(
+                    booking_start,
+                    booking_start + datetime.timedelta(
+                        minutes=rnd.choice([30, 60, 90, 120])
+                    )
+                ))
+        for source in sources:
+            source.sort(key=CalendarEventInstance.sort_key)
+
+        queries = []
+        for x in range(options['queries']):
+            query_start = start + datetime.timedelta(
+                minutes=rnd.randrange(0, options['days'] * 24 * 60, 15)
+            )
+            queries.append((
+                query_start,
+                query_start + datetime.timedelta(days=rnd.randint(1, 14)),
+                rnd.choice([30, 60, 120, 240])
+            ))
+
+        return (start, end, availables, sources, queries)
+
+    def compare(self, name, old, new, repeat):
+        old_time = min(timeit.repeat(old, number=1, repeat=repeat))
+        new_time = min(timeit.repeat(new, number=1, repeat=repeat))
+        self.stdout.write("%-20s old: %8.4fs  new: %8.4fs  (%.1fx)" % (
+            name, old_time, new_time,
+            old_time / new_time if new_time else float('inf')
+        ))
+
+    def handle(self, *args, **options):
+        (start, end, availables, sources, queries) = \
+            self.make_calendar(options)
+        unavailables = list(heapq.merge(
+            *sources, key=CalendarEventInstance.sort_key
+        ))
+        self.stdout.write(
+            "%d available and %d unavailable intervals from %d sources, "
+            "%d queries" % (
+                len(availables), len(unavailables), len(sources),
+                len(queries)
+            )
+        )
+
+        if list(linear_merge(iter(x) for x in sources)) != unavailables:
+            self.stderr.write("Merged lists differ")
+        for (from_dt, to_dt, minutes) in queries:
+            args = (availables, unavailables, from_dt, to_dt, minutes)
+            if nested_has_available_time(*args) != \
+                    indexed_has_available_time(*args):
+                self.stderr.write(
+                    "has_available_time differs for %s - %s, %d minutes" %
+                    (from_dt, to_dt, minutes)
+                )
+
+        self.compare(
+            "merge",
+            lambda: list(linear_merge(iter(x) for x in sources)),
+            lambda: list(heapq.merge(
+                *sources, key=CalendarEventInstance.sort_key
+            )),
+            options['repeat']
+        )
+
+        # Each query only sees the intervals inside its window, like
+        # Calendar.has_available_time does
+        def windowed(items, from_dt, to_dt):
+            return [x for x in items if x.end > from_dt and x.start < to_dt]
+        windows = [
+            (
+                windowed(availables, from_dt, to_dt),
+                windowed(unavailables, from_dt, to_dt),
+                from_dt, to_dt, minutes
+            )
+            for (from_dt, to_dt, minutes) in queries
+        ]
+        self.compare(
+            "has_available_time",
+            lambda: [nested_has_available_time(*x) for x in windows],
+            lambda: [indexed_has_available_time(*x) for x in windows],
+            options['repeat']
+        )
+        # Nothing long enough, so neither version can stop early
+        long_windows = [x[:4] + (9 * 60,) for x in windows]
+        self.compare(
+            "has_available_time*",
+            lambda: [nested_has_available_time(*x) for x in long_windows],
+            lambda: [indexed_has_available_time(*x) for x in long_windows],
+            options['repeat']
+        )
+
+        free = Calendar.as_interval_list(availables).subtract(
+            Calendar.as_interval_list(unavailables)
+        )
+        free_instances = [
+            CalendarEventInstance(x[0], x[1], available=True) for x in free
+        ]
+        self.compare(
+            "covers",
+            lambda: [
+                any(
+                    x.start <= from_dt and x.end >= to_dt
+                    for x in free_instances
+                )
+                for (from_dt, to_dt, minutes) in queries
+            ],
+            lambda: [
+                free.covers(from_dt, to_dt)
+                for (from_dt, to_dt, minutes) in queries
+            ],
+            options['repeat']
+        )
@@ -0,0 +1,191 @@
+# encoding: utf-8
+import random
+import timeit
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+from django.db.models import Count
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from booking.models import Product
+from booking.models import ProductGrundskoleFag
+from booking.models import ProductGymnasieFag
+from booking.models import Subject
+from booking.views import SearchView
+
+
+# The facet counting used by SearchView.make_facet before it used
+# SearchView.get_facet_hits: one aggregate query per facet, with the
+# filters that are not on the facet's own field.
+def legacy_facet_hits(view, facet_field):
+    filters = view.get_filters()
+    new_filter_args = [
+        v for k, v in filters.items()
+        if k.startswith('__') and not k.startswith('__' + facet_field)
+    ]
+    new_filter_kwargs = {
+        k: v for k, v in filters.items()
+        if not k.startswith(facet_field) and not k.startswith('__')
+    }
+    facet_qs = Product.objects.filter(
+        pk__in=view.get_facet_queryset().filter(
+            *new_filter_args,
+            **new_filter_kwargs
+        )
+    )
+    return {
+        item[facet_field]: item["hits"]
+        for item in facet_qs.values(facet_field).annotate(hits=Count("pk"))
+        if item[facet_field] is not None
+    }
+
+
+def legacy_facets(view):
+    hits = {
+        field: legacy_facet_hits(view, field)
+        for field in SearchView.facet_fields
+    }
+    unsubjected = {
+        field: view.get_facet_queryset().filter(
+            **{field: Subject.get_all()}
+        ).count()
+        for field in SearchView.subject_facet_tables
+    }
+    return (hits, unsubjected)
+
+
+def single_pass_facets(view):
+    hits = view.get_facet_hits()['hits']
+    unsubjected = {
+        field: view.count_unsubjected(field)
+        for field in SearchView.subject_facet_tables
+    }
+    return (hits, unsubjected)
+
+
+class Command(BaseCommand):
+    help = "Compares per-facet and single-pass facet counting for public " \
+           "search pages on synthetic products. The products are removed " \
+           "again when the benchmark is done."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--subjects-per-product', type=int, default=3)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def make_products(self, options):
+        rnd = random.Random(options['seed'])
+        if Subject.objects.count() < 10:
+            Subject.create_defaults()
+        all_subject = Subject.get_all()
+        gym_subjects = list(
+            Subject.gymnasiefag_qs().exclude(pk=all_subject.pk)
+        )
+        gs_subjects = list(
+            Subject.grundskolefag_qs().exclude(pk=all_subject.pk)
+        )
+
+        products = Product.objects.bulk_create([
+            Product(
+                title="Benchmark product %d" % x,
+                teaser="Benchmark",
+                description="Benchmark",
+                type=rnd.choice(Product.resource_type_choices)[0],
+                institution_level=rnd.choice(Product.institution_choices)[0],
+                state=Product.ACTIVE if rnd.random() < 0.8
+                else Product.CREATED,
+                time_mode=Product.TIME_MODE_NONE,
+            )
+            for x in range(options['products'])
+        ])
+
+        gym_rows = []
+        gs_rows = []
+        for product in products:
+            if product.institution_level & Subject.SUBJECT_TYPE_GYMNASIE:
+                subjects = rnd.sample(
+                    gym_subjects, options['subjects_per_product']
+                )
+                if rnd.random() < 0.1:
+                    subjects = [all_subject]
+                gym_rows.extend(
+                    ProductGymnasieFag(product=product, subject=subject)
+                    for subject in subjects
+                )
+            if product.institution_level & Subject.SUBJECT_TYPE_GRUNDSKOLE:
+                subjects = rnd.sample(
+                    gs_subjects, options['subjects_per_product']
+                )
+                if rnd.random() < 0.1:
+                    subjects = [all_subject]
+                gs_rows.extend(
+                    ProductGrundskoleFag(product=product, subject=subject)
+                    for subject in subjects
+                )
+        ProductGymnasieFag.objects.bulk_create(gym_rows)
+        ProductGrundskoleFag.objects.bulk_create(gs_rows)
+
+        return [
+            ("no filters", {}),
+            ("type", {'t': [str(products[0].type)]}),
+            ("institution", {'i': [str(Subject.SUBJECT_TYPE_GYMNASIE)]}),
+            ("gymnasiefag", {'f': [str(gym_subjects[0].pk)]}),
+            ("type + grundskolefag", {
+                't': [str(products[1].type)],
+                'g': [str(gs_subjects[0].pk)],
+            }),
+        ]
+
+    def make_view(self, params):
+        request = RequestFactory().get('/search', params)
+        request.user = AnonymousUser()
+        view = SearchView()
+        view.request = request
+        view.kwargs = {}
+        view.is_public = True
+        view.t_from = timezone.now()
+        view.t_to = None
+        return view
+
+    def compare(self, name, params, repeat):
+        with CaptureQueriesContext(connection) as old_queries:
+            old_result = legacy_facets(self.make_view(params))
+        with CaptureQueriesContext(connection) as new_queries:
+            new_result = single_pass_facets(self.make_view(params))
+        if old_result != new_result:
+            self.stderr.write("Facet hits differ for %s" % name)
+
+        old_time = min(timeit.repeat(
+            lambda: legacy_facets(self.make_view(params)),
+            number=1, repeat=repeat
+        ))
+        new_time = min(timeit.repeat(
+            lambda: single_pass_facets(self.make_view(params)),
+            number=1, repeat=repeat
+        ))
+        self.stdout.write(
+            "%-22s old: %8.4fs %3d queries  new: %8.4fs %3d queries  "
+            "(%.1fx)" % (
+                name, old_time, len(old_queries), new_time,
+                len(new_queries),
+                old_time / new_time if new_time else float('inf')
+            )
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            searches = self.make_products(options)
+            self.stdout.write(
+                "%d products, %d active" % (
+                    Product.objects.count(),
+                    Product.objects.filter(state=Product.ACTIVE).count()
+                )
+            )
+            for (name, params) in searches:
+                self.compare(name, params, options['repeat'])
+            transaction.set_rollback(True)
@@ -0,0 +1,39 @@
+# encoding: utf-8
+from django.core.management.base import BaseCommand
+
+from booking.models import Visit
+
+
+class Command(BaseCommand):
+    help = "Compares the attendee and booking counters of visits to their " \
+           "bookings, and optionally corrects them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help="Recount the visits whose counters are wrong"
+        )
+
+    def handle(self, *args, **options):
+        inconsistent = Visit.inconsistent_counters()
+        for (visit_id, stored, counted) in inconsistent:
+            self.stdout.write(
+                "Visit %d: %s, counted %s" % (
+                    visit_id,
+                    ", ".join(
+                        "%s=%d" % x for x in zip(Visit.counter_fields, stored)
+                    ),
+                    ", ".join(
+                        "%s=%d" % x
+                        for x in zip(Visit.counter_fields, counted)
+                    )
+                )
+            )
+        if options['fix'] and inconsistent:
+            Visit.update_counters([x[0] for x in inconsistent])
+            self.stdout.write(
+                "Recounted %d visits" % len(inconsistent)
+            )
+        elif not inconsistent:
+            self.stdout.write("All visit counters are consistent")
@@ -0,0 +1,24 @@
+# encoding: utf-8
+from django.core.management.base import BaseCommand
+
+from user_profile.models import AssignmentOpportunity
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the index of visits teachers and hosts can be " \
+           "assigned to"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'visit_ids',
+            nargs='*',
+            type=int,
+            help="Only rebuild the visits with these ids"
+        )
+
+    def handle(self, *args, **options):
+        AssignmentOpportunity.refresh(options['visit_ids'] or None)
+        self.stdout.write(
+            "%d assignment opportunities" %
+            AssignmentOpportunity.objects.count()
+        )
@@ -0,0 +1,24 @@
+# encoding: utf-8
+from django.core.management.base import BaseCommand
+
+from booking.resource_based.models import PublicBookableTime
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the index of publicly bookable product times used by " \
+           "the public search"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'product_ids',
+            nargs='*',
+            type=int,
+            help="Only rebuild the index for the products with these ids"
+        )
+
+    def handle(self, *args, **options):
+        PublicBookableTime.refresh(options['product_ids'] or None)
+        self.stdout.write(
+            "Public search index holds %d rows" %
+            PublicBookableTime.objects.count()
+        )
@@ -0,0 +1,27 @@
+# encoding: utf-8
+from django.core.management.base import BaseCommand
+
+from booking.resource_based.models import Calendar
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the calculated available times for calendars"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'calendar_ids',
+            nargs='*',
+            type=int,
+            help="Only rebuild the calendars with these ids"
+        )
+
+    def handle(self, *args, **options):
+        calendars = Calendar.objects.order_by('pk')
+        if options['calendar_ids']:
+            calendars = calendars.filter(pk__in=options['calendar_ids'])
+
+        count = 0
+        for calendar in calendars.iterator():
+            calendar.recalculate_available()
+            count += 1
+        self.stdout.write("Recalculated %d calendars" % count)
@@ -0,0 +1,22 @@
+# encoding: utf-8
+from django.core.management.base import BaseCommand
+
+from booking.resource_based.models import ResourceUtilisation
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the assigned hours per week and month of resources"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'resource_ids',
+            nargs='*',
+            type=int,
+            help="Only rebuild the resources with these ids"
+        )
+
+    def handle(self, *args, **options):
+        ResourceUtilisation.refresh(options['resource_ids'] or None)
+        self.stdout.write(
+            "%d utilisation counters" % ResourceUtilisation.objects.count()
+        )
@@ -0,0 +1,61 @@
+# encoding: utf-8
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from booking.models import PendingSearchReindex
+from booking.models import Product
+from booking.models import Visit
+from booking.utils import chunked_pks
+
+
+class Command(BaseCommand):
+    help = "Regenerates the search texts and vectors of products and " \
+           "visits marked for reindexing, or of all of them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--products',
+            action='store_true',
+            help="Regenerate all products"
+        )
+        parser.add_argument(
+            '--visits',
+            action='store_true',
+            help="Regenerate all visits"
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.SEARCH_REINDEX_BATCH_SIZE
+        )
+
+    def report_products(self, done, seconds):
+        self.stdout.write(
+            "Reindexed %d products in %.1fs (%.0f products/s)" % (
+                done, seconds, done / seconds if seconds else 0
+            )
+        )
+
+    def reindex_visits(self, batch_size):
+        count = 0
+        for chunk in chunked_pks(Visit.objects.all(), batch_size):
+            Visit.update_searchvectors(chunk)
+            count += len(chunk)
+        self.stdout.write("Reindexed %d visits" % count)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['products']:
+            Product.rebuild_searchvectors(
+                chunk_size=batch_size, progress=self.report_products
+            )
+        if options['visits']:
+            self.reindex_visits(batch_size)
+
+        total = 0
+        while True:
+            count = PendingSearchReindex.process_pending(batch_size)
+            total += count
+            if count < batch_size:
+                break
+        self.stdout.write("Processed %d marked products and visits" % total)
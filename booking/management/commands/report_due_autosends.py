@@ -0,0 +1,38 @@
+# encoding: utf-8
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from booking.cron import EvaluationReminderJob
+from booking.cron import IdleHostroleJob
+from booking.cron import ReminderJob
+
+
+class Command(BaseCommand):
+    help = "Lists the autosends the reminder cron jobs would send on a " \
+           "day, without sending anything"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            type=lambda x: datetime.strptime(x, '%Y-%m-%d').date(),
+            help="The day to report on, as YYYY-MM-DD. Defaults to today"
+        )
+
+    def handle(self, *args, **options):
+        day = options['date'] or timezone.localdate()
+        self.stdout.write("Autosends due on %s" % day)
+        for job in (ReminderJob(), IdleHostroleJob(), EvaluationReminderJob()):
+            autosends = job.get_due_autosends(day)
+            self.stdout.write("%s: %d" % (job.code, len(autosends)))
+            for autosend in autosends:
+                self.stdout.write(
+                    "    Autosend %d (%s) for visit %d%s" % (
+                        autosend.pk,
+                        autosend.template_type.name,
+                        autosend.visit_id,
+                        ", inherited from product" if autosend.inherit
+                        else ""
+                    )
+                )
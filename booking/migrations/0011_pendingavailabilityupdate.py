@@ -0,0 +1,24 @@
+# Generated by Django 2.2.17 on 2026-10-18 10:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0010_auto_20201127_1407'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingAvailabilityUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(null=True)),
+                ('end', models.DateTimeField(null=True)),
+                ('calendar', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='booking.Calendar')),
+                ('eventtime', models.OneToOneField(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='booking.EventTime')),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.17 on 2026-10-18 11:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0011_pendingavailabilityupdate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kuemailmessage',
+            name='delivered',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='kuemailmessage',
+            name='delivery_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='kuemailmessage',
+            name='delivery_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='kuemailmessage',
+            name='delivery_status',
+            field=models.IntegerField(choices=[(0, 'I kø'), (1, 'Sendt'), (2, 'Fejlet')], default=1, verbose_name='Afsendelsesstatus'),
+        ),
+        migrations.AddField(
+            model_name='kuemailmessage',
+            name='next_attempt',
+            field=models.DateTimeField(blank=True, db_index=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.17 on 2026-10-18 11:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0012_kuemailmessage_delivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublicBookableTime',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(null=True)),
+                ('calendar', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='booking.Calendar')),
+                ('eventtime', models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.EventTime')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.Product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='publicbookabletime',
+            index=models.Index(fields=['start', 'product'], name='booking_pub_start_7a773e_idx'),
+        ),
+    ]
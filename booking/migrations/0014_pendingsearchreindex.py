@@ -0,0 +1,22 @@
+# Generated by Django 2.2.17 on 2026-10-18 11:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0013_publicbookabletime'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingSearchReindex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product', models.OneToOneField(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='booking.Product')),
+                ('visit', models.OneToOneField(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='booking.Visit')),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.17 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0014_pendingsearchreindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResourceUtilisation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.IntegerField(choices=[(1, 'Uge'), (2, 'Måned')])),
+                ('period_start', models.DateField()),
+                ('minutes', models.IntegerField(default=0)),
+                ('visits', models.IntegerField(default=0)),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='utilisation', to='booking.Resource')),
+            ],
+            options={
+                'unique_together': {('resource', 'period', 'period_start')},
+            },
+        ),
+    ]
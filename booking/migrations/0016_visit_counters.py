@@ -0,0 +1,76 @@
+# Generated by Django 2.2.17 on 2026-10-18 12:12
+
+from django.db import migrations, models
+
+
+# Counts the existing bookings, like Visit.update_counters
+fill_counters = '''
+    UPDATE "booking_visit"
+    SET
+        "attendees_count" = "counted"."attendees_count",
+        "waiting_count" = "counted"."waiting_count",
+        "cancelled_attendees_count" = "counted"."cancelled_attendees_count",
+        "booking_count" = "counted"."booking_count"
+    FROM (
+        SELECT
+            "booking_booking"."visit_id",
+            COALESCE(SUM("booking_guest"."attendee_count") FILTER (
+                WHERE
+                    "booking_booking"."waitinglist_spot" = 0
+                    AND
+                    NOT "booking_booking"."cancelled"
+            ), 0) AS "attendees_count",
+            COALESCE(SUM("booking_guest"."attendee_count") FILTER (
+                WHERE
+                    "booking_booking"."waitinglist_spot" > 0
+                    AND
+                    NOT "booking_booking"."cancelled"
+            ), 0) AS "waiting_count",
+            COALESCE(SUM("booking_guest"."attendee_count") FILTER (
+                WHERE "booking_booking"."cancelled"
+            ), 0) AS "cancelled_attendees_count",
+            COUNT("booking_booking"."id") AS "booking_count"
+        FROM
+            "booking_booking"
+            LEFT OUTER JOIN "booking_guest" ON (
+                "booking_guest"."id" = "booking_booking"."booker_id"
+            )
+        WHERE
+            "booking_booking"."visit_id" IS NOT NULL
+        GROUP BY
+            "booking_booking"."visit_id"
+    ) "counted"
+    WHERE
+        "booking_visit"."id" = "counted"."visit_id"
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0015_resourceutilisation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visit',
+            name='attendees_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='booking_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='cancelled_attendees_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='visit',
+            name='waiting_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(fill_counters, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.17 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0016_visit_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='eventtime',
+            index=models.Index(condition=models.Q(has_notified_start=False), fields=['start'], name='eventtime_notify_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='eventtime',
+            index=models.Index(condition=models.Q(has_notified_end=False), fields=['end'], name='eventtime_notify_end_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.17 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0017_eventtime_notify_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='kuemailmessage',
+            index=models.Index(condition=models.Q(_negated=True, recipients='[anonymiseret]'), fields=['created'], name='kuemailmessage_unanonymized'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 # encoding: utf-8
+from django.conf import settings
 from django.contrib.admin.models import LogEntry
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
@@ -11,17 +12,15 @@ from django.views.generic.base import ContextMixin
 
 from booking.constants import LOGACTION_CREATE, LOGACTION_CHANGE
 from booking.logging import log_action
-from booking.utils import get_related_content_types
+from booking.utils import get_related_content_types, merge_intervals
 from user_profile.constants import EDIT_ROLES, ADMINISTRATOR, role_to_text
 
 
 class AvailabilityUpdaterMixin(object):
 
     def save(self, *args, **kwargs):
-        aff_qs = self.affected_eventtimes
-        EventTime = aff_qs.model
         # Store what will be affected before the change
-        affected = set(x.pk for x in aff_qs)
+        affected = set(self.affected_eventtimes.values_list('pk', flat=True))
 
         # Whenever affected_eventtimes is calculated using m2m relations we
         # will get one save before relations are saved and one after. In the
@@ -34,12 +33,14 @@ class AvailabilityUpdaterMixin(object):
         ):
             affected.update(self._recently_affected)
 
+        # Store which calendar spans the stored version affects
+        calendar_updates = self._stored_calendar_updates()
+
         # Perform change
         res = super(AvailabilityUpdaterMixin, self).save(*args, **kwargs)
 
         # Add what will be affected after the change
-        for x in self.affected_eventtimes:
-            affected.add(x.pk)
+        affected.update(self.affected_eventtimes.values_list('pk', flat=True))
 
         # Store recently affected, or remove it if we just used it.
         if getattr(self, 'affected_eventtimes_uses_m2m', False):
@@ -48,45 +49,87 @@ class AvailabilityUpdaterMixin(object):
             else:
                 self._recently_affected = affected
 
-        # Update cached availability for any calendars affected by this change
-        if hasattr(self, "affected_calendars"):
-            for x in self.affected_calendars:
-                x.recalculate_available()
-
-        # Update availability for everything affected
-        EventTime.update_resource_status_for_qs(
-            EventTime.objects.filter(pk__in=affected)
-        )
+        # Update cached availability for any calendars affected by this
+        # change and availability for everything affected
+        calendar_updates.extend(self._calendar_updates())
+        self.update_availability_for(calendar_updates, affected)
 
         return res
 
     def delete(self, *args, **kwargs):
-        aff_qs = self.affected_eventtimes
-        EventTime = aff_qs.model
         # Store what will be affected before the change
-        affected = set(x.pk for x in aff_qs)
+        affected = set(self.affected_eventtimes.values_list('pk', flat=True))
 
         # Make a copy of calendars that will be affected by the change
-        if hasattr(self, "affected_calendars"):
-            affected_calendars = tuple(self.affected_calendars)
-        else:
-            affected_calendars = None
+        calendar_updates = self._calendar_updates()
 
         # Perform change
         res = super(AvailabilityUpdaterMixin, self).delete(*args, **kwargs)
 
-        # Update cached availability for any calendars affected by this change
-        if affected_calendars is not None:
-            for x in affected_calendars:
-                x.recalculate_available()
-
-        # Update availability for everything affected
-        EventTime.update_resource_status_for_qs(
-            EventTime.objects.filter(pk__in=affected)
-        )
+        # Update cached availability for any calendars affected by this
+        # change and availability for everything affected
+        self.update_availability_for(calendar_updates, affected)
 
         return res
 
+    # List of (calendar, intervals) pairs for the calendars affected by
+    # this object. Intervals is None when the object does not define
+    # affected_calendar_intervals, meaning the whole calendar is affected.
+    def _calendar_updates(self):
+        if not hasattr(self, "affected_calendars"):
+            return []
+        intervals = getattr(self, "affected_calendar_intervals", None)
+        return [(x, intervals) for x in self.affected_calendars]
+
+    def _stored_calendar_updates(self):
+        if self.pk is None or not getattr(
+            self, 'affected_calendar_intervals_from_db', False
+        ):
+            return []
+        stored = type(self).objects.filter(pk=self.pk).first()
+        if stored is None:
+            return []
+        return stored._calendar_updates()
+
+    # Recalculates the given calendar spans and the resource status of the
+    # given eventtimes, or queues them for the AvailabilityUpdateJob cron job
+    # when settings.DEFER_AVAILABILITY_UPDATES is set. Queued updates are
+    # written in the current transaction, so they become visible to the job
+    # when it commits.
+    @staticmethod
+    def update_availability_for(calendar_updates, eventtime_ids):
+        from booking.resource_based.models import EventTime
+        from booking.resource_based.models import PendingAvailabilityUpdate
+
+        if settings.DEFER_AVAILABILITY_UPDATES:
+            PendingAvailabilityUpdate.enqueue(calendar_updates, eventtime_ids)
+        else:
+            AvailabilityUpdaterMixin.recalculate_calendars(calendar_updates)
+            EventTime.update_resource_status_for_qs(
+                EventTime.objects.filter(pk__in=eventtime_ids)
+            )
+
+    @staticmethod
+    def recalculate_calendars(calendar_updates):
+        # Collect intervals per calendar so each calendar is only
+        # recalculated once for overlapping spans
+        calendars = {}
+        for (calendar, intervals) in calendar_updates:
+            if calendar.pk not in calendars:
+                calendars[calendar.pk] = (calendar, [])
+            collected = calendars[calendar.pk][1]
+            if intervals is None or collected is None:
+                calendars[calendar.pk] = (calendar, None)
+            else:
+                collected.extend(intervals)
+
+        for (calendar, intervals) in calendars.values():
+            if intervals is None:
+                calendar.recalculate_available()
+            else:
+                for (from_dt, to_dt) in merge_intervals(intervals):
+                    calendar.recalculate_available(from_dt, to_dt)
+
 
 class BreadcrumbMixin(ContextMixin):
 
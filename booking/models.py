@@ -1,10 +1,14 @@
 # encoding: utf-8
 
+import copy
 import math
-import random
 import re
+import threading
 import uuid
+from contextlib import contextmanager
 from datetime import timedelta, datetime, date, time
+from functools import lru_cache
+from time import monotonic
 
 from django.conf import settings
 from django.contrib.admin.models import LogEntry
@@ -15,14 +19,26 @@ from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.core import validators
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import EmailMultiAlternatives
+from django.core.exceptions import ValidationError
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection
 from django.db import models
+from django.db import transaction
 from django.db.models import Case, When
+from django.db.models import DateField
+from django.db.models import Exists
+from django.db.models import ExpressionWrapper
+from django.db.models import F
+from django.db.models import IntegerField
+from django.db.models import OuterRef
 from django.db.models import Q
+from django.db.models import Subquery
 from django.db.models import Sum
 from django.db.models.base import ModelBase
 from django.db.models.functions import Coalesce
+from django.db.models.functions import TruncDate
 from django.db.models.query import QuerySet
+from django.template import Engine
 from django.template.base import Template, VariableNode
 from django.template.context import make_context
 from django.template.loader import get_template
@@ -51,6 +67,7 @@ from booking.utils import (
     ClassProperty,
     CustomStorage,
     bool2int,
+    chunked_pks,
     getattr_long,
     prune_list,
     surveyxact_upload,
@@ -194,6 +211,16 @@ class OrganizationalUnit(models.Model):
     def __str__(self):
         return "%s (%s)" % (self.name, self.type.name)
 
+    def save(self, *args, **kwargs):
+        super(OrganizationalUnit, self).save(*args, **kwargs)
+        # Email templates are inherited through the parent units
+        EmailTemplate.clear_template_map_cache()
+
+    def delete(self, *args, **kwargs):
+        res = super(OrganizationalUnit, self).delete(*args, **kwargs)
+        EmailTemplate.clear_template_map_cache()
+        return res
+
     def get_users(self, role=None):
         if role is not None:
             profiles = self.userprofile_set.filter(user_role__role=role).all()
@@ -1211,7 +1238,22 @@ class EmailTemplate(models.Model):
     ]
 
     @staticmethod
-    def get_template_object(template_text, escape=True):
+    @lru_cache(maxsize=1)
+    def placeholder_engine():
+        # A copy of the template engine that renders unknown variables as
+        # placeholders. Changing string_if_invalid on the shared engine
+        # would affect anything rendered by other threads at the same time.
+        engine = copy.copy(Engine.get_default())
+        engine.string_if_invalid = "{{ %s }}"
+        return engine
+
+    # Parsing is the expensive part of expanding a template, and the same
+    # subject and body are expanded for every recipient, so compiled
+    # templates are cached by their text.
+    @staticmethod
+    @lru_cache(maxsize=512)
+    def get_template_object(template_text, escape=True,
+                            keep_placeholders=False):
         # Add default includes and encapsulate in danish
         lines = [] + EmailTemplate.default_includes + ["{% language 'da' %}"]
         if not escape:
@@ -1221,55 +1263,139 @@ class EmailTemplate(models.Model):
             lines.append("{% endautoescape %}")
         lines.append("{% endlanguage %}")
         encapsulated = "\n".join(lines)
+        if keep_placeholders:
+            return Template(
+                encapsulated, engine=EmailTemplate.placeholder_engine()
+            )
         return Template(encapsulated)
 
     @staticmethod
     def _expand(text, context, keep_placeholders=False, escape=True):
-        template = EmailTemplate.get_template_object(text, escape)
+        template = EmailTemplate.get_template_object(
+            text, escape, keep_placeholders
+        )
 
         if isinstance(context, dict):
             context = make_context(context)
 
-        # This setting will affect the global template engine, so we have to
-        # reset it below.
-        if keep_placeholders:
-            template.engine.string_if_invalid = "{{ %s }}"
+        return template.render(context)
+
+    def save(self, *args, **kwargs):
+        super(EmailTemplate, self).save(*args, **kwargs)
+        # Drop the compiled versions of the old text
+        EmailTemplate.get_template_object.cache_clear()
+        EmailTemplate.clear_template_map_cache()
+
+    def delete(self, *args, **kwargs):
+        res = super(EmailTemplate, self).delete(*args, **kwargs)
+        EmailTemplate.clear_template_map_cache()
+        return res
+
+    # Template maps by unit pk, kept while inside cached_template_maps()
+    template_map_cache = threading.local()
 
+    @staticmethod
+    @contextmanager
+    def cached_template_maps():
+        # Reuse the template map of each unit while sending a batch of
+        # emails. Nested blocks share the cache of the outermost one.
+        cache = EmailTemplate.template_map_cache
+        if getattr(cache, 'maps', None) is not None:
+            yield
+            return
+        cache.maps = {}
         try:
-            rendered = template.render(context)
+            yield
         finally:
-            # Reset string_if_invalid
-            if keep_placeholders:
-                template.engine.string_if_invalid = ''
+            cache.maps = None
 
-        return rendered
+    @staticmethod
+    def clear_template_map_cache():
+        if getattr(EmailTemplate.template_map_cache, 'maps', None):
+            EmailTemplate.template_map_cache.maps = {}
+
+    @staticmethod
+    def get_template_map(unit):
+        """
+        Map of template type id to the templates that apply to unit, found
+        with a single query over the unit and its ancestors. Each list has
+        the templates of the unit first, then those of its parent and so
+        on, and the templates without a unit last. Each template has its
+        unit's distance from unit as unit_depth, which is None for
+        templates without a unit.
+        """
+        unit_id = unit.pk if unit is not None else None
+        maps = getattr(EmailTemplate.template_map_cache, 'maps', None)
+        if maps is not None and unit_id in maps:
+            return maps[unit_id]
+
+        template_map = {}
+        for template in EmailTemplate.objects.raw(
+            '''
+            WITH RECURSIVE "ancestors"("id", "parent_id", "depth", "path") AS (
+                SELECT
+                    "unit"."id",
+                    "unit"."parent_id",
+                    0,
+                    ARRAY["unit"."id"]
+                FROM
+                    "booking_organizationalunit" "unit"
+                WHERE
+                    "unit"."id" = %s
+                UNION ALL
+                SELECT
+                    "unit"."id",
+                    "unit"."parent_id",
+                    "ancestors"."depth" + 1,
+                    "ancestors"."path" || "unit"."id"
+                FROM
+                    "booking_organizationalunit" "unit"
+                    INNER JOIN
+                    "ancestors" ON ("unit"."id" = "ancestors"."parent_id")
+                WHERE
+                    NOT "unit"."id" = ANY("ancestors"."path")
+            )
+            SELECT
+                "template".*,
+                "ancestors"."depth" AS "unit_depth"
+            FROM
+                "booking_emailtemplate" "template"
+                LEFT OUTER JOIN
+                "ancestors" ON (
+                    "template"."organizationalunit_id" = "ancestors"."id"
+                )
+            WHERE
+                "ancestors"."id" IS NOT NULL
+                OR
+                "template"."organizationalunit_id" IS NULL
+            ORDER BY
+                "ancestors"."depth" ASC NULLS LAST,
+                "template"."id" ASC
+            ''',
+            [unit_id]
+        ):
+            template_map.setdefault(template.type_id, []).append(template)
+
+        if maps is not None:
+            maps[unit_id] = template_map
+        return template_map
 
     @staticmethod
     def get_template(template_type, unit, include_overridden=False):
         if type(template_type) == int:
             template_type = EmailTemplateType.get(template_type)
+        type_id = template_type.pk if template_type is not None else None
+
+        # The first template from each unit, nearest unit first
         templates = []
-        while unit is not None and (include_overridden or len(templates) == 0):
-            try:
-                template = EmailTemplate.objects.filter(
-                    type=template_type,
-                    organizationalunit=unit
-                ).first()
-                if template is not None:
-                    templates.append(template)
-            except Exception:
-                pass
-            unit = unit.parent if unit.parent != unit else None
-        if include_overridden or len(templates) == 0:
-            try:
-                template = EmailTemplate.objects.filter(
-                    type=template_type,
-                    organizationalunit__isnull=True
-                ).first()
-                if template is not None:
-                    templates.append(template)
-            except Exception:
-                pass
+        depths = set()
+        for template in EmailTemplate.get_template_map(unit).get(
+            type_id, []
+        ):
+            if template.unit_depth not in depths:
+                depths.add(template.unit_depth)
+                templates.append(template)
+
         if include_overridden:
             return templates
         else:
@@ -1277,16 +1403,21 @@ class EmailTemplate(models.Model):
 
     @staticmethod
     def get_templates(unit, include_inherited=True):
-        if unit is None:
-            templates = EmailTemplate.objects.filter(
-                organizationalunit__isnull=True
-            ).all()
-        else:
-            templates = list(EmailTemplate.objects.filter(
-                organizationalunit=unit
-            ).all())
-        if include_inherited and unit is not None and unit.parent != unit:
-            templates.extend(EmailTemplate.get_templates(unit.parent, True))
+        own_depth = 0 if unit is not None else None
+        templates = [
+            template
+            for type_templates in EmailTemplate.get_template_map(
+                unit
+            ).values()
+            for template in type_templates
+            if include_inherited or template.unit_depth == own_depth
+        ]
+        templates.sort(
+            key=lambda template: (
+                template.unit_depth is None, template.unit_depth or 0,
+                template.pk
+            )
+        )
         return templates
 
     def get_template_variables(self):
@@ -2397,27 +2528,17 @@ class Product(AvailabilityUpdaterMixin, models.Model):
         )
         if self.only_one_guest_per_visit:
             qs = qs.filter(
-                visit__bookings__isnull=True
+                Q(visit__isnull=True) | Q(visit__booking_count=0)
             )
+        # Annotated with seats_left and waiting_left, times with neither
+        # left are not bookable
+        qs = EventTime.with_capacity(qs)
         if self.maximum_number_of_visitors is not None:
-            max = (self.maximum_number_of_visitors +
-                   (self.waiting_list_length or 0))
-
-            qs = qs.annotate(
-                attendees=Coalesce(
-                    Sum(
-                        Case(
-                            When(
-                                visit__bookings__cancelled=False,
-                                then='visit__bookings__booker__attendee_count'
-                            )
-                        )
-                    ),
-                    0
-                )
-            ).filter(
+            qs = qs.filter(
                 Q(visit__isnull=True) |
-                Q(attendees__lt=max)
+                Q(seats_left__gt=0) |
+                Q(waiting_left__isnull=True) |
+                Q(waiting_left__gt=0)
             )
 
         return qs
@@ -2519,32 +2640,101 @@ class Product(AvailabilityUpdaterMixin, models.Model):
     def autosend_enabled(self, template_type):
         return self.get_autosend(template_type) is not None
 
-    # This is used from booking.signals.update_search_vectors
-    def update_searchvector(self):
-
-        extra_search_old = self.extra_search_text or ""
-        extra_search_new = self.generate_extra_search_text() or ""
-        search_vector = SearchVector(
-            "title",
-            "teaser",
-            "description",
-            "mouseover_description",
-            "extra_search_text"
-        )
+    # Regenerates the extra search text and the search vector of the given
+    # products. The texts are written with one bulk update and the vectors
+    # are calculated by the database in one UPDATE, so the products are not
+    # saved again. This is used by PendingSearchReindex.
+    @staticmethod
+    def update_searchvectors(product_ids):
+        products = list(Product.objects.filter(
+            pk__in=product_ids
+        ).select_related('organizationalunit__parent'))
+        Product.load_search_relations(products)
+        for product in products:
+            product.extra_search_text = \
+                product.generate_extra_search_text() or ""
+
+        with transaction.atomic():
+            Product.objects.bulk_update(products, ['extra_search_text'])
+            Product.objects.filter(
+                pk__in=[product.pk for product in products]
+            ).update(search_vector=SearchVector(
+                "title",
+                "teaser",
+                "description",
+                "mouseover_description",
+                "extra_search_text"
+            ))
 
-        if (extra_search_old != extra_search_new) or (
-            self.search_vector != search_vector
+        return len(products)
+
+    # Loads the related objects generate_extra_search_text() uses for many
+    # products with one query per relation. prefetch_related would build a
+    # queryset per product and relation, which costs more than the queries.
+    @staticmethod
+    def load_search_relations(products):
+        by_pk = {}
+        for product in products:
+            product.search_relations = {
+                'links': [], 'gymnasiefag': [], 'grundskolefag': [],
+                'tags': [], 'topics': []
+            }
+            by_pk[product.pk] = product.search_relations
+
+        for (name, through, field) in (
+            ('links', Product.links.through, 'link'),
+            ('tags', Product.tags.through, 'tag'),
+            ('topics', Product.topics.through, 'topic'),
         ):
-            self.extra_search_text = extra_search_new
-            self.search_vector = search_vector
-            self.save()
-            return True
-        else:
-            return False
+            for x in through.objects.filter(
+                product_id__in=by_pk
+            ).select_related(field).order_by('pk'):
+                by_pk[x.product_id][name].append(getattr(x, field))
+
+        for (name, model) in (
+            ('gymnasiefag', ProductGymnasieFag),
+            ('grundskolefag', ProductGrundskoleFag),
+        ):
+            for x in model.objects.filter(
+                product_id__in=by_pk
+            ).select_related('subject'):
+                by_pk[x.product_id][name].append(x)
+
+    # Regenerates the search texts and vectors of all products in the
+    # queryset, or of all products, in chunks of chunk_size products.
+    # progress is called with the number of products done so far and the
+    # seconds spent after each chunk. Returns the number of products.
+    @staticmethod
+    def rebuild_searchvectors(qs=None, chunk_size=None, progress=None):
+        if qs is None:
+            qs = Product.objects.all()
+        if chunk_size is None:
+            chunk_size = settings.SEARCH_REINDEX_BATCH_SIZE
+
+        started = monotonic()
+        done = 0
+        for chunk in chunked_pks(qs, chunk_size):
+            done += Product.update_searchvectors(chunk)
+            if progress is not None:
+                progress(done, monotonic() - started)
+        return done
 
     def generate_extra_search_text(self):
         texts = []
 
+        # Related objects loaded by load_search_relations()
+        relations = getattr(self, 'search_relations', None)
+        if relations is None:
+            links = self.links.all()
+            subjects = self.all_subjects()
+            tags = self.tags.all()
+            topics = self.topics.all()
+        else:
+            links = relations['links']
+            subjects = relations['gymnasiefag'] + relations['grundskolefag']
+            tags = relations['tags']
+            topics = relations['topics']
+
         # Display-value for type
         texts.append(self.get_type_display() or "")
 
@@ -2557,7 +2747,7 @@ class Product(AvailabilityUpdaterMixin, models.Model):
                 texts.append(self.organizationalunit.parent.name)
 
         # Url, name and description of all links
-        for link in self.links.all():
+        for link in links:
             if link.url:
                 texts.append(link.url)
             if link.name:
@@ -2569,15 +2759,15 @@ class Product(AvailabilityUpdaterMixin, models.Model):
         texts.append(self.get_institution_level_display() or "")
 
         # All subjects
-        for x in self.all_subjects():
+        for x in subjects:
             texts.append(x.display_value())
 
         # Name of all tags
-        for t in self.tags.all():
+        for t in tags:
             texts.append(t.name)
 
         # Name of all topocs
-        for t in self.topics.all():
+        for t in topics:
             texts.append(t.name)
 
         return "\n".join(texts)
@@ -3163,6 +3353,62 @@ class Visit(AvailabilityUpdaterMixin, models.Model):
         on_delete=models.SET_NULL
     )
 
+    # Attendees and bookings of the visit, kept up to date by
+    # Visit.update_counters when bookings and guests change. The
+    # check_visit_counters management command compares them to the bookings.
+    attendees_count = models.IntegerField(
+        default=0
+    )
+    waiting_count = models.IntegerField(
+        default=0
+    )
+    cancelled_attendees_count = models.IntegerField(
+        default=0
+    )
+    booking_count = models.IntegerField(
+        default=0
+    )
+
+    counter_fields = [
+        'attendees_count', 'waiting_count', 'cancelled_attendees_count',
+        'booking_count'
+    ]
+
+    # The counters of the visits matching visit_cond, counted from their
+    # bookings
+    counters_sql = '''
+        SELECT
+            "booking_visit"."id" AS "visit_id",
+            COALESCE(SUM("booking_guest"."attendee_count") FILTER (
+                WHERE
+                    "booking_booking"."waitinglist_spot" = 0
+                    AND
+                    NOT "booking_booking"."cancelled"
+            ), 0) AS "attendees_count",
+            COALESCE(SUM("booking_guest"."attendee_count") FILTER (
+                WHERE
+                    "booking_booking"."waitinglist_spot" > 0
+                    AND
+                    NOT "booking_booking"."cancelled"
+            ), 0) AS "waiting_count",
+            COALESCE(SUM("booking_guest"."attendee_count") FILTER (
+                WHERE "booking_booking"."cancelled"
+            ), 0) AS "cancelled_attendees_count",
+            COUNT("booking_booking"."id") AS "booking_count"
+        FROM
+            "booking_visit"
+            LEFT OUTER JOIN "booking_booking" ON (
+                "booking_booking"."visit_id" = "booking_visit"."id"
+            )
+            LEFT OUTER JOIN "booking_guest" ON (
+                "booking_guest"."id" = "booking_booking"."booker_id"
+            )
+        WHERE
+            %s
+        GROUP BY
+            "booking_visit"."id"
+    '''
+
     WORKFLOW_STATUS_BEING_PLANNED = 0
     WORKFLOW_STATUS_REJECTED = 1
     WORKFLOW_STATUS_PLANNED = 2
@@ -3199,6 +3445,14 @@ class Visit(AvailabilityUpdaterMixin, models.Model):
         WORKFLOW_STATUS_AUTOASSIGN_FAILED
     ])
 
+    # States that change to executed when the visit's time is over
+    EXPIRABLE_STATES = set([
+        WORKFLOW_STATUS_PLANNED,
+        WORKFLOW_STATUS_PLANNED_NO_BOOKING,
+        WORKFLOW_STATUS_CONFIRMED,
+        WORKFLOW_STATUS_REMINDED
+    ])
+
     workflow_status_choices = (
         (WORKFLOW_STATUS_BEING_PLANNED, _(BEING_PLANNED_STATUS_TEXT)),
         (WORKFLOW_STATUS_REJECTED, _('Afvist af undervisere eller vært')),
@@ -3405,6 +3659,10 @@ class Visit(AvailabilityUpdaterMixin, models.Model):
             eventtime = self.eventtime
             self.eventtime.visit = None
             eventtime.save()
+            # The resources no longer spend time on the visit
+            ResourceUtilisation.refresh(
+                self.visitresource.values_list('resource_id', flat=True)
+            )
             # Register as a cancelled visit for the given time
             self.cancelled_eventtime = eventtime
             self.save()
@@ -3470,6 +3728,15 @@ class Visit(AvailabilityUpdaterMixin, models.Model):
             Q(resource__in=self.resources.all())
         )
 
+    @property
+    # Time spans in which assigning resources to this visit changes their
+    # availability.
+    def affected_calendar_intervals(self):
+        eventtime = getattr(self, 'eventtime', None)
+        if eventtime is None or not eventtime.start or not eventtime.end:
+            return []
+        return [(eventtime.start, eventtime.end)]
+
     def update_availability(self):
         for x in self.affected_eventtimes:
             x.update_availability()
@@ -3531,12 +3798,7 @@ class Visit(AvailabilityUpdaterMixin, models.Model):
         self.on_expire()
 
     def on_expire(self):
-        if self.workflow_status in [
-            self.WORKFLOW_STATUS_PLANNED,
-            self.WORKFLOW_STATUS_PLANNED_NO_BOOKING,
-            self.WORKFLOW_STATUS_CONFIRMED,
-            self.WORKFLOW_STATUS_REMINDED
-        ]:
+        if self.workflow_status in self.EXPIRABLE_STATES:
             self.workflow_status = self.WORKFLOW_STATUS_EXECUTED
             self.save()
 
@@ -3898,15 +4160,91 @@ class Visit(AvailabilityUpdaterMixin, models.Model):
 
     @property
     def nr_attendees(self):
-        return self.get_attendee_count(False, True)
+        return self.attendees_count
 
     @property
     def nr_waiting(self):
-        return self.get_attendee_count(True, False)
+        return self.waiting_count
 
     @property
     def nr_cancelled_attendees(self):
-        return self.get_attendee_count(True, True, True, False)
+        return self.cancelled_attendees_count
+
+    # Recounts the attendee and booking counters of the given visits, or of
+    # all visits if visit_ids is None. The visits are locked first, so a
+    # booking committed by a concurrent transaction is counted once that
+    # transaction is done.
+    @staticmethod
+    def update_counters(visit_ids=None):
+        if visit_ids is not None:
+            visit_ids = sorted(set(x for x in visit_ids if x is not None))
+            if len(visit_ids) == 0:
+                return
+            visit_cond = '"booking_visit"."id" = ANY(%s)'
+            params = [visit_ids]
+        else:
+            visit_cond = 'TRUE'
+            params = []
+
+        with transaction.atomic():
+            if visit_ids is not None:
+                list(
+                    Visit.objects.select_for_update().filter(
+                        pk__in=visit_ids
+                    ).order_by('pk').values_list('pk', flat=True)
+                )
+            with connection.cursor() as cursor:
+                cursor.execute('''
+                    UPDATE "booking_visit"
+                    SET
+                        "attendees_count" = "counted"."attendees_count",
+                        "waiting_count" = "counted"."waiting_count",
+                        "cancelled_attendees_count" =
+                            "counted"."cancelled_attendees_count",
+                        "booking_count" = "counted"."booking_count"
+                    FROM (%s) "counted"
+                    WHERE
+                        "booking_visit"."id" = "counted"."visit_id"
+                ''' % (Visit.counters_sql % visit_cond), params)
+
+    # (visit pk, stored counters, counted counters) for the visits whose
+    # counters do not match their bookings
+    @staticmethod
+    def inconsistent_counters():
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT
+                    "booking_visit"."id",
+                    "booking_visit"."attendees_count",
+                    "booking_visit"."waiting_count",
+                    "booking_visit"."cancelled_attendees_count",
+                    "booking_visit"."booking_count",
+                    "counted"."attendees_count",
+                    "counted"."waiting_count",
+                    "counted"."cancelled_attendees_count",
+                    "counted"."booking_count"
+                FROM
+                    "booking_visit"
+                    INNER JOIN (%s) "counted" ON (
+                        "counted"."visit_id" = "booking_visit"."id"
+                    )
+                WHERE
+                    ("booking_visit"."attendees_count",
+                     "booking_visit"."waiting_count",
+                     "booking_visit"."cancelled_attendees_count",
+                     "booking_visit"."booking_count")
+                    IS DISTINCT FROM
+                    ("counted"."attendees_count",
+                     "counted"."waiting_count",
+                     "counted"."cancelled_attendees_count",
+                     "counted"."booking_count")
+                ORDER BY
+                    "booking_visit"."id"
+            ''' % (Visit.counters_sql % 'TRUE'))
+            return [
+                (row[0], row[1:5], row[5:9])
+                for row in cursor.fetchall()
+            ]
 
     @property
     def available_seats(self):
@@ -3991,23 +4329,43 @@ class Visit(AvailabilityUpdaterMixin, models.Model):
 
         return " ".join(result)
 
-    # This is used from booking.signals.update_search_vectors
-    def update_searchvector(self):
-        old_value = self.extra_search_text or ""
-        new_value = self.as_searchtext() or ""
+    # Regenerates the extra search text and the search vector of the given
+    # visits where the text has changed, without saving the visits again.
+    # This is used by PendingSearchReindex.
+    @staticmethod
+    def update_searchvectors(visit_ids):
+        visits = Visit.objects.filter(pk__in=visit_ids).select_related(
+            'eventtime__product', 'cancelled_eventtime__product'
+        ).prefetch_related(
+            'bookings__booker__school__postcode'
+        )
 
-        if (old_value != new_value) or (
-            self.search_vector is None
-        ):
-            self.extra_search_text = new_value
-            self.search_vector = SearchVector("extra_search_text")
-            self.save()
-            return True
-        else:
-            return False
+        changed = []
+        for visit in visits:
+            old_value = visit.extra_search_text or ""
+            new_value = visit.as_searchtext() or ""
+            if old_value != new_value or visit.search_vector is None:
+                visit.extra_search_text = new_value
+                changed.append(visit)
+
+        with transaction.atomic():
+            Visit.objects.bulk_update(changed, ['extra_search_text'])
+            Visit.objects.filter(
+                pk__in=[visit.pk for visit in changed]
+            ).update(search_vector=SearchVector("extra_search_text"))
+
+        return len(changed)
 
     def save(self, *args, **kwargs):
         self.update_last_workflow_change()
+        # The counters are only written by update_counters; saving a visit
+        # loaded before a concurrent booking must not set them back
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in self.counter_fields
+            ]
         super(Visit, self).save(*args, **kwargs)
 
     def get_absolute_url(self):
@@ -4432,54 +4790,92 @@ class Visit(AvailabilityUpdaterMixin, models.Model):
         return context
 
     def resources_available_for_autoassign(self, resource_pool):
-        eligible = resource_pool.resources.exclude(visitresource__visit=self)
+        return resource_pool.resources_available_for_visits([self])[0]
 
-        return [
-            resource
-            for resource in eligible
-            if resource.available_for_visit(self)
-        ]
-
-    def autoassign_resources(self):
+    # Assigns free resources to the requirements that are not yet
+    # fulfilled. Availability for all requirements is found with one query,
+    # the resources are picked by the autoassign strategy (see
+    # AutoassignStrategy) and assigned together in one transaction.
+    def autoassign_resources(self, strategy=None):
         if self.is_multiproductvisit:
             self.multiproductvisit.autoassign_resources()
         if self.product is not None and self.product.time_mode == \
                 Product.TIME_MODE_RESOURCE_CONTROLLED_AUTOASSIGN:
-            for requirement in self.product.resourcerequirement_set.all():
-                if requirement.being_deleted:
-                    # Deletion of VisitResources can start this process, but
-                    # we must ignore requirements that are scheduled for
-                    # deletion.
-                    continue
-                assigned = self.resources.filter(
-                    visitresource__resource_requirement=requirement
+            # Deletion of VisitResources can start this process, but we must
+            # ignore requirements that are scheduled for deletion.
+            requirements = [
+                requirement for requirement in
+                self.product.resourcerequirement_set.filter(
+                    being_deleted=False
                 )
-                extra_needed = requirement.required_amount - assigned.count()
-                if extra_needed > 0:
-                    eligible = list(
-                        requirement.resource_pool.resources.exclude(
-                            id__in=[resource.id for resource in assigned]
-                        )
+            ]
+
+            # Resources are only assigned once to the visit
+            assigned = {}
+            taken = set()
+            for (requirement_id, resource_id) in VisitResource.objects.filter(
+                visit=self
+            ).values_list('resource_requirement_id', 'resource_id'):
+                assigned[requirement_id] = \
+                    assigned.get(requirement_id, 0) + 1
+                taken.add(resource_id)
+
+            needed = [
+                (requirement, requirement.required_amount -
+                 assigned.get(requirement.pk, 0))
+                for requirement in requirements
+            ]
+            needed = [(r, amount) for (r, amount) in needed if amount > 0]
+            if len(needed) == 0:
+                self.resources_updated()
+                return
+
+            pool_resources = {}
+            for pool_resource in ResourcePool.resources.through.objects.filter(
+                resourcepool_id__in=[r.resource_pool_id for (r, a) in needed]
+            ).select_related('resource__resource_type'):
+                pool_resources.setdefault(
+                    pool_resource.resourcepool_id, []
+                ).append(pool_resource.resource)
+
+            candidates = dict(
+                (resource.pk, resource)
+                for resources in pool_resources.values()
+                for resource in resources
+                if resource.pk not in taken
+            )
+            available = Resource.availability_matrix(
+                candidates.values(), Resource.visit_times([self]), [self]
+            )
+
+            if strategy is None:
+                strategy = AutoassignStrategy.get()
+            assignments = []
+            failed = False
+            for (requirement, extra_needed) in needed:
+                free = [
+                    resource for resource in pool_resources.get(
+                        requirement.resource_pool_id, []
                     )
-                    random.shuffle(eligible)
-                    found = []
-                    for resource in eligible:
-                        if resource.available_for_visit(self):
-                            found.append(resource)
-                            if len(found) >= extra_needed:
-                                break
-                    if len(found) < extra_needed:
-                        # requirement cannot be fulfilled;
-                        # not enough available resources
-                        self.workflow_status = \
-                            self.WORKFLOW_STATUS_AUTOASSIGN_FAILED
-                        self.save()
-                    for resource in found:
-                        VisitResource(
-                            visit=self,
-                            resource=resource,
-                            resource_requirement=requirement
-                        ).save()
+                    if resource.pk in candidates and
+                    available[resource.pk][0] and
+                    resource.pk not in taken
+                ]
+                found = strategy.order(self, requirement, free)[:extra_needed]
+                if len(found) < extra_needed:
+                    # requirement cannot be fulfilled;
+                    # not enough available resources
+                    failed = True
+                for resource in found:
+                    taken.add(resource.pk)
+                    assignments.append((resource, requirement))
+
+            with transaction.atomic():
+                VisitResource.bulk_assign(self, assignments)
+                if failed:
+                    self.workflow_status = \
+                        self.WORKFLOW_STATUS_AUTOASSIGN_FAILED
+                    self.save()
             self.resources_updated()
 
     @property
@@ -5197,6 +5593,96 @@ class VisitAutosend(Autosend):
         if self.inherit:
             return self.visit.get_autosend(self.template_type)
 
+    # The enabled autosends of the given template types, annotated with
+    # effective_days: their own days, or those of the enabled product
+    # autosend they inherit, as found by get_inherited. Inheriting
+    # autosends without an enabled product autosend are left out.
+    @staticmethod
+    def resolved(template_types):
+        # The product of the visit is that of its eventtime, or that of
+        # the eventtime it was cancelled from
+        inherited = ProductAutosend.objects.filter(
+            Q(product__eventtime__visit=OuterRef('visit')) |
+            Q(product__eventtime__cancelled_visits=OuterRef('visit')),
+            template_type=OuterRef('template_type'),
+            enabled=True
+        ).order_by('pk')
+        return VisitAutosend.objects.filter(
+            template_type__in=template_types
+        ).annotate(
+            inherited_days=Subquery(inherited.values('days')[:1]),
+            inherited_enabled=Exists(inherited)
+        ).filter(
+            Q(inherit=False, enabled=True) |
+            Q(
+                inherit=True,
+                inherited_enabled=True,
+                visit__multiproductvisit__isnull=True
+            )
+        ).annotate(
+            effective_days=Case(
+                When(inherit=True, then=F('inherited_days')),
+                default=F('days'),
+                output_field=IntegerField()
+            )
+        ).select_related('visit__eventtime', 'template_type')
+
+    # The autosends of the given template types that are due on day (or
+    # today): those of visits starting effective_days later. Visits that
+    # have started are left out.
+    @staticmethod
+    def due_before_start(template_types, day=None):
+        if day is None:
+            day = timezone.localdate()
+        return VisitAutosend.resolved(template_types).filter(
+            effective_days__isnull=False,
+            visit__eventtime__start__gte=timezone.now()
+        ).annotate(
+            due_date=ExpressionWrapper(
+                TruncDate('visit__eventtime__start') - F('effective_days'),
+                output_field=DateField()
+            )
+        ).filter(due_date=day)
+
+    # The autosends of the given template types that are due on day (or
+    # today): those of visits that got their first booking
+    # effective_days earlier.
+    @staticmethod
+    def due_after_first_booking(template_types, day=None):
+        if day is None:
+            day = timezone.localdate()
+        first_booked = Booking.objects.filter(
+            visit=OuterRef('visit')
+        ).order_by('statistics__created_time').values(
+            'statistics__created_time'
+        )[:1]
+        return VisitAutosend.resolved(template_types).filter(
+            effective_days__isnull=False
+        ).annotate(
+            first_booked=Subquery(first_booked)
+        ).annotate(
+            due_date=ExpressionWrapper(
+                TruncDate('first_booked') + F('effective_days'),
+                output_field=DateField()
+            )
+        ).filter(due_date=day)
+
+    # The autosends of the given template types that are due on day (or
+    # today) when they are sent a fixed number of days after the visit
+    # has ended
+    @staticmethod
+    def due_after_end(template_types, days, day=None):
+        if day is None:
+            day = timezone.localdate()
+        return VisitAutosend.resolved(template_types).filter(
+            Q(inherit=True) | Q(days__isnull=False)
+        ).annotate(
+            visit_end=Coalesce(
+                F('visit__eventtime__end'),
+                F('visit__cancelled_eventtime__end')
+            )
+        ).filter(visit_end__date=day - timedelta(days))
+
     def __str__(self):
         return "%s on %s" % (
             super(VisitAutosend, self).__str__(),
@@ -5759,6 +6245,38 @@ class Guest(models.Model):
             Guest.anonymized
         self.save()
 
+    # Anonymizes the next batch_size guests after after_pk, in pk order,
+    # whose visits started before limit, with one UPDATE in its own
+    # transaction. Their visits' search texts include the guests' names,
+    # so they are marked for reindexing. Returns the anonymized pks.
+    @staticmethod
+    def anonymize_batch(limit, after_pk=0, batch_size=None):
+        if batch_size is None:
+            batch_size = settings.ANONYMIZE_BATCH_SIZE
+        with transaction.atomic():
+            pks = list(
+                Guest.objects.filter(
+                    Q(booking__visit__eventtime__start__lt=limit) |
+                    Q(booking__visit__cancelled_eventtime__start__lt=limit),
+                    pk__gt=after_pk
+                ).exclude(
+                    Guest.filter_anonymized()
+                ).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if pks:
+                Guest.objects.filter(pk__in=pks).update(
+                    firstname=Guest.anonymized,
+                    lastname=Guest.anonymized,
+                    email=Guest.anonymized,
+                    phone=Guest.anonymized
+                )
+                PendingSearchReindex.mark(
+                    visit_ids=Booking.objects.filter(
+                        booker_id__in=pks
+                    ).values_list('visit_id', flat=True)
+                )
+        return pks
+
     @staticmethod
     def filter_anonymized():
         return Q(
@@ -5812,6 +6330,58 @@ class Booking(models.Model):
         verbose_name='Aflyst'
     )
 
+    # Places the booking on the visit of eventtime and saves it, making the
+    # visit first if the time has none. The event time and its visit are
+    # locked until the surrounding transaction ends, so concurrent bookings
+    # of one time are placed one at a time and always see the seats taken
+    # by those before them. A booking that does not fit in the free seats
+    # goes on the waiting list; if it fits in neither, ValidationError is
+    # raised and nothing is saved. Returns whether a visit was made.
+    def place(self, eventtime, **visit_kwargs):
+        with transaction.atomic():
+            created = False
+            if eventtime.pk is not None:
+                eventtime = EventTime.objects.select_for_update().get(
+                    pk=eventtime.pk
+                )
+            if eventtime.visit is None:
+                eventtime.make_visit(**visit_kwargs)
+                created = True
+            visit = Visit.objects.select_for_update().get(
+                pk=eventtime.visit.pk
+            )
+
+            attendee_count = self.booker.attendee_count
+            available_seats = visit.available_seats
+            self.visit = visit
+            self.waitinglist_spot = 0
+            if available_seats != AVAILABLE_SEATS_NO_LIMIT and \
+                    attendee_count > available_seats:
+                if visit.product.do_create_waiting_list:
+                    if visit.waiting_list_closed:
+                        raise ValidationError(
+                            _("Der er ikke flere ledige pladser, og "
+                              "ventelisten er lukket")
+                        )
+                    waitinglist_capacity = visit.waiting_list_capacity
+                    if attendee_count > waitinglist_capacity:
+                        raise ValidationError(
+                            _("Der er kun %(waitinglist_capacity)d pladser "
+                              "på ventelisten") % {
+                                'waitinglist_capacity': waitinglist_capacity
+                            }
+                        )
+                    self.waitinglist_spot = visit.next_waiting_list_spot
+                elif not created:
+                    # A visit made for this booking takes it whatever its
+                    # size, but others are not overbooked
+                    raise ValidationError(
+                        _("Der er kun %(available_seats)d ledige pladser") %
+                        {'available_seats': available_seats}
+                    )
+            self.save()
+        return created
+
     def get_visit_attr(self, attrname):
         if not self.visit:
             return None
@@ -6115,6 +6685,17 @@ class BookingGrundskoleSubjectLevel(models.Model):
 class KUEmailMessage(models.Model):
     """Email data for logging purposes."""
 
+    class Meta:
+        # Only the messages that have not been anonymized, for
+        # anonymize_batch
+        indexes = [
+            models.Index(
+                fields=['created'],
+                name='kuemailmessage_unanonymized',
+                condition=~Q(recipients="[anonymiseret]")
+            ),
+        ]
+
     objects = KUEmailMessageQuerySet.as_manager()
 
     created = models.DateTimeField(
@@ -6166,6 +6747,41 @@ class KUEmailMessage(models.Model):
         on_delete=models.SET_NULL
     )
 
+    DELIVERY_QUEUED = 0
+    DELIVERY_SENT = 1
+    DELIVERY_FAILED = 2
+
+    delivery_status_choices = (
+        (DELIVERY_QUEUED, _("I kø")),
+        (DELIVERY_SENT, _("Sendt")),
+        (DELIVERY_FAILED, _("Fejlet")),
+    )
+    delivery_status = models.IntegerField(
+        choices=delivery_status_choices,
+        default=DELIVERY_SENT,
+        verbose_name=_("Afsendelsesstatus")
+    )
+    delivery_attempts = models.IntegerField(
+        default=0
+    )
+    # When a queued message should next be attempted sent; only set for
+    # queued messages
+    next_attempt = models.DateTimeField(
+        blank=True,
+        null=True,
+        default=None,
+        db_index=True
+    )
+    delivery_error = models.TextField(
+        blank=True,
+        null=True
+    )
+    delivered = models.DateTimeField(
+        blank=True,
+        null=True,
+        default=None
+    )
+
     @staticmethod
     def extract_addresses(recipients):
         if type(recipients) != list:
@@ -6226,13 +6842,16 @@ class KUEmailMessage(models.Model):
     @staticmethod
     def save_email(
             email_message, instance, reply_nonce=None, htmlbody=None,
-            template_type=None, original_from_email=None, reply_to_message=None
+            template_type=None, original_from_email=None,
+            reply_to_message=None, queued=False
     ):
         """
         :param email_message: An instance of
         django.core.mail.message.EmailMessage
         :param instance: The object that the message concerns i.e. Booking,
         Product etc.
+        :param queued: Whether the message still has to be sent, by
+        KUEmailMessage.send_queued
         :return: None
         """
         ctype = ContentType.objects.get_for_model(instance)
@@ -6262,10 +6881,96 @@ class KUEmailMessage(models.Model):
             template_key=template_key,
             reply_to_message=reply_to_message
         )
+        if queued:
+            ku_email_message.delivery_status = KUEmailMessage.DELIVERY_QUEUED
+            ku_email_message.next_attempt = ku_email_message.created
+        else:
+            ku_email_message.delivered = timezone.now()
         ku_email_message.save()
 
         return ku_email_message
 
+    def as_email_message(self):
+        # Messages are created with a single recipient, so the recipients
+        # field holds exactly one address
+        message = EmailMultiAlternatives(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email,
+            to=[self.recipients],
+        )
+        if self.htmlbody is not None:
+            message.attach_alternative(self.htmlbody, 'text/html')
+        return message
+
+    @staticmethod
+    def send_queued(batch_size=None):
+        """
+        Send a batch of queued messages over a single connection to the mail
+        server. Failed messages are retried later with exponential backoff,
+        until settings.EMAIL_MAX_ATTEMPTS is reached.
+        :return: The number of messages attempted
+        """
+        if batch_size is None:
+            batch_size = settings.EMAIL_BATCH_SIZE
+        now = timezone.now()
+
+        # Claim the batch by moving its next attempt into the future, so
+        # other workers leave it alone while we send. Should we die while
+        # sending, the messages will be picked up again after that.
+        with transaction.atomic():
+            batch = list(
+                KUEmailMessage.objects.select_for_update(
+                    skip_locked=True
+                ).filter(
+                    delivery_status=KUEmailMessage.DELIVERY_QUEUED,
+                    next_attempt__lte=now
+                ).order_by('next_attempt')[:batch_size]
+            )
+            KUEmailMessage.objects.filter(
+                pk__in=[message.pk for message in batch]
+            ).update(next_attempt=now + timedelta(minutes=10))
+
+        if len(batch) == 0:
+            return 0
+
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            connection = None
+            error = e
+
+        for message in batch:
+            message.delivery_attempts += 1
+            try:
+                if connection is None:
+                    raise error
+                connection.send_messages([message.as_email_message()])
+                message.delivery_status = KUEmailMessage.DELIVERY_SENT
+                message.delivered = timezone.now()
+                message.next_attempt = None
+                message.delivery_error = None
+            except Exception as e:
+                message.delivery_error = str(e)
+                if message.delivery_attempts >= \
+                        settings.EMAIL_MAX_ATTEMPTS:
+                    message.delivery_status = KUEmailMessage.DELIVERY_FAILED
+                    message.next_attempt = None
+                else:
+                    message.next_attempt = timezone.now() + timedelta(
+                        minutes=2 ** message.delivery_attempts
+                    )
+
+        if connection is not None:
+            connection.close()
+
+        KUEmailMessage.objects.bulk_update(batch, [
+            'delivery_status', 'delivery_attempts', 'next_attempt',
+            'delivery_error', 'delivered'
+        ])
+        return len(batch)
+
     @staticmethod
     def send_email(template, context, recipients, instance,
                    organizationalunit=None, original_from_email=None,
@@ -6335,13 +7040,15 @@ class KUEmailMessage(models.Model):
             )
             if htmlbody is not None:
                 message.attach_alternative(htmlbody, 'text/html')
-            message.send()
+            if not settings.QUEUE_EMAILS:
+                message.send()
 
             msg_obj = KUEmailMessage.save_email(
                 message, instance, reply_nonce=nonce,
                 template_type=template.type,
                 original_from_email=original_from_email,
-                reply_to_message=reply_to_message
+                reply_to_message=reply_to_message,
+                queued=settings.QUEUE_EMAILS
             )
             recipient.email_message = msg_obj
             recipient.save()
@@ -6396,6 +7103,29 @@ class KUEmailMessage(models.Model):
         self.htmlbody = KUEmailMessage.anonymized
         self.save()
 
+    # Anonymizes the next batch_size messages after after_pk, in pk order,
+    # created before limit, with one UPDATE. Returns the anonymized pks.
+    @staticmethod
+    def anonymize_batch(limit, after_pk=0, batch_size=None):
+        if batch_size is None:
+            batch_size = settings.ANONYMIZE_BATCH_SIZE
+        with transaction.atomic():
+            pks = list(
+                KUEmailMessage.objects.filter(
+                    created__lt=limit,
+                    pk__gt=after_pk
+                ).exclude(
+                    **KUEmailMessage.anonymized_filter
+                ).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if pks:
+                KUEmailMessage.objects.filter(pk__in=pks).update(
+                    recipients=KUEmailMessage.anonymized,
+                    body=KUEmailMessage.anonymized,
+                    htmlbody=KUEmailMessage.anonymized
+                )
+        return pks
+
 
 class BookerResponseNonce(models.Model):
     uuid = models.UUIDField(default=uuid.uuid4)
@@ -6770,6 +7500,79 @@ class ExercisePresentation(models.Model):
                 exercise_presentation.save()
 
 
+# Products and visits whose search text and search vector must be
+# regenerated. They are marked when they or their bookings are saved. With
+# settings.DEFER_SEARCH_INDEXING the marks are stored here, in the saving
+# transaction, and processed in batches by the SearchReindexJob cron job;
+# otherwise they are processed right away. References are kept without
+# database constraints, since the referenced objects may be deleted before
+# they are processed.
+class PendingSearchReindex(models.Model):
+    product = models.OneToOneField(
+        Product,
+        null=True,
+        related_name='+',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
+    )
+    visit = models.OneToOneField(
+        Visit,
+        null=True,
+        related_name='+',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
+    )
+
+    @staticmethod
+    def mark(product_ids=(), visit_ids=()):
+        product_ids = set(x for x in product_ids if x is not None)
+        visit_ids = set(x for x in visit_ids if x is not None)
+
+        if settings.DEFER_SEARCH_INDEXING:
+            PendingSearchReindex.objects.bulk_create(
+                [PendingSearchReindex(product_id=x) for x in product_ids] +
+                [PendingSearchReindex(visit_id=x) for x in visit_ids],
+                ignore_conflicts=True
+            )
+        else:
+            if product_ids:
+                Product.update_searchvectors(product_ids)
+            if visit_ids:
+                Visit.update_searchvectors(visit_ids)
+
+    # Processes and removes a batch of marked products and visits. Marks are
+    # locked while processing, so concurrent runs skip them, and they are
+    # kept if processing fails. Returns the number of processed marks.
+    @staticmethod
+    def process_pending(batch_size=None):
+        if batch_size is None:
+            batch_size = settings.SEARCH_REINDEX_BATCH_SIZE
+
+        with transaction.atomic():
+            pending = list(
+                PendingSearchReindex.objects.select_for_update(
+                    skip_locked=True
+                ).order_by('pk').values_list(
+                    'pk', 'product_id', 'visit_id'
+                )[:batch_size]
+            )
+            if len(pending) == 0:
+                return 0
+
+            PendingSearchReindex.objects.filter(
+                pk__in=[x[0] for x in pending]
+            ).delete()
+
+            product_ids = [x[1] for x in pending if x[1] is not None]
+            if product_ids:
+                Product.update_searchvectors(product_ids)
+            visit_ids = [x[2] for x in pending if x[2] is not None]
+            if visit_ids:
+                Visit.update_searchvectors(visit_ids)
+
+        return len(pending)
+
+
 from booking.resource_based import models as rb_models  # noqa
 
 EventTime = rb_models.EventTime
@@ -6787,3 +7590,7 @@ VehicleResource = rb_models.VehicleResource
 ResourcePool = rb_models.ResourcePool
 ResourceRequirement = rb_models.ResourceRequirement
 VisitResource = rb_models.VisitResource
+PendingAvailabilityUpdate = rb_models.PendingAvailabilityUpdate
+PublicBookableTime = rb_models.PublicBookableTime
+AutoassignStrategy = rb_models.AutoassignStrategy
+ResourceUtilisation = rb_models.ResourceUtilisation
@@ -284,16 +284,18 @@ class EditVisitResourceForm(forms.Form):
             resourcefield.label_suffix = \
                 resource_requirement.resource_pool.name
 
+            resources = resource_requirement.resource_pool.specific_resources
             resourcefield.choices = [
                 (resource.id, resource.get_name())
-                for resource
-                in resource_requirement.resource_pool.specific_resources
+                for resource in resources
             ]
+            available = Resource.availability_matrix(
+                resources, Resource.visit_times([visit]), [visit]
+            )
             resourcefield.disabled_values = [
                 resource.id
-                for resource
-                in resource_requirement.resource_pool.specific_resources
-                if not resource.available_for_visit(visit)
+                for resource in resources
+                if not available[resource.pk][0]
             ]
         else:
             resourcefield.label = _("Ukendt ressourcebehov")
@@ -1,17 +1,31 @@
 # encoding: utf-8
 import datetime
+import heapq
 import math
+import random
 import re
+import threading
+from collections import OrderedDict
 from functools import total_ordering
 
+from django.conf import settings
 from django.contrib.auth import models as auth_models
+from django.core.exceptions import EmptyResultSet
 from django.core.validators import MinValueValidator
+from django.db import connection
 from django.db import models
 from django.db import transaction
+from django.db.models import Case
 from django.db.models import F
+from django.db.models import IntegerField
+from django.db.models import Max
 from django.db.models import Q
+from django.db.models import Value
+from django.db.models import When
 from django.db.models.deletion import SET_NULL
 from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+from django.db.models.functions import Greatest
 from django.urls import reverse
 from django.utils import formats
 from django.utils import timezone
@@ -22,6 +36,7 @@ from booking.constants import AVAILABLE_SEATS_NO_LIMIT
 from booking.mixins import AvailabilityUpdaterMixin
 from booking.models import Room, Visit, EmailTemplateType, Product, \
     KUEmailRecipient
+from booking.utils import INFINITY, IntervalList, merge_intervals
 from user_profile.constants import TEACHER, HOST, NONE
 
 
@@ -31,6 +46,20 @@ class EventTime(models.Model):
         verbose_name = _("tidspunkt")
         verbose_name_plural = _("tidspunkter")
         ordering = ['start', 'end']
+        # Only the times that have not been notified yet, for
+        # notify_pending
+        indexes = [
+            models.Index(
+                fields=['start'],
+                name='eventtime_notify_start_idx',
+                condition=Q(has_notified_start=False)
+            ),
+            models.Index(
+                fields=['end'],
+                name='eventtime_notify_end_idx',
+                condition=Q(has_notified_end=False)
+            ),
+        ]
 
     product = models.ForeignKey(
         "Product",
@@ -191,6 +220,36 @@ class EventTime(models.Model):
 
         return visit
 
+    def save(self, *args, **kwargs):
+        # Moving the time of a visit frees its resources at the old time and
+        # occupies them at the new one.
+        moved_from = None
+        if self.pk is not None and self.visit_id is not None:
+            stored = EventTime.objects.filter(pk=self.pk).values_list(
+                'start', 'end'
+            ).first()
+            if stored is not None and stored != (self.start, self.end):
+                moved_from = stored
+
+        res = super(EventTime, self).save(*args, **kwargs)
+
+        if moved_from is not None:
+            intervals = [
+                x for x in (moved_from, (self.start, self.end))
+                if x[0] is not None and x[1] is not None
+            ]
+            AvailabilityUpdaterMixin.update_availability_for([
+                (calendar, intervals)
+                for calendar in self.visit.affected_calendars
+            ], [])
+            ResourceUtilisation.refresh(
+                VisitResource.objects.filter(
+                    visit_id=self.visit_id
+                ).values_list('resource_id', flat=True)
+            )
+
+        return res
+
     def update_availability(self):
         fully_assigned = True
 
@@ -333,6 +392,53 @@ class EventTime(models.Model):
         else:
             return 0
 
+    # Annotates the eventtimes of qs with the same numbers as
+    # available_seats and waiting_list_capacity, as seats_left and
+    # waiting_left, computed from the counters on their visits in the same
+    # query. waiting_left is None where the waiting list has no limit.
+    @staticmethod
+    def with_capacity(qs):
+        maximum = 'product__maximum_number_of_visitors'
+        length = 'product__waiting_list_length'
+        return qs.annotate(
+            seats_left=Case(
+                When(product__isnull=True, then=Value(0)),
+                When(**{
+                    maximum + '__isnull': True,
+                    'then': Value(AVAILABLE_SEATS_NO_LIMIT)
+                }),
+                default=Greatest(
+                    F(maximum) - Coalesce(F('visit__attendees_count'), 0),
+                    0
+                ),
+                output_field=IntegerField()
+            ),
+            waiting_left=Case(
+                When(product__isnull=True, then=Value(0)),
+                When(product__do_create_waiting_list=False, then=Value(0)),
+                When(**{length + '__isnull': True, 'then': Value(None)}),
+                When(**{length + '__lte': 0, 'then': Value(0)}),
+                When(visit__isnull=True, then=F(length)),
+                default=Greatest(F(length) - F('visit__waiting_count'), 0),
+                output_field=IntegerField()
+            )
+        )
+
+    # The free seats and waiting list spots of the eventtimes in qs, keyed
+    # by eventtime pk as used by the booking forms
+    @staticmethod
+    def capacity_payload(qs):
+        return {
+            str(pk): {
+                'available': seats_left,
+                'waitinglist': INFINITY if waiting_left is None
+                else waiting_left
+            }
+            for (pk, seats_left, waiting_left) in EventTime.with_capacity(
+                qs
+            ).values_list('pk', 'seats_left', 'waiting_left')
+        }
+
     @property
     def can_be_deleted(self):
         return not self.visit
@@ -356,208 +462,198 @@ class EventTime(models.Model):
         r"$"
     )
 
-    # Update resource_status for eventtimes in the given queryset
+    # Update resource_status for eventtimes in the given queryset. The new
+    # status is calculated for all the eventtimes in one statement, using
+    # the same rules as update_availability(), and only rows whose status
+    # changes are written.
     @staticmethod
-    def update_resource_status_for_qs(qs):
+    def update_resource_status_for_qs(qs, resource_controlled_only=True):
         # Make sure we only work on stuff that's actually resource controlled
-        qs = qs.filter(
-            product__time_mode__in=[
-                Product.TIME_MODE_RESOURCE_CONTROLLED,
-                Product.TIME_MODE_RESOURCE_CONTROLLED_AUTOASSIGN
-            ]
-        )
+        if resource_controlled_only:
+            qs = qs.filter(
+                product__time_mode__in=[
+                    Product.TIME_MODE_RESOURCE_CONTROLLED,
+                    Product.TIME_MODE_RESOURCE_CONTROLLED_AUTOASSIGN
+                ]
+            )
+        try:
+            (ids_sql, ids_params) = qs.order_by().values('pk').query.\
+                sql_with_params()
+        except EmptyResultSet:
+            return EventTime.objects.none()
 
-        num_requirements_sql = '''
+        # Number of resources assigned to the visit for the requirement
+        num_assigned_sql = '''
             SELECT
                 COUNT(1)
             FROM
-                "booking_resourcerequirement" "nrs_req"
-                INNER JOIN
-                "booking_product" "nrs_product" ON (
-                    "nrs_req"."product_id" = "nrs_product"."id"
-                )
-            WHERE "nrs_product"."id" = "booking_eventtime"."product_id"
-        '''
-
-        available_calender_times_sql = '''
-            SELECT
-                "booking_calendarcalculatedavailable"."id"
-            FROM
-                "booking_calendarcalculatedavailable"
-            WHERE
-                "booking_calendarcalculatedavailable"."calendar_id" =
-                    "available_resource"."calendar_id"
-                AND
-                    "booking_calendarcalculatedavailable"."start" <=
-                        "booking_eventtime"."start"
-                AND
-                    "booking_calendarcalculatedavailable"."end" >=
-                        "booking_eventtime"."end"
-        '''
-
-        blocking_booking_assignments_sql = '''
-            SELECT
-                "blocking_time"."id"
-            FROM
-                "booking_eventtime" "blocking_time"
-                INNER JOIN
-                "booking_visit" "bt_visit" ON (
-                    "blocking_time"."visit_id" = "bt_visit"."id"
-                )
-                INNER JOIN
-                "booking_visitresource" "bt_resource" ON (
-                    "bt_visit"."id" = "bt_resource"."visit_id"
-                )
+                "booking_visitresource" "assigned_resource"
             WHERE
-                "bt_resource"."resource_requirement_id" =
-                    "num_fullfilled_req"."id"
-                AND
-                "bt_resource"."resource_id" = "available_resource"."id"
-                AND
-                "bt_visit"."workflow_status" != 7
-                AND
-                "blocking_time"."start" <
-                    "booking_eventtime"."end"
+                "assigned_resource"."visit_id" = "et"."visit_id"
                 AND
-                "blocking_time"."end" >
-                    "booking_eventtime"."start"
-                AND
-                "blocking_time"."id" != "booking_eventtime"."id"
+                "assigned_resource"."resource_requirement_id" = "req"."id"
         '''
 
-        num_available_resources_sql = '''
+        # Number of resources in the requirement's pool that have calculated
+        # available time covering the eventtime
+        num_free_sql = '''
             SELECT
                 COUNT(1)
             FROM
-                "booking_resource" "available_resource"
+                "booking_resourcepool_resources" "free_pool_res"
                 INNER JOIN
-                "booking_resourcepool_resources" "a_resp_res" ON (
-                     "available_resource"."id" =  "a_resp_res"."resource_id"
+                "booking_resource" "free_resource" ON (
+                    "free_pool_res"."resource_id" = "free_resource"."id"
                 )
             WHERE
-                 "a_resp_res"."resourcepool_id" =
-                    "num_fullfilled_req"."resource_pool_id"
-                AND
-                    NOT EXISTS(%s)
+                "free_pool_res"."resourcepool_id" = "req"."resource_pool_id"
                 AND
-                (
-                    "available_resource"."calendar_id" IS NULL
-                    OR
-                    EXISTS(%s)
-                )
-        ''' % (
-            # Need to check blocking bookings for resources that do not have
-            # a calendar.
-            blocking_booking_assignments_sql,
-            available_calender_times_sql,
-        )
-
-        num_assigned_for_requirement_sql = '''
-            SELECT
-                COUNT(1)
-            FROM
-                "booking_visit" "assigned_visit"
-                INNER JOIN
-                "booking_visitresource" "assigned_resource" ON (
-                    "assigned_visit"."id" = "assigned_resource"."visit_id"
+                EXISTS (
+                    SELECT
+                        1
+                    FROM
+                        "booking_calendarcalculatedavailable" "avail"
+                    WHERE
+                        "avail"."calendar_id" = "free_resource"."calendar_id"
+                        AND
+                        "avail"."start" <= "et"."start"
+                        AND
+                        "avail"."end" >= "et"."end"
                 )
-            WHERE (
-                "assigned_visit"."id" = "booking_eventtime"."visit_id"
-                AND
-                "assigned_resource"."resource_requirement_id" =
-                    "num_fullfilled_req"."id"
-            )
         '''
 
-        num_can_be_fullfilled_sql = '''
+        requirement_state_sql = '''
             SELECT
-                COUNT(1)
+                "et"."id" AS "eventtime_id",
+                "req"."required_amount" != "assigned"."num"
+                    AS "unfulfilled",
+                (
+                    "req"."required_amount" != "assigned"."num"
+                    AND
+                    "et"."start" IS NOT NULL
+                    AND
+                    "et"."end" IS NOT NULL
+                    AND
+                    CASE
+                        WHEN "req"."resource_pool_id" IS NULL THEN TRUE
+                        WHEN "req"."required_amount" <= "assigned"."num"
+                            THEN FALSE
+                        ELSE (%s) < "req"."required_amount" - "assigned"."num"
+                    END
+                ) AS "blocking"
             FROM
-                "booking_resourcerequirement" "num_fullfilled_req"
+                "booking_eventtime" "et"
                 INNER JOIN
-                "booking_product" "nfr_product" ON (
-                    "num_fullfilled_req"."product_id" = "nfr_product"."id"
+                "booking_resourcerequirement" "req" ON (
+                    "req"."product_id" = "et"."product_id"
                 )
+                CROSS JOIN LATERAL (
+                    SELECT (%s) AS "num"
+                ) "assigned"
             WHERE
-                "nfr_product"."id" = "booking_eventtime"."product_id"
-                AND
-                (
-                    "num_fullfilled_req"."required_amount" > (%s)
-                    AND
-                    "num_fullfilled_req"."required_amount" <= (
-                        (%s)
-                        +
-                        (%s)
-                    )
-                )
-        ''' % (
-            num_assigned_for_requirement_sql,
-            num_assigned_for_requirement_sql,
-            num_available_resources_sql,
-        )
+                "et"."id" IN (%s)
+        ''' % (num_free_sql, num_assigned_sql, ids_sql)
 
-        num_assigned_sql = '''
+        new_status_sql = '''
             SELECT
-                COUNT(1)
+                "et"."id",
+                CASE
+                    WHEN BOOL_OR("req_state"."blocking") THEN %%s
+                    WHEN BOOL_OR("req_state"."unfulfilled") THEN %%s
+                    ELSE %%s
+                END AS "resource_status"
             FROM
-                "booking_resourcerequirement" "num_assigned_req"
-                INNER JOIN
-                "booking_product" "nar_product" ON (
-                    "num_assigned_req"."product_id" = "nar_product"."id"
-                )
+                "booking_eventtime" "et"
+                LEFT OUTER JOIN
+                "req_state" ON ("req_state"."eventtime_id" = "et"."id")
+            WHERE
+                "et"."id" IN (%s)
+            GROUP BY
+                "et"."id"
+        ''' % ids_sql
+
+        update_sql = '''
+            WITH
+                "req_state" AS (%s),
+                "new_status" AS (%s)
+            UPDATE
+                "booking_eventtime"
+            SET
+                "resource_status" = "new_status"."resource_status"
+            FROM
+                "new_status"
             WHERE
-                "nar_product"."id" = "booking_eventtime"."product_id"
+                "booking_eventtime"."id" = "new_status"."id"
                 AND
-                (
-                    "num_assigned_req"."required_amount" <= (
-                        SELECT
-                            COUNT(1)
-                        FROM
-                            "booking_visitresource" "assigned_resource2"
-                            INNER JOIN
-                            "booking_visit" "assigned_visit2" ON (
-                                "assigned_resource2"."visit_id" =
-                                    "assigned_visit2"."id"
-                            )
-                        WHERE (
-                            "assigned_resource2"."resource_requirement_id" =
-                                "num_assigned_req"."id"
-                            AND
-                            "assigned_visit2"."id" =
-                                "booking_eventtime"."visit_id"
-                        )
-                    )
-                )
-        '''
-
-        qs = qs.annotate(
-            num_requirements=RawSQL(num_requirements_sql, tuple()),
-            num_can_be_fullfilled=RawSQL(num_can_be_fullfilled_sql, tuple()),
-            num_assigned=RawSQL(num_assigned_sql, tuple())
-        ).exclude(
-            Q(
-                resource_status=EventTime.RESOURCE_STATUS_ASSIGNED,
-                num_assigned=F('num_requirements')
-            ) |
-            Q(
-                resource_status=EventTime.RESOURCE_STATUS_AVAILABLE,
-                num_requirements__lte=(
-                    F('num_assigned') + F('num_can_be_fullfilled')
-                )
-            ) |
-            Q(
-                resource_status=EventTime.RESOURCE_STATUS_BLOCKED,
-                num_requirements__gt=(
-                    F('num_assigned') + F('num_can_be_fullfilled')
-                )
+                "booking_eventtime"."resource_status" !=
+                    "new_status"."resource_status"
+            RETURNING
+                "booking_eventtime"."id"
+        ''' % (requirement_state_sql, new_status_sql)
+
+        params = ids_params + (
+            EventTime.RESOURCE_STATUS_BLOCKED,
+            EventTime.RESOURCE_STATUS_AVAILABLE,
+            EventTime.RESOURCE_STATUS_ASSIGNED,
+        ) + ids_params
+
+        with connection.cursor() as cursor:
+            cursor.execute(update_sql, params)
+            updated = [row[0] for row in cursor.fetchall()]
+
+        result = EventTime.objects.filter(pk__in=updated)
+        if settings.PUBLIC_SEARCH_INDEX and len(updated) > 0:
+            PublicBookableTime.refresh(
+                result.values_list('product_id', flat=True)
             )
-        )
+
+        return result
+
+    # Creates eventtimes for the product from the human readable intervals
+    # posted by the times-from-rules form. The eventtimes are inserted in
+    # one statement and their resource status is worked out in another, like
+    # saving each of them and calling update_availability() would. Returns
+    # the created eventtimes and those of them that are blocked.
+    @staticmethod
+    def bulk_create_from_intervals(product, interval_strs):
+        times = []
+        for interval_str in interval_strs:
+            interval = EventTime.parse_human_readable_interval(interval_str)
+            if interval is None:
+                continue
+            (start, end) = interval
+            times.append(EventTime(
+                product=product,
+                start=start,
+                end=end,
+                has_specific_time=not (
+                    start.hour == 0 and start.minute == 0 and
+                    end.hour == 0 and end.minute == 0
+                ),
+                notes='',
+            ))
 
         with transaction.atomic():
-            for x in qs:
-                x.update_availability()
+            created = EventTime.objects.bulk_create(times)
+            created_qs = EventTime.objects.filter(
+                pk__in=[x.pk for x in created]
+            )
+            EventTime.update_resource_status_for_qs(
+                created_qs, resource_controlled_only=False
+            )
 
-        return qs
+        # bulk_create sends no post_save signals
+        if settings.PUBLIC_SEARCH_INDEX:
+            PublicBookableTime.refresh([product.pk])
+
+        statuses = dict(created_qs.values_list('pk', 'resource_status'))
+        for eventtime in created:
+            eventtime.resource_status = statuses[eventtime.pk]
+        blocked = [
+            x for x in created
+            if x.resource_status == EventTime.RESOURCE_STATUS_BLOCKED
+        ]
+        return (created, blocked)
 
     @staticmethod
     # Parses the human readable interval that is used on web pages.
@@ -669,7 +765,7 @@ class EventTime(models.Model):
                 else:
                     return formats.date_format(
                         self.naive_start, "SHORT_DATE_FORMAT"
-                    ),
+                    )
         else:
             if self.start:
                 if self.has_specific_time:
@@ -677,7 +773,7 @@ class EventTime(models.Model):
                 else:
                     return formats.date_format(
                         self.naive_start, "SHORT_DATE_FORMAT"
-                    ),
+                    )
             else:
                 return _("<Intet tidspunkt angivet>")
 
@@ -704,26 +800,72 @@ class EventTime(models.Model):
         self.has_notified_end = True
         self.save()
 
+    notify_flags = {
+        'start': 'has_notified_start',
+        'end': 'has_notified_end',
+    }
+
+    # Does what on_start (or on_end, with field='end') does for up to
+    # batch_size eventtimes that started (ended) before `before` and have
+    # not been notified yet. Only the visits that expire are loaded and
+    # saved; the eventtimes are flagged with one UPDATE. The eventtimes are
+    # claimed with SKIP LOCKED, so runs on several nodes take different
+    # batches. Returns the number of eventtimes notified.
+    @staticmethod
+    def notify_pending(field, before, batch_size=None):
+        if batch_size is None:
+            batch_size = settings.NOTIFY_EVENTTIME_BATCH_SIZE
+        flag = EventTime.notify_flags[field]
+
+        with transaction.atomic():
+            pks = list(
+                EventTime.objects.select_for_update(
+                    skip_locked=True
+                ).filter(**{
+                    flag: False,
+                    field + '__lt': before
+                }).order_by(field).values_list('pk', flat=True)[:batch_size]
+            )
+            if len(pks) == 0:
+                return 0
+
+            for visit in Visit.objects.filter(
+                eventtime__pk__in=pks,
+                workflow_status__in=Visit.EXPIRABLE_STATES
+            ).select_related('eventtime'):
+                if field == 'start':
+                    visit.on_starttime()
+                else:
+                    visit.on_endtime()
+
+            EventTime.objects.filter(pk__in=pks).update(**{flag: True})
+
+        return len(pks)
+
 
 class Calendar(AvailabilityUpdaterMixin, models.Model):
 
     def available_list(self, from_dt, to_dt):
-        calendar_event_instances = []
-        for event in self.calendarevent_set.filter(
-            availability=CalendarEvent.AVAILABLE
-        ).order_by("start", "end"):
-            for instance in event.between(from_dt, to_dt):
-                calendar_event_instances.append(instance)
-        calendar_event_instances.sort(key=lambda instance: instance.start)
-        for instance in calendar_event_instances:
-            yield instance
+        return heapq.merge(
+            *[
+                event.between(from_dt, to_dt)
+                for event in self.calendarevent_set.filter(
+                    availability=CalendarEvent.AVAILABLE
+                )
+            ],
+            key=CalendarEventInstance.sort_key
+        )
 
     def generate_unavailable_events(self, from_dt, to_dt):
-        for x in self.calendarevent_set.filter(
-            availability=CalendarEvent.NOT_AVAILABLE
-        ).order_by("start", "end"):
-            for y in x.between(from_dt, to_dt):
-                yield y
+        return heapq.merge(
+            *[
+                event.between(from_dt, to_dt)
+                for event in self.calendarevent_set.filter(
+                    availability=CalendarEvent.NOT_AVAILABLE
+                )
+            ],
+            key=CalendarEventInstance.sort_key
+        )
 
     def generate_resource_occupied_times(self, from_dt, to_dt):
         # Not available on times when we are booked as a resource
@@ -759,7 +901,7 @@ class Calendar(AvailabilityUpdaterMixin, models.Model):
             for x in profile.assigned_to_visits.filter(
                 eventtime__start__lt=to_dt,
                 eventtime__end__gt=from_dt
-            ):
+            ).order_by('eventtime__start', 'eventtime__end'):
                 yield CalendarEventInstance(
                     x.eventtime.start,
                     x.eventtime.end,
@@ -782,7 +924,8 @@ class Calendar(AvailabilityUpdaterMixin, models.Model):
                 )
 
     def unavailable_list(self, from_dt, to_dt):
-        # Collect the generators we want to get items from
+        # Collect the generators we want to get items from. Each of them
+        # yields items sorted by time, so they can be merged lazily.
         generators = [self.generate_unavailable_events(from_dt, to_dt)]
         if hasattr(self, 'resource'):
             generators.append(
@@ -796,58 +939,29 @@ class Calendar(AvailabilityUpdaterMixin, models.Model):
                 self.generate_product_unavailable(from_dt, to_dt)
             )
 
-        # Pick the first remaining item from any of the generators and remove
-        # any generators that are empty
-        pending_items = []
-        new_generators = []
-        for x in generators:
-            try:
-                item = next(x)
-                new_generators.append(x)
-            except StopIteration:
-                continue
-            pending_items.append(item)
-
-        generators = new_generators
-
-        while(len(generators) > 1):
-            # Find the next item in pending items
-            item_idx = None
-            item = None
-            for idx, x in enumerate(pending_items):
-                if item is None or x < item:
-                    item_idx = idx
-                    item = x
+        return heapq.merge(*generators, key=CalendarEventInstance.sort_key)
 
-            # move next item from the matched generator to pending items
-            # If generator is empty, remove it and its pending item slot
-            try:
-                pending_items[item_idx] = next(generators[item_idx])
-            except StopIteration:
-                del generators[item_idx]
-                del pending_items[item_idx]
-
-            yield item
+    # Available and unavailable instances together, in order of time
+    def instances_between(self, from_dt, to_dt):
+        return heapq.merge(
+            self.available_list(from_dt, to_dt),
+            self.unavailable_list(from_dt, to_dt),
+            key=CalendarEventInstance.sort_key
+        )
 
-        # Yield items from the remaining generator
-        if len(generators) > 0:
-            yield pending_items[0]
-            for x in generators[0]:
-                yield x
+    @staticmethod
+    def as_interval_list(instances, exclude_sources=set()):
+        return IntervalList(
+            (x.start, x.end) for x in instances
+            if x.source not in exclude_sources
+        )
 
     def is_available_between(self, from_dt, to_dt, exclude_sources=set([])):
         # Check if availability rules match
-        available_match = False
-
-        for x in self.available_list(from_dt, to_dt):
-            if x.source in exclude_sources:
-                continue
-
-            if x.start <= from_dt and x.end >= to_dt:
-                available_match = True
-                break
-
-        if not available_match:
+        available = Calendar.as_interval_list(
+            self.available_list(from_dt, to_dt), exclude_sources
+        )
+        if not available.covers(from_dt, to_dt):
             return False
 
         # Any blocking source that is not in exclude_sources means the
@@ -860,151 +974,79 @@ class Calendar(AvailabilityUpdaterMixin, models.Model):
 
         return True
 
+    # Intervals where the calendar has available time that is not blocked
+    # by anything unavailable. Available times are not cut off at from_dt
+    # and to_dt.
+    def free_intervals(self, from_dt, to_dt):
+        return Calendar.as_interval_list(
+            self.available_list(from_dt, to_dt)
+        ).subtract(
+            Calendar.as_interval_list(self.unavailable_list(from_dt, to_dt))
+        )
+
     def has_available_time(self, from_dt, to_dt, minutes):
         needed = datetime.timedelta(minutes=minutes)
 
-        unavailables = tuple(self.unavailable_list(from_dt, to_dt))
-
-        for available in self.available_list(from_dt, to_dt):
-            # The first available start is whatever is later of the start
-            # of the available interval and from_dt.
-            avail_start_time = max(available.start, from_dt)
-            avail_end_time = min(available.end, to_dt)
-
-            # For each unavailable marker, check if the interval between
-            # the last available start and the start of the unavailable period
-            # is enough. If it is not, move the last available start to the
-            # end of the unavailable interval, if that is later.
-            for unavailable in unavailables:
-                next_unavailable = min(unavailable.start, avail_end_time)
-                if next_unavailable - avail_start_time >= needed:
-                    return True
-                else:
-                    avail_start_time = max(unavailable.end, avail_start_time)
-
-            # Last possible end is whatever comes first of the available
-            # interval's end and to_dt. Compare this to the last available
-            # start time to see if we have enough time after the last
-            # unavailable marking.
-            if avail_end_time - avail_start_time >= needed:
-                return True
-
-        return False
+        return any(
+            end - start >= needed
+            for (start, end) in self.free_intervals(
+                from_dt, to_dt
+            ).clip(from_dt, to_dt)
+        )
 
     # Produces a set of intervals where (the resource of) the calendar is
     # available. Overlapping or adjecent intervals will be merged together
     # before output
     def get_available_intervals(self, from_dt, to_dt):
-        availables = self.available_list(from_dt, to_dt)
-        unavailables = self.unavailable_list(from_dt, to_dt)
-
-        current_start = None
-        current_end = None
-
-        try:
-            next_unavailable = next(unavailables)
-        except StopIteration:
-            next_unavailable = None
-
-        for x in availables:
-
-            if current_end:
-                # If the current available ends before the current open
-                # interval, just skip it.
-                if current_end >= x.end:
-                    continue
-                # If last interval ends before the start of the new available
-                # time, commit it, and start a new interval starting at start
-                # time for the current available marker:
-                if current_end < x.start:
-                    yield (current_start, current_end)
-                    current_start = x.start
-                    current_end = None
-
-            if current_start is None:
-                current_start = x.start
-
-            # Loop over unavailables until we reach one that starts after
-            # the available time:
-            # A: #----------#
-            # U:              #---#
-            while (
-                current_start and
-                next_unavailable and
-                next_unavailable.start < x.end
-            ):
-                # Only unavailable times that end after the current start
-                if next_unavailable.end <= current_start:
-                    # We skip any unavailable that ends before the current
-                    # start time.
-                    # A:       #----------#
-                    # U: #---#
-                    pass
-                else:
-                    if next_unavailable.start > current_start:
-                        if next_unavailable.end < x.end:
-                            # A: #----------#
-                            # U:   #----#
-                            # Return current start until the start of the
-                            # unavailability
-                            yield (current_start, next_unavailable.start)
-                            # Open a new interval starting after the
-                            # unavailable marking
-                            current_start = next_unavailable.end
-                        else:
-                            # A: #----------#
-                            # U:   #----------#
-                            # Return current start until the start of the
-                            # unavailability
-                            yield (current_start, next_unavailable.start)
-                            current_start = None
-                    else:
-                        if next_unavailable.end < x.end:
-                            #  A:    #----------#
-                            #  U: #----------#
-                            current_start = next_unavailable.end
-                        else:
-                            #  A:    #----#
-                            #  U: #----------#
-                            current_start = None
-
-                # Only go on to next unavailable if we have a start time
-                # ot compare it to
-                if current_start:
-                    try:
-                        next_unavailable = next(unavailables)
-                    except StopIteration:
-                        next_unavailable = None
-
-            if current_start and current_start < x.end:
-                current_end = x.end
-            else:
-                current_end = None
-
-        # Yield any leftoever last interval
-        if current_start and current_end:
-            yield (current_start, current_end)
-
-    def recalculate_available(self, to_dt=None):
+        return iter(self.free_intervals(from_dt, to_dt))
 
+    # The span of time that CalendarCalculatedAvailable is maintained for
+    @staticmethod
+    def calculated_available_range():
         # Process from back when the project started
         from_dt = timezone.make_aware(datetime.datetime(2016, 7, 1))
-        # And default to three years into the future
-        if to_dt is None:
-            to_dt = timezone.now() + datetime.timedelta(days=365*3)
+        # And three years into the future
+        to_dt = timezone.now() + datetime.timedelta(days=365*3)
+        return (from_dt, to_dt)
+
+    # Recalculates the stored available intervals for the calendar. Without
+    # arguments the whole calculated range is rebuilt, otherwise only the
+    # window between from_dt and to_dt is replaced and stored intervals
+    # crossing the window boundaries are joined with the new ones.
+    def recalculate_available(self, from_dt=None, to_dt=None):
+        (range_start, range_end) = Calendar.calculated_available_range()
+        from_dt = range_start if from_dt is None else max(from_dt, range_start)
+        to_dt = range_end if to_dt is None else min(to_dt, range_end)
+
+        if from_dt >= to_dt:
+            return
+
+        intervals = [
+            (max(start, from_dt), min(end, to_dt))
+            for (start, end) in self.get_available_intervals(from_dt, to_dt)
+            if start < to_dt and end > from_dt
+        ]
 
         with transaction.atomic():
-            CalendarCalculatedAvailable.objects.filter(
+            existing = CalendarCalculatedAvailable.objects.select_for_update(
+            ).filter(
                 calendar=self,
-                end__gt=from_dt,
-                start__lt=to_dt
-            ).delete()
+                end__gte=from_dt,
+                start__lte=to_dt
+            )
+            # Keep the parts of stored intervals that lie outside the window
+            for (start, end) in existing.values_list('start', 'end'):
+                if start < from_dt:
+                    intervals.append((start, from_dt))
+                if end > to_dt:
+                    intervals.append((to_dt, end))
+            existing.delete()
             CalendarCalculatedAvailable.objects.bulk_create([
                 CalendarCalculatedAvailable(
                     calendar=self,
-                    start=x[0],
-                    end=x[1]
-                ) for x in self.get_available_intervals(from_dt, to_dt)
+                    start=start,
+                    end=end
+                ) for (start, end) in merge_intervals(intervals)
             ])
 
     @property
@@ -1054,12 +1096,10 @@ class CalendarCalculatedAvailable(models.Model):
 
 @total_ordering
 class CalendarEventInstance(object):
-    start = None
-    end = None
-    available = False
-    source = None
-    calendar = None
-    combined_calendar = None
+    # Calendar views create thousands of these, so keep them small
+    __slots__ = (
+        'start', 'end', 'available', 'source', 'calendar', 'combined_calendar'
+    )
 
     EMS_IN_DAY = 12
     SECONDS_IN_DAY = 24 * 60 * 60
@@ -1079,6 +1119,20 @@ class CalendarEventInstance(object):
         self.available = available
         self.source = source
         self.calendar = calendar
+        self.combined_calendar = None
+
+    def as_dict(self):
+        obj = {
+            'start': timezone.localtime(self.start).isoformat(),
+            'end': timezone.localtime(self.end).isoformat(),
+            'available': self.available,
+            'title': str(self.source) if self.source is not None else None,
+        }
+        if self.calendar is not None and self.combined_calendar is not None:
+            obj['calendar'] = self.combined_calendar.subcalendar_index(
+                self.calendar
+            )
+        return obj
 
     def day_marker(self, date):
         day_start = timezone.make_aware(
@@ -1137,6 +1191,10 @@ class CalendarEventInstance(object):
 
         return obj
 
+    @staticmethod
+    def sort_key(instance):
+        return (instance.start, instance.end)
+
     def __lt__(self, other):
         if isinstance(other, CalendarEventInstance):
             return (
@@ -1213,9 +1271,87 @@ class CalendarEvent(AvailabilityUpdaterMixin, models.Model):
             len(self.recurrences.rdates) > 0
         )
 
+    # Expanded recurrence start times per event pk, as
+    # (fingerprint, {month start: occurrence starts}), least recently used
+    # first. The fingerprint holds what the expansion depends on, so entries
+    # left by another process or an unsaved change are never used.
+    recurrence_cache = OrderedDict()
+    recurrence_cache_lock = threading.Lock()
+    RECURRENCE_CACHE_SIZE = 256
+
+    @staticmethod
+    def month_starts(from_dt, to_dt):
+        month_start = datetime.datetime(from_dt.year, from_dt.month, 1)
+        while month_start <= to_dt:
+            next_month = (
+                month_start + datetime.timedelta(days=32)
+            ).replace(day=1)
+            yield (month_start, next_month)
+            month_start = next_month
+
+    def expand_recurrences(self, naive_start, from_dt, to_dt):
+        return [
+            x for x in self.recurrences.between(
+                from_dt, to_dt, inc=True, dtstart=naive_start
+            )
+            if x < to_dt
+        ]
+
+    # Start times of the recurrences between from_dt and to_dt (inclusive,
+    # naive). Expansion runs through every occurrence from the start of the
+    # event, so it is cached one month at a time.
+    def recurrence_starts(self, from_dt, to_dt):
+        naive_start = timezone.make_naive(self.start)
+        if self.pk is None:
+            return self.recurrences.between(
+                from_dt, to_dt, inc=True, dtstart=naive_start
+            )
+
+        fingerprint = (str(self.recurrences), naive_start)
+        cache = CalendarEvent.recurrence_cache
+        with CalendarEvent.recurrence_cache_lock:
+            cached = cache.get(self.pk)
+            if cached is None or cached[0] != fingerprint:
+                cached = (fingerprint, {})
+                cache[self.pk] = cached
+            cache.move_to_end(self.pk)
+            while len(cache) > CalendarEvent.RECURRENCE_CACHE_SIZE:
+                cache.popitem(last=False)
+        months = cached[1]
+
+        result = []
+        for (month_start, next_month) in CalendarEvent.month_starts(
+            from_dt, to_dt
+        ):
+            if month_start not in months:
+                months[month_start] = self.expand_recurrences(
+                    naive_start, month_start, next_month
+                )
+            result.extend(
+                x for x in months[month_start] if from_dt <= x <= to_dt
+            )
+        return result
+
+    @staticmethod
+    def clear_recurrence_cache(pk=None):
+        with CalendarEvent.recurrence_cache_lock:
+            if pk is None:
+                CalendarEvent.recurrence_cache.clear()
+            else:
+                CalendarEvent.recurrence_cache.pop(pk, None)
+
+    def save(self, *args, **kwargs):
+        CalendarEvent.clear_recurrence_cache(self.pk)
+        return super(CalendarEvent, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        result = super(CalendarEvent, self).delete(*args, **kwargs)
+        CalendarEvent.clear_recurrence_cache(pk)
+        return result
+
     def between(self, from_dt, to_dt):
         duration = self.end - self.start
-        recurrences = self.recurrences
 
         if self.has_recurrences:
             if not timezone.is_naive(from_dt):
@@ -1225,14 +1361,12 @@ class CalendarEvent(AvailabilityUpdaterMixin, models.Model):
 
             naive_start = timezone.make_naive(self.start)
 
-            recurrences.dtstart = naive_start
-
             # Since we only find start time we have to extend the search
             # area with the duration in both directions.
             search_start = from_dt - duration
             search_end = to_dt + duration
 
-            for x in recurrences.between(search_start, search_end, inc=True):
+            for x in self.recurrence_starts(search_start, search_end):
                 starttime = timezone.datetime.combine(
                     x.date(), naive_start.time()
                 )
@@ -1324,6 +1458,26 @@ class CalendarEvent(AvailabilityUpdaterMixin, models.Model):
         else:
             return Calendar.objects.none()
 
+    # Moving or deleting an event only changes availability where its old
+    # instances were, so the stored version must be recalculated as well.
+    affected_calendar_intervals_from_db = True
+
+    @property
+    def affected_calendar_intervals(self):
+        if not self.has_recurrences:
+            return [(self.start, self.end)]
+        # Recalculating each instance separately costs more than a single
+        # window spanning all of them.
+        instances = list(
+            self.between(*Calendar.calculated_available_range())
+        )
+        if len(instances) == 0:
+            return []
+        return [(
+            min(x.start for x in instances),
+            max(x.end for x in instances)
+        )]
+
     @property
     def calendar_event_link(self):
         if hasattr(self.calendar, 'resource'):
@@ -1392,6 +1546,17 @@ class CombinedCalendar(object):
                 unavailable.append(eventinstance)
         return unavailable
 
+    def instances_between(self, start_dt, end_dt):
+        for eventinstance in heapq.merge(
+            *[
+                subcal.instances_between(start_dt, end_dt)
+                for subcal in self.calendars
+            ],
+            key=CalendarEventInstance.sort_key
+        ):
+            eventinstance.combined_calendar = self
+            yield eventinstance
+
     @property
     def calendarevent_set(self):
         events = CalendarEvent.objects.none()
@@ -1601,6 +1766,202 @@ class Resource(AvailabilityUpdaterMixin, models.Model):
             exclude_sources=set([visit])
         )
 
+    @staticmethod
+    def visit_times(visits):
+        return [
+            (visit.eventtime.start, visit.eventtime.end)
+            if (
+                getattr(visit, 'eventtime', None) is not None and
+                visit.eventtime.start is not None and
+                visit.eventtime.end is not None
+            ) else None
+            for visit in visits
+        ]
+
+    # Set of (resource pk, visit pk) for the given visits and the resources
+    # they occupy, whether assigned directly or as teacher, host or room
+    @staticmethod
+    def visit_assignments(resource_ids, visits):
+        visit_ids = [visit.pk for visit in visits]
+        assignments = set(
+            VisitResource.objects.filter(
+                resource_id__in=resource_ids,
+                visit_id__in=visit_ids
+            ).values_list('resource_id', 'visit_id')
+        )
+        for (cls, lookup) in [
+            (TeacherResource, 'user__taught_visits'),
+            (HostResource, 'user__hosted_visits'),
+            (RoomResource, 'room__visit'),
+        ]:
+            assignments.update(
+                cls.objects.filter(**{
+                    'pk__in': resource_ids,
+                    lookup + '__in': visit_ids
+                }).values_list('pk', lookup)
+            )
+        return assignments
+
+    # Answers is_available_between for many resources and intervals at once,
+    # using the precalculated availability of the resource calendars.
+    # intervals is a list of (from_dt, to_dt) pairs, where None is never
+    # available. exclude_visits may hold a visit (or None) for each interval,
+    # which will not count as occupying the resources in that interval.
+    # Returns a dict of resource pk to a list with a boolean per interval.
+    @staticmethod
+    def availability_matrix(resources, intervals, exclude_visits=None):
+        resources = list(resources)
+        intervals = list(intervals)
+        if exclude_visits is None:
+            exclude_visits = [None] * len(intervals)
+        matrix = dict(
+            (resource.pk, [False] * len(intervals))
+            for resource in resources
+        )
+        slots = [
+            (idx, interval) for (idx, interval) in enumerate(intervals)
+            if interval is not None
+        ]
+        calendar_resources = [
+            resource for resource in resources
+            if resource.calendar_id is not None
+        ]
+
+        if len(slots) > 0 and len(calendar_resources) > 0:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    '''
+                    SELECT
+                        "res"."id",
+                        "slot"."idx"
+                    FROM
+                        "booking_resource" "res"
+                        CROSS JOIN
+                        unnest(
+                            %s::integer[],
+                            %s::timestamptz[],
+                            %s::timestamptz[]
+                        ) AS "slot"("idx", "start", "end")
+                    WHERE
+                        "res"."id" = ANY(%s)
+                        AND
+                        EXISTS (
+                            SELECT
+                                1
+                            FROM
+                                "booking_calendarcalculatedavailable" "avail"
+                            WHERE (
+                                "avail"."calendar_id" = "res"."calendar_id"
+                                AND
+                                "avail"."start" <= "slot"."start"
+                                AND
+                                "avail"."end" >= "slot"."end"
+                            )
+                        )
+                    ''',
+                    [
+                        [idx for (idx, interval) in slots],
+                        [interval[0] for (idx, interval) in slots],
+                        [interval[1] for (idx, interval) in slots],
+                        [resource.pk for resource in calendar_resources],
+                    ]
+                )
+                for (resource_id, idx) in cursor.fetchall():
+                    matrix[resource_id][idx] = True
+
+            # The precalculated availability counts the excluded visits as
+            # occupying their resources, so those must be checked one by one
+            excluded = [
+                (idx, visit) for (idx, visit) in enumerate(exclude_visits)
+                if visit is not None and intervals[idx] is not None
+            ]
+            if len(excluded) > 0:
+                assignments = Resource.visit_assignments(
+                    [resource.pk for resource in calendar_resources],
+                    [visit for (idx, visit) in excluded]
+                )
+                for (idx, visit) in excluded:
+                    for resource in calendar_resources:
+                        if (
+                            not matrix[resource.pk][idx] and
+                            (resource.pk, visit.pk) in assignments
+                        ):
+                            matrix[resource.pk][idx] = \
+                                resource.is_available_between(
+                                    intervals[idx][0],
+                                    intervals[idx][1],
+                                    exclude_sources=set([visit])
+                                )
+
+            # Deferred updates leave the precalculated availability stale
+            # until the AvailabilityUpdateJob runs, so calendars with queued
+            # spans overlapping a slot are checked one by one
+            if settings.DEFER_AVAILABILITY_UPDATES:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        '''
+                        SELECT DISTINCT
+                            "res"."id",
+                            "slot"."idx"
+                        FROM
+                            "booking_resource" "res"
+                            CROSS JOIN
+                            unnest(
+                                %s::integer[],
+                                %s::timestamptz[],
+                                %s::timestamptz[]
+                            ) AS "slot"("idx", "start", "end")
+                            INNER JOIN
+                            "booking_pendingavailabilityupdate" "pending"
+                            ON (
+                                "pending"."calendar_id" = "res"."calendar_id"
+                            )
+                        WHERE
+                            "res"."id" = ANY(%s)
+                            AND (
+                                "pending"."start" IS NULL
+                                OR (
+                                    "pending"."start" <= "slot"."end"
+                                    AND
+                                    "pending"."end" >= "slot"."start"
+                                )
+                            )
+                        ''',
+                        [
+                            [idx for (idx, interval) in slots],
+                            [interval[0] for (idx, interval) in slots],
+                            [interval[1] for (idx, interval) in slots],
+                            [resource.pk for resource in calendar_resources],
+                        ]
+                    )
+                    pending = cursor.fetchall()
+                resources_by_pk = dict(
+                    (resource.pk, resource) for resource in calendar_resources
+                )
+                for (resource_id, idx) in pending:
+                    exclude_sources = set()
+                    if exclude_visits[idx] is not None:
+                        exclude_sources.add(exclude_visits[idx])
+                    matrix[resource_id][idx] = \
+                        resources_by_pk[resource_id].is_available_between(
+                            intervals[idx][0], intervals[idx][1],
+                            exclude_sources
+                        )
+
+        # Resources get a calendar when they are created, so this is rare
+        for resource in resources:
+            if resource.calendar_id is not None:
+                continue
+            for (idx, interval) in slots:
+                exclude_sources = set()
+                if exclude_visits[idx] is not None:
+                    exclude_sources.add(exclude_visits[idx])
+                matrix[resource.pk][idx] = resource.is_available_between(
+                    interval[0], interval[1], exclude_sources
+                )
+
+        return matrix
+
     def make_calendar(self):
         if not self.calendar:
             cal = Calendar()
@@ -1901,6 +2262,41 @@ class ResourcePool(AvailabilityUpdaterMixin, models.Model):
 
         return qs
 
+    # Batch version of available_resources_between, see
+    # Resource.availability_matrix. Returns a list of the available
+    # resources for each interval.
+    def available_resources_for(self, intervals, exclude_visits=None):
+        resources = list(self.resources.all())
+        intervals = list(intervals)
+        matrix = Resource.availability_matrix(
+            resources, intervals, exclude_visits
+        )
+        return [
+            [resource for resource in resources if matrix[resource.pk][idx]]
+            for idx in range(len(intervals))
+        ]
+
+    # For each visit, the resources in the pool that are not assigned to
+    # the visit and are available at its time
+    def resources_available_for_visits(self, visits):
+        visits = list(visits)
+        assigned = set(
+            VisitResource.objects.filter(
+                visit__in=visits,
+                resource__in=self.resources.all()
+            ).values_list('visit_id', 'resource_id')
+        )
+        available = self.available_resources_for(
+            Resource.visit_times(visits), visits
+        )
+        return [
+            [
+                resource for resource in available[idx]
+                if (visit.pk, resource.pk) not in assigned
+            ]
+            for (idx, visit) in enumerate(visits)
+        ]
+
     affected_eventtimes_uses_m2m = True
 
     @property
@@ -2053,6 +2449,10 @@ class VisitResource(AvailabilityUpdaterMixin, models.Model):
     def affected_calendars(self):
         return Calendar.objects.filter(resource__visitresource=self)
 
+    @property
+    def affected_calendar_intervals(self):
+        return self.visit.affected_calendar_intervals
+
     @property
     def affected_eventtimes(self):
         if self.resource_requirement:
@@ -2065,26 +2465,597 @@ class VisitResource(AvailabilityUpdaterMixin, models.Model):
         super(VisitResource, self).save(*args, **kwargs)
 
         if new:
-            resourcetype = self.resource.resource_type.id
-            if resourcetype == ResourceType.RESOURCE_TYPE_TEACHER:
-                self.visit.autosend(
-                    EmailTemplateType.notify_teacher__associated,
-                    [
-                        KUEmailRecipient.create(
-                            self.resource.teacherresource.user,
-                            KUEmailRecipient.TYPE_TEACHER
-                        )
-                    ],
-                    True
+            self.notify_assigned()
+
+    # Tells assigned teachers and hosts about the visit
+    def notify_assigned(self):
+        resourcetype = self.resource.resource_type.id
+        if resourcetype == ResourceType.RESOURCE_TYPE_TEACHER:
+            self.visit.autosend(
+                EmailTemplateType.notify_teacher__associated,
+                [
+                    KUEmailRecipient.create(
+                        self.resource.teacherresource.user,
+                        KUEmailRecipient.TYPE_TEACHER
+                    )
+                ],
+                True
+            )
+        if resourcetype == ResourceType.RESOURCE_TYPE_HOST:
+            self.visit.autosend(
+                EmailTemplateType.notify_host__associated,
+                [
+                    KUEmailRecipient.create(
+                        self.resource.hostresource.user,
+                        KUEmailRecipient.TYPE_HOST
+                    )
+                ],
+                True
+            )
+
+    # Assigns (resource, requirement) pairs to the visit with one insert,
+    # and does what save() does for each of them: availability is updated
+    # once for all the affected calendars and eventtimes, and teachers and
+    # hosts are notified.
+    @staticmethod
+    def bulk_assign(visit, assignments):
+        assignments = list(assignments)
+        if len(assignments) == 0:
+            return []
+
+        with transaction.atomic():
+            created = VisitResource.objects.bulk_create([
+                VisitResource(
+                    visit=visit,
+                    resource=resource,
+                    resource_requirement=requirement
                 )
-            if resourcetype == ResourceType.RESOURCE_TYPE_HOST:
-                self.visit.autosend(
-                    EmailTemplateType.notify_host__associated,
-                    [
-                        KUEmailRecipient.create(
-                            self.resource.hostresource.user,
-                            KUEmailRecipient.TYPE_HOST
-                        )
-                    ],
-                    True
+                for (resource, requirement) in assignments
+            ])
+
+            pool_ids = set(
+                requirement.resource_pool_id
+                for (resource, requirement) in assignments
+                if requirement.resource_pool_id is not None
+            )
+            affected = EventTime.objects.filter(
+                product__resourcerequirement__resource_pool__resources__in=(
+                    Resource.objects.filter(resourcepool__in=pool_ids)
+                )
+            ).values_list('pk', flat=True).distinct()
+            intervals = visit.affected_calendar_intervals
+            AvailabilityUpdaterMixin.update_availability_for(
+                [
+                    (calendar, intervals)
+                    for calendar in Calendar.objects.filter(
+                        resource__in=[
+                            resource for (resource, requirement)
+                            in assignments
+                        ]
+                    )
+                ],
+                set(affected)
+            )
+            ResourceUtilisation.refresh(
+                resource.pk for (resource, requirement) in assignments
+            )
+            # bulk_create sends no post_save, which keeps the index current
+            # for single assignments
+            if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+                from user_profile.models import AssignmentOpportunity
+                AssignmentOpportunity.refresh([visit.pk])
+
+            for visitresource in created:
+                visitresource.notify_assigned()
+
+        return created
+
+
+# Hours each resource is assigned to visits per week and per month, counted
+# from VisitResource and the visits' eventtimes. Periods start on Mondays
+# and on the first of the month in local time. Maintained when assignments
+# change and when visits move; rebuild it with the recalculate_utilisation
+# management command.
+class ResourceUtilisation(models.Model):
+
+    class Meta:
+        unique_together = ('resource', 'period', 'period_start')
+
+    PERIOD_WEEK = 1
+    PERIOD_MONTH = 2
+
+    period_choices = (
+        (PERIOD_WEEK, _("Uge")),
+        (PERIOD_MONTH, _("Måned")),
+    )
+
+    resource = models.ForeignKey(
+        Resource,
+        related_name='utilisation',
+        on_delete=models.CASCADE
+    )
+    period = models.IntegerField(
+        choices=period_choices
+    )
+    period_start = models.DateField()
+    minutes = models.IntegerField(
+        default=0
+    )
+    visits = models.IntegerField(
+        default=0
+    )
+
+    @property
+    def hours(self):
+        return self.minutes / 60.0
+
+    # The starts of the week and the month dt is in
+    @staticmethod
+    def period_starts(dt):
+        day = timezone.localtime(dt).date()
+        return (
+            day - datetime.timedelta(days=day.weekday()),
+            day.replace(day=1)
+        )
+
+    # Recounts the utilisation of the given resources, or of all resources
+    # if resource_ids is None, with one DELETE and one INSERT ... SELECT
+    @staticmethod
+    def refresh(resource_ids=None):
+        if resource_ids is not None:
+            resource_ids = [x for x in set(resource_ids) if x is not None]
+            if len(resource_ids) == 0:
+                return
+            resource_cond = '"vr"."resource_id" = ANY(%s)'
+            resource_params = [resource_ids]
+        else:
+            resource_cond = 'TRUE'
+            resource_params = []
+
+        # A resource may be assigned to a visit for several requirements,
+        # but its time is only counted once
+        insert_sql = '''
+            INSERT INTO "booking_resourceutilisation" (
+                "resource_id", "period", "period_start", "minutes", "visits"
+            )
+            SELECT
+                "assigned"."resource_id",
+                "p"."period",
+                "p"."period_start",
+                SUM(
+                    EXTRACT(EPOCH FROM "et"."end" - "et"."start") / 60
+                )::integer,
+                COUNT(1)
+            FROM
+                (
+                    SELECT DISTINCT
+                        "vr"."resource_id",
+                        "vr"."visit_id"
+                    FROM
+                        "booking_visitresource" "vr"
+                    WHERE
+                        %s
+                ) "assigned"
+                INNER JOIN
+                "booking_eventtime" "et" ON (
+                    "et"."visit_id" = "assigned"."visit_id"
+                )
+                CROSS JOIN LATERAL (
+                    VALUES
+                        (%%s, date_trunc(
+                            'week', "et"."start" AT TIME ZONE %%s
+                        )::date),
+                        (%%s, date_trunc(
+                            'month', "et"."start" AT TIME ZONE %%s
+                        )::date)
+                ) AS "p"("period", "period_start")
+            WHERE
+                "et"."start" IS NOT NULL
+                AND
+                "et"."end" IS NOT NULL
+            GROUP BY
+                "assigned"."resource_id",
+                "p"."period",
+                "p"."period_start"
+        ''' % resource_cond
+
+        tz_name = timezone.get_current_timezone_name()
+        params = resource_params + [
+            ResourceUtilisation.PERIOD_WEEK, tz_name,
+            ResourceUtilisation.PERIOD_MONTH, tz_name,
+        ]
+
+        with transaction.atomic():
+            stale = ResourceUtilisation.objects.all()
+            if resource_ids is not None:
+                stale = stale.filter(resource_id__in=resource_ids)
+            stale.delete()
+            with connection.cursor() as cursor:
+                cursor.execute(insert_sql, params)
+
+    # {resource pk: minutes} for the given resources in the week and the
+    # month dt is in
+    @staticmethod
+    def minutes_at(resource_ids, dt):
+        (week, month) = ResourceUtilisation.period_starts(dt)
+        result = dict(
+            (resource_id, {'week': 0, 'month': 0})
+            for resource_id in resource_ids
+        )
+        for (resource_id, period, minutes) in \
+                ResourceUtilisation.objects.filter(
+                    Q(period=ResourceUtilisation.PERIOD_WEEK,
+                      period_start=week) |
+                    Q(period=ResourceUtilisation.PERIOD_MONTH,
+                      period_start=month),
+                    resource_id__in=resource_ids
+                ).values_list('resource_id', 'period', 'minutes'):
+            key = 'week' if period == ResourceUtilisation.PERIOD_WEEK \
+                else 'month'
+            result[resource_id][key] = minutes
+        return result
+
+    # The coming weeks and months from the one dt is in, as
+    # (period, period_start) pairs, and {resource pk: [minutes, ...]} with
+    # the resources' minutes in each of them, fetched in one query
+    @staticmethod
+    def counters(resource_ids, dt=None, weeks=4, months=2):
+        if dt is None:
+            dt = timezone.now()
+        (week, month) = ResourceUtilisation.period_starts(dt)
+        periods = [
+            (ResourceUtilisation.PERIOD_WEEK,
+             week + datetime.timedelta(days=7 * x))
+            for x in range(weeks)
+        ]
+        for x in range(months):
+            periods.append((ResourceUtilisation.PERIOD_MONTH, month))
+            month = (month + datetime.timedelta(days=32)).replace(day=1)
+
+        columns = dict((period, idx) for idx, period in enumerate(periods))
+        result = dict(
+            (resource_id, [0] * len(periods))
+            for resource_id in resource_ids
+        )
+        for (resource_id, period, period_start, minutes) in \
+                ResourceUtilisation.objects.filter(
+                    resource_id__in=resource_ids,
+                    period_start__in=set(x[1] for x in periods)
+                ).values_list(
+                    'resource_id', 'period', 'period_start', 'minutes'
+                ):
+            idx = columns.get((period, period_start))
+            if idx is not None:
+                result[resource_id][idx] = minutes
+        return (periods, result)
+
+
+# Decides which of the free resources autoassign picks for a requirement.
+# Strategies are looked up by name with AutoassignStrategy.get(), which
+# defaults to settings.AUTOASSIGN_STRATEGY.
+class AutoassignStrategy(object):
+    name = None
+
+    # Returns the candidate resources in the order they should be picked
+    def order(self, visit, requirement, candidates):
+        return list(candidates)
+
+    @classmethod
+    def get(cls, name=None):
+        if name is None:
+            name = settings.AUTOASSIGN_STRATEGY
+        for subclass in cls.__subclasses__():
+            if subclass.name == name:
+                return subclass()
+        raise ValueError("Unknown autoassign strategy %s" % name)
+
+
+class RandomAutoassignStrategy(AutoassignStrategy):
+    name = 'random'
+
+    def order(self, visit, requirement, candidates):
+        candidates = list(candidates)
+        random.shuffle(candidates)
+        return candidates
+
+
+# Picks the resources whose latest assignment is the oldest first, so the
+# assignments go around the pool. Resources never assigned come first.
+class RoundRobinAutoassignStrategy(AutoassignStrategy):
+    name = 'round_robin'
+
+    def order(self, visit, requirement, candidates):
+        candidates = list(candidates)
+        latest = dict(
+            VisitResource.objects.filter(
+                resource__in=candidates
+            ).values('resource').annotate(
+                latest=Max('pk')
+            ).values_list('resource', 'latest')
+        )
+        return sorted(
+            candidates,
+            key=lambda resource: (latest.get(resource.pk, 0), resource.pk)
+        )
+
+
+# Picks the resources with the fewest assigned hours in the week of the
+# visit first, then in its month, using ResourceUtilisation
+class LeastLoadedAutoassignStrategy(AutoassignStrategy):
+    name = 'least_loaded'
+
+    def order(self, visit, requirement, candidates):
+        candidates = list(candidates)
+        times = Resource.visit_times([visit])[0]
+        if times is None:
+            return candidates
+        minutes = ResourceUtilisation.minutes_at(
+            [resource.pk for resource in candidates], times[0]
+        )
+        return sorted(
+            candidates,
+            key=lambda resource: (
+                minutes[resource.pk]['week'],
+                minutes[resource.pk]['month'],
+                resource.pk
+            )
+        )
+
+
+# Calendar spans and eventtimes whose availability must be recalculated by
+# the AvailabilityUpdateJob cron job. Only used when
+# settings.DEFER_AVAILABILITY_UPDATES is set. References are kept without
+# database constraints, since the referenced objects may be deleted in the
+# transaction that queues them.
+class PendingAvailabilityUpdate(models.Model):
+    calendar = models.ForeignKey(
+        Calendar,
+        null=True,
+        related_name='+',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
+    )
+    # A calendar update without start and end covers the whole calendar
+    start = models.DateTimeField(
+        null=True
+    )
+    end = models.DateTimeField(
+        null=True
+    )
+    # Each eventtime is only queued once
+    eventtime = models.OneToOneField(
+        EventTime,
+        null=True,
+        related_name='+',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False
+    )
+
+    @staticmethod
+    def enqueue(calendar_updates, eventtime_ids):
+        updates = set()
+        for (calendar, intervals) in calendar_updates:
+            if intervals is None:
+                updates.add((calendar.pk, None, None))
+            else:
+                for (start, end) in intervals:
+                    updates.add((calendar.pk, start, end))
+
+        PendingAvailabilityUpdate.objects.bulk_create(
+            [
+                PendingAvailabilityUpdate(
+                    calendar_id=calendar_id, start=start, end=end
+                )
+                for (calendar_id, start, end) in updates
+            ] + [
+                PendingAvailabilityUpdate(eventtime_id=x)
+                for x in set(eventtime_ids)
+            ],
+            ignore_conflicts=True
+        )
+
+    # Processes and removes all queued updates. Queued rows are locked while
+    # processing, so concurrent runs skip them, and they are kept if
+    # processing fails. Returns the number of processed rows.
+    @staticmethod
+    def process_pending():
+        with transaction.atomic():
+            pending = list(
+                PendingAvailabilityUpdate.objects.select_for_update(
+                    skip_locked=True
+                ).values_list(
+                    'pk', 'calendar_id', 'start', 'end', 'eventtime_id'
+                )
+            )
+            if len(pending) == 0:
+                return 0
+
+            PendingAvailabilityUpdate.objects.filter(
+                pk__in=[x[0] for x in pending]
+            ).delete()
+
+            calendars = Calendar.objects.in_bulk(
+                set(x[1] for x in pending if x[1] is not None)
+            )
+            AvailabilityUpdaterMixin.recalculate_calendars([
+                (
+                    calendars[calendar_id],
+                    None if start is None else [(start, end)]
+                )
+                for (pk, calendar_id, start, end, eventtime_id) in pending
+                if calendar_id in calendars
+            ])
+            EventTime.update_resource_status_for_qs(
+                EventTime.objects.filter(
+                    pk__in=[x[4] for x in pending if x[4] is not None]
+                )
+            )
+
+        return len(pending)
+
+
+# Denormalized index of the times at which products can be found by the
+# public search. Every active product that is bookable without a time has a
+# row without start, and every publicly bookable eventtime of the other
+# active products has a row with its start. Only maintained and used when
+# settings.PUBLIC_SEARCH_INDEX is set; build it with the
+# rebuild_public_search_index management command before enabling it.
+class PublicBookableTime(models.Model):
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['start', 'product'])
+        ]
+
+    product = models.ForeignKey(
+        Product,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    eventtime = models.OneToOneField(
+        EventTime,
+        null=True,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    start = models.DateTimeField(
+        null=True
+    )
+    # Set for products with guest suggested times that must have available
+    # time in their calendar to be found
+    calendar = models.ForeignKey(
+        Calendar,
+        null=True,
+        related_name='+',
+        on_delete=models.SET_NULL
+    )
+
+    OPEN_TIME_MODES = (
+        Product.TIME_MODE_NONE,
+        Product.TIME_MODE_NO_BOOKING,
+        Product.TIME_MODE_GUEST_SUGGESTED,
+    )
+
+    # Replaces the rows of the given products, or of all products if
+    # product_ids is None, with one DELETE and one INSERT ... SELECT.
+    @staticmethod
+    def refresh(product_ids=None):
+        if product_ids is not None:
+            product_ids = [x for x in set(product_ids) if x is not None]
+            if len(product_ids) == 0:
+                return
+            product_cond = '"product"."id" = ANY(%s)'
+            product_params = [product_ids]
+        else:
+            product_cond = 'TRUE'
+            product_params = []
+
+        insert_sql = '''
+            INSERT INTO "booking_publicbookabletime" (
+                "product_id", "eventtime_id", "start", "calendar_id"
+            )
+            SELECT
+                "product"."id",
+                NULL,
+                NULL,
+                CASE
+                    WHEN "product"."time_mode" = %%s
+                        THEN "product"."calendar_id"
+                    ELSE NULL
+                END
+            FROM
+                "booking_product" "product"
+            WHERE
+                %s
+                AND
+                "product"."state" = %%s
+                AND
+                "product"."time_mode" = ANY(%%s)
+            UNION ALL
+            SELECT
+                "product"."id",
+                "et"."id",
+                "et"."start",
+                NULL
+            FROM
+                "booking_eventtime" "et"
+                INNER JOIN
+                "booking_product" "product" ON (
+                    "product"."id" = "et"."product_id"
+                )
+                LEFT OUTER JOIN
+                "booking_visit" "visit" ON (
+                    "visit"."id" = "et"."visit_id"
+                )
+            WHERE
+                %s
+                AND
+                "product"."state" = %%s
+                AND
+                NOT ("product"."time_mode" = ANY(%%s))
+                AND
+                "et"."bookable"
+                AND
+                "et"."start" IS NOT NULL
+                AND
+                (
+                    "visit"."id" IS NULL
+                    OR
+                    "visit"."workflow_status" = ANY(%%s)
+                )
+                AND
+                (
+                    NOT ("product"."time_mode" = ANY(%%s))
+                    OR
+                    "et"."resource_status" = ANY(%%s)
                 )
+        ''' % (product_cond, product_cond)
+
+        open_modes = list(PublicBookableTime.OPEN_TIME_MODES)
+        params = [Product.TIME_MODE_GUEST_SUGGESTED] + product_params + [
+            Product.ACTIVE,
+            open_modes,
+        ] + product_params + [
+            Product.ACTIVE,
+            open_modes,
+            list(Visit.BOOKABLE_STATES),
+            [
+                Product.TIME_MODE_RESOURCE_CONTROLLED,
+                Product.TIME_MODE_RESOURCE_CONTROLLED_AUTOASSIGN
+            ],
+            list(EventTime.NONBLOCKED_RESOURCE_STATES),
+        ]
+
+        with transaction.atomic():
+            stale = PublicBookableTime.objects.all()
+            if product_ids is not None:
+                stale = stale.filter(product_id__in=product_ids)
+            stale.delete()
+            with connection.cursor() as cursor:
+                cursor.execute(insert_sql, params)
+
+    # Ids of the products that can be found by the public search for the
+    # given time range. t_to is the start of the last day in the range.
+    @staticmethod
+    def product_ids_between(t_from, t_to):
+        in_range = Q(start__isnull=False)
+        if t_from is not None:
+            in_range &= Q(start__gt=t_from)
+        if t_to is not None:
+            # End datetime is midnight of the next day
+            in_range &= Q(start__lte=t_to + datetime.timedelta(hours=24))
+
+        open_calendar = Q(
+            Q(calendar__calendarevent__in=CalendarEvent.get_events(
+                CalendarEvent.AVAILABLE, t_from, t_to
+            )) & ~
+            Q(calendar__calendarevent__in=CalendarEvent.get_events(
+                CalendarEvent.NOT_AVAILABLE, t_from, t_to
+            ))
+        )
+
+        return PublicBookableTime.objects.filter(
+            in_range |
+            Q(start__isnull=True, calendar__isnull=True) |
+            Q(Q(start__isnull=True) & open_calendar)
+        ).values('product_id')
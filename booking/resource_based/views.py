@@ -1,16 +1,22 @@
 # encoding: utf-8
 
 import datetime
+import json
 from itertools import chain
 
+from django.contrib import messages
 from django.forms import models as forms_models
 from django.forms.widgets import TextInput, HiddenInput, Select
-from django.http import Http404
+from django.http import Http404, HttpResponseBadRequest
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import redirect
 from django.urls import reverse, reverse_lazy
+from django.utils import formats
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.utils.translation import ugettext as _
-from django.views.generic import RedirectView
+from django.views.generic import RedirectView, View
 from django.views.generic import TemplateView, ListView, DetailView
 from django.views.generic.edit import CreateView, UpdateView
 from django.views.generic.edit import FormView, DeleteView
@@ -28,6 +34,7 @@ from booking.resource_based.models import ItemResource, RoomResource
 from booking.resource_based.models import Resource, ResourceType
 from booking.resource_based.models import ResourcePool
 from booking.resource_based.models import ResourceRequirement
+from booking.resource_based.models import ResourceUtilisation
 from booking.resource_based.models import TeacherResource, HostResource
 from booking.resource_based.models import VehicleResource
 
@@ -202,29 +209,28 @@ class CreateTimesFromRulesView(BreadcrumbMixin, FormView):
     def form_valid(self, form):
         dates = self.request.POST.getlist('selecteddate', [])
 
-        cls = booking_models.EventTime
-        product = self.get_product()
-
-        for dstr in dates:
-            (start, end) = cls.parse_human_readable_interval(dstr)
+        (created, blocked) = \
+            booking_models.EventTime.bulk_create_from_intervals(
+                self.get_product(), dates
+            )
 
-            if (
-                start.hour == 0 and start.minute == 0 and
-                end.hour == 0 and end.minute == 0
-            ):
-                has_specific_time = False
-            else:
-                has_specific_time = True
-
-            d = cls(
-                product=product,
-                start=start,
-                end=end,
-                has_specific_time=has_specific_time,
-                notes='',
+        messages.add_message(
+            self.request,
+            messages.INFO,
+            _('%d tidspunkter blev oprettet.') % len(created)
+        )
+        if blocked:
+            messages.add_message(
+                self.request,
+                messages.WARNING,
+                _('%(count)d af tidspunkterne mangler ledige ressourcer: '
+                  '%(times)s') % {
+                    'count': len(blocked),
+                    'times': ', '.join(
+                        x.interval_display for x in blocked
+                    )
+                }
             )
-            d.save()
-            d.update_availability()
 
         return super(CreateTimesFromRulesView, self).form_valid(form)
 
@@ -680,6 +686,69 @@ class ResourcePoolDetailView(BreadcrumbMixin, EditorRequiredMixin, DetailView):
     template_name = "resourcepool/details.html"
     model = ResourcePool
 
+    # Assigned hours of each member in the coming weeks and months
+    def get_utilisation(self):
+        resources = list(self.object.specific_resources)
+        (periods, minutes) = ResourceUtilisation.counters(
+            [resource.pk for resource in resources]
+        )
+        return {
+            'periods': [
+                {
+                    'period': period,
+                    'start': period_start,
+                    'label': (
+                        _("Uge %d") % period_start.isocalendar()[1]
+                        if period == ResourceUtilisation.PERIOD_WEEK
+                        else formats.date_format(
+                            period_start, "F Y"
+                        )
+                    )
+                }
+                for (period, period_start) in periods
+            ],
+            'resources': [
+                {
+                    'resource': resource,
+                    'hours': [x / 60.0 for x in minutes[resource.pk]]
+                }
+                for resource in resources
+            ]
+        }
+
+    def get_context_data(self, **kwargs):
+        context = {'utilisation': self.get_utilisation()}
+        context.update(kwargs)
+        return super(ResourcePoolDetailView, self).get_context_data(
+            **context
+        )
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('format') == 'json':
+            self.object = self.get_object()
+            utilisation = self.get_utilisation()
+            return JsonResponse({
+                'periods': [
+                    {
+                        'period': x['period'],
+                        'start': x['start'].isoformat(),
+                        'label': x['label'],
+                    }
+                    for x in utilisation['periods']
+                ],
+                'resources': [
+                    {
+                        'id': x['resource'].pk,
+                        'name': x['resource'].get_name(),
+                        'hours': x['hours'],
+                    }
+                    for x in utilisation['resources']
+                ]
+            })
+        return super(ResourcePoolDetailView, self).get(
+            request, *args, **kwargs
+        )
+
     def get_breadcrumb_args(self):
         return [self.object]
 
@@ -877,13 +946,16 @@ class ResourceRequirementConfirmMixin(object):
         required_amount = int(self.request.GET.get('required_amount'))
         old_amount = self.get_old_amount()
         visit_data = []
-        for eventtime in self.product.booked_eventtimes():
+        eventtimes = list(self.product.booked_eventtimes())
+        available = resource_pool.resources_available_for_visits(
+            [eventtime.visit for eventtime in eventtimes]
+        )
+        for (eventtime, available_resources) in zip(eventtimes, available):
             data = {
                 'visit': eventtime.visit,
                 'eventtime': eventtime,
                 'assigned_count': self.get_assigned_count(eventtime.visit),
-                'available': eventtime.visit.
-                resources_available_for_autoassign(resource_pool)
+                'available': available_resources
             }
             data['insufficient'] = len(data['available']) + old_amount < \
                 required_amount
@@ -1409,6 +1481,49 @@ class CalendarView(
         return breadcrumbs
 
 
+class CalendarFeedView(LoginRequiredMixin, CalRelatedMixin, View):
+    # Streams the event instances of a calendar between the dates given in
+    # the start and end parameters as a JSON list, so clients can load a
+    # week at a time instead of a rendered month.
+    max_days = 366
+
+    def get(self, request, *args, **kwargs):
+        calendar = self.get_calendar()
+
+        try:
+            start_date = parse_date(request.GET.get('start', ''))
+            end_date = parse_date(request.GET.get('end', ''))
+        except ValueError:
+            start_date = end_date = None
+        if (
+            start_date is None or end_date is None or
+            end_date <= start_date or
+            (end_date - start_date).days > self.max_days
+        ):
+            return HttpResponseBadRequest(_("Ugyldigt tidsrum"))
+
+        start_dt = timezone.make_aware(
+            datetime.datetime.combine(start_date, datetime.time())
+        )
+        end_dt = timezone.make_aware(
+            datetime.datetime.combine(end_date, datetime.time())
+        )
+
+        return StreamingHttpResponse(
+            self.stream(calendar.instances_between(start_dt, end_dt)),
+            content_type='application/json'
+        )
+
+    @staticmethod
+    def stream(instances):
+        yield '['
+        separator = ''
+        for instance in instances:
+            yield separator + json.dumps(instance.as_dict())
+            separator = ','
+        yield ']'
+
+
 class CalendarCreateView(LoginRequiredMixin, CalRelatedMixin, RedirectView):
     permanent = False
 
@@ -1,16 +1,16 @@
+from django.conf import settings
 from django.db.models.signals import post_save, post_delete, pre_delete
+from django.db.models.signals import pre_save
 from django.dispatch import receiver
 
 from booking.models import Booking, ClassBooking, TeacherBooking
 from booking.models import Guest, VisitResource, ResourceRequirement
+from booking.models import EventTime, PublicBookableTime
+from booking.models import PendingSearchReindex
+from booking.models import ResourceUtilisation
 from booking.models import Product
 from booking.models import Visit
 
-MODELS_WITH_SEARCHVECTOR = set([
-    Product,
-    Visit
-])
-
 BOOKING_MODELS = set([
     Booking,
     ClassBooking,
@@ -18,43 +18,69 @@ BOOKING_MODELS = set([
 ])
 
 
-def run_searchvector_for_object(obj):
-    model_type = type(obj)
-
-    if model_type in MODELS_WITH_SEARCHVECTOR:
-        # Disconnect signal to avoid recursion
-        post_save.disconnect(update_search_vectors, sender=model_type)
-        # Run the indexing
-        obj.update_searchvector()
-        # Re-enable signal
-        post_save.connect(update_search_vectors, sender=model_type)
-
+# Search texts are regenerated with queryset updates, which send no
+# signals, so the saved objects are not saved again
+@receiver(post_save, sender=Product)
+def update_product_search_vector(sender, instance, **kwargs):
+    PendingSearchReindex.mark(product_ids=[instance.pk])
 
-def update_search_vectors(sender, instance, **kwargs):
-    run_searchvector_for_object(instance)
 
-
-for model in MODELS_WITH_SEARCHVECTOR:
-    post_save.connect(update_search_vectors, sender=model)
+@receiver(post_save, sender=Visit)
+def update_visit_search_vector(sender, instance, **kwargs):
+    PendingSearchReindex.mark(visit_ids=[instance.pk])
 
 
+# The search text of a visit includes its bookings and their bookers
 def on_booking_save(sender, instance, **kwargs):
-    vo = getattr(instance, 'visit', None)
-    if vo:
-        run_searchvector_for_object(vo)
+    PendingSearchReindex.mark(visit_ids=[instance.visit_id])
 
 
 for model in BOOKING_MODELS:
     post_save.connect(on_booking_save, sender=model)
 
 
+@receiver(post_save, sender=Guest)
 def on_booker_save(sender, instance, **kwargs):
-    vo = getattr(instance, 'visit', None)
-    if vo:
-        run_searchvector_for_object(vo)
+    PendingSearchReindex.mark(
+        visit_ids=Booking.objects.filter(booker=instance).values_list(
+            'visit_id', flat=True
+        )
+    )
+
 
+# Keep the attendee and booking counters of visits up to date. A booking
+# that moves to another visit changes the counters of both.
+def before_booking_save_counters(sender, instance, **kwargs):
+    if instance.pk is not None:
+        instance.counter_visit_ids = list(
+            Booking.objects.filter(pk=instance.pk).values_list(
+                'visit_id', flat=True
+            )
+        )
 
-post_save.connect(on_booker_save, sender=Guest)
+
+def on_booking_change_counters(sender, instance, **kwargs):
+    Visit.update_counters(
+        getattr(instance, 'counter_visit_ids', []) + [instance.visit_id]
+    )
+    if instance.visit_id is not None and \
+            Booking.visit.is_cached(instance):
+        instance.visit.refresh_from_db(fields=Visit.counter_fields)
+
+
+for model in BOOKING_MODELS:
+    pre_save.connect(before_booking_save_counters, sender=model)
+    post_save.connect(on_booking_change_counters, sender=model)
+    post_delete.connect(on_booking_change_counters, sender=model)
+
+
+@receiver(post_save, sender=Guest)
+def on_booker_save_counters(sender, instance, **kwargs):
+    Visit.update_counters(
+        Booking.objects.filter(booker=instance).values_list(
+            'visit_id', flat=True
+        )
+    )
 
 
 @receiver(pre_delete, sender=ResourceRequirement)
@@ -68,4 +94,54 @@ def on_visitresource_delete(sender, instance, using, **kwargs):
     if instance.visit is not None:
         instance.visit.autoassign_resources()
 
+
+@receiver(post_save, sender=VisitResource)
+@receiver(post_delete, sender=VisitResource)
+def on_visitresource_change_utilisation(sender, instance, **kwargs):
+    ResourceUtilisation.refresh([instance.resource_id])
+
+
+# Keep the public search index up to date with the products, eventtimes and
+# visits it is built from
+@receiver(post_save, sender=Product)
+def on_product_save_public_index(sender, instance, **kwargs):
+    if settings.PUBLIC_SEARCH_INDEX:
+        PublicBookableTime.refresh([instance.pk])
+
+
+@receiver(post_save, sender=EventTime)
+@receiver(post_delete, sender=EventTime)
+def on_eventtime_change_public_index(sender, instance, **kwargs):
+    if settings.PUBLIC_SEARCH_INDEX:
+        PublicBookableTime.refresh([instance.product_id])
+
+
+@receiver(post_save, sender=Visit)
+def on_visit_save_public_index(sender, instance, **kwargs):
+    if settings.PUBLIC_SEARCH_INDEX:
+        PublicBookableTime.refresh(
+            EventTime.objects.filter(visit=instance).values_list(
+                'product_id', flat=True
+            )
+        )
+
+
+# Deleting a visit frees its eventtime, which is only updated after the
+# visit is gone
+@receiver(pre_delete, sender=Visit)
+def before_visit_delete_public_index(sender, instance, **kwargs):
+    if settings.PUBLIC_SEARCH_INDEX:
+        instance.public_index_product_ids = list(
+            EventTime.objects.filter(visit=instance).values_list(
+                'product_id', flat=True
+            )
+        )
+
+
+@receiver(post_delete, sender=Visit)
+def on_visit_delete_public_index(sender, instance, **kwargs):
+    product_ids = getattr(instance, 'public_index_product_ids', None)
+    if product_ids:
+        PublicBookableTime.refresh(product_ids)
+
 # Import resource-based signals
@@ -1,6 +1,11 @@
+import threading
 from datetime import datetime, timedelta
 
+from django.core.exceptions import ValidationError
+from django.db import connection
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.utils import timezone
 from pyquery import PyQuery
 import re
 
@@ -12,6 +17,7 @@ from booking.models import OrganizationalUnit
 from booking.models import Locality
 from booking.models import RoomResponsible
 from booking.models import Product
+from booking.models import EventTime
 from booking.models import Subject
 from booking.models import Booking
 from booking.models import Visit
@@ -305,3 +311,62 @@ class TestBooking(TestMixin, TestCase):
         # post cancel form
         # test updated booking object
         pass
+
+
+class TestConcurrentBooking(TestMixin, TransactionTestCase):
+
+    def test_parallel_bookings(self):
+        product = self.create_product(
+            time_mode=Product.TIME_MODE_SPECIFIC,
+            state=Product.ACTIVE
+        )
+        product.maximum_number_of_visitors = 25
+        product.do_create_waiting_list = True
+        product.waiting_list_length = 30
+        product.save()
+        eventtime = EventTime.objects.create(
+            product=product,
+            start=timezone.now() + timedelta(days=10),
+            end=timezone.now() + timedelta(days=10, hours=1)
+        )
+        guests = [
+            self.create_guest(attendee_count=10, email="%d@example.com" % x)
+            for x in range(8)
+        ]
+
+        # Book the same time from eight connections at once. Two bookings
+        # fit in the seats, three on the waiting list and the rest are
+        # turned down.
+        barrier = threading.Barrier(len(guests))
+        results = []
+
+        def book(guest):
+            try:
+                booking = Booking(booker=guest)
+                barrier.wait()
+                booking.place(EventTime.objects.get(pk=eventtime.pk))
+                results.append(booking.waitinglist_spot)
+            except ValidationError:
+                results.append(None)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=book, args=(guest,)) for guest in guests
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        eventtime.refresh_from_db()
+        visit = Visit.objects.get(pk=eventtime.visit_id)
+        self.assertEquals(1, Visit.objects.count())
+        self.assertEquals([0, 0, 1, 2, 3], sorted(
+            spot for spot in results if spot is not None
+        ))
+        self.assertEquals(3, results.count(None))
+        self.assertEquals(20, visit.attendees_count)
+        self.assertEquals(30, visit.waiting_count)
+        self.assertEquals(5, visit.booking_count)
+        self.assertEquals([], Visit.inconsistent_counters())
@@ -1,6 +1,9 @@
 from datetime import timedelta, datetime
 
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db.models import Q
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 from django.core import mail
@@ -12,6 +15,7 @@ from resource_booking.tests.mixins import TestMixin
 
 from booking.models import (
     MultiProductVisitTemp,
+    EventTime,
     Visit,
     Guest,
     KUEmailMessage,
@@ -108,6 +112,50 @@ class AnonymizeGuestsJobTestCase(TestCase, TestMixin):
 
         self.assertIn(guest, Guest.objects.filter(Guest.filter_anonymized()))
 
+    @override_settings(ANONYMIZE_BATCH_SIZE=2)
+    def test_guests_are_anonymized_in_batches(self):
+        product = self.create_product()
+        old_visit = self.create_visit(
+            product,
+            start=datetime.now() - timedelta(days=(365 * 2) + 1),
+            end=datetime.now() - timedelta(days=365 * 2),
+        )
+        new_visit = self.create_visit(
+            product,
+            start=datetime.now() - timedelta(days=10),
+            end=datetime.now() - timedelta(days=9),
+        )
+        guests = []
+        for x in range(6):
+            guest = self.create_guest()
+            guest.firstname = "Ebbe%d" % x
+            guest.save()
+            self.create_booking(old_visit if x < 5 else new_visit, guest)
+            guests.append(guest)
+        (old_guests, new_guest) = (guests[:5], guests[5])
+        old_visit.refresh_from_db()
+        self.assertIn("Ebbe3", old_visit.extra_search_text)
+
+        # A run that stopped after the first batch is carried on by the
+        # next
+        limit = timezone.now() - timedelta(days=365 * 2)
+        self.assertEquals(
+            [guest.pk for guest in old_guests[:2]],
+            Guest.anonymize_batch(limit)
+        )
+        message = AnonymizeGuestsJob().do()
+        self.assertIn("Anonymized 3 guests", message)
+
+        anonymized = Guest.objects.filter(Guest.filter_anonymized())
+        self.assertEquals(
+            set(guest.pk for guest in old_guests),
+            set(anonymized.values_list('pk', flat=True))
+        )
+        old_visit.refresh_from_db()
+        self.assertNotIn("Ebbe", old_visit.extra_search_text)
+        new_guest.refresh_from_db()
+        self.assertEquals("Ebbe5", new_guest.firstname)
+
 
 class EvaluationReminderJobTestCase(TestCase, TestMixin):
     def test_evaluation_reminders_are_sent(self):
@@ -200,6 +248,84 @@ class NotifyEventTimeJobTestCase(TestCase, TestMixin):
         self.assertTrue(visit.eventtime.has_notified_end)
         self.assertEqual(visit.workflow_status, Visit.WORKFLOW_STATUS_EXECUTED)
 
+    @override_settings(NOTIFY_EVENTTIME_BATCH_SIZE=2)
+    def test_event_times_are_notified_in_batches(self):
+        product = self.create_product()
+        ended = [
+            self.create_visit(
+                product,
+                start=datetime.now() - timedelta(days=2, hours=x),
+                end=datetime.now() - timedelta(days=1, hours=x),
+                workflow_status=status,
+            )
+            for (x, status) in enumerate([
+                Visit.WORKFLOW_STATUS_PLANNED,
+                Visit.WORKFLOW_STATUS_CONFIRMED,
+                Visit.WORKFLOW_STATUS_CANCELLED,
+            ])
+        ]
+        running = self.create_visit(
+            product,
+            start=datetime.utcnow() - timedelta(hours=1),
+            end=datetime.utcnow() + timedelta(hours=1),
+            workflow_status=Visit.WORKFLOW_STATUS_PLANNED,
+        )
+        for x in range(3):
+            EventTime.objects.create(
+                product=product,
+                start=timezone.now() - timedelta(days=3, hours=x),
+                end=timezone.now() - timedelta(days=2, hours=x),
+            )
+
+        self.assertEquals(2, EventTime.notify_pending(
+            'end', timezone.now()
+        ))
+        self.assertEquals(4, EventTime.objects.filter(
+            has_notified_end=False, end__lt=timezone.now()
+        ).count())
+
+        job = NotifyEventTimeJob()
+        CronJobLog.objects.create(
+            start_time=timezone.now() - timedelta(days=1),
+            end_time=timezone.now() - timedelta(days=1),
+            code=job.code,
+            is_success=True,
+        )
+        with CaptureQueriesContext(connection) as queries:
+            job.run()
+        self.assertEquals(0, EventTime.objects.filter(
+            Q(has_notified_start=False, start__lt=timezone.now()) |
+            Q(has_notified_end=False, end__lt=timezone.now())
+        ).count())
+        # The seven started times are claimed and flagged two at a time,
+        # then the four ended ones, each run stopping at a short batch
+        claims = [
+            query for query in queries
+            if 'SKIP LOCKED' in query['sql']
+        ]
+        flags = [
+            query for query in queries
+            if query['sql'].startswith('UPDATE "booking_eventtime"')
+        ]
+        self.assertEquals(4 + 3, len(claims))
+        self.assertEquals(4 + 2, len(flags))
+
+        for visit in ended:
+            visit.refresh_from_db()
+        self.assertEquals(
+            [
+                Visit.WORKFLOW_STATUS_EXECUTED,
+                Visit.WORKFLOW_STATUS_EXECUTED,
+                Visit.WORKFLOW_STATUS_CANCELLED
+            ],
+            [visit.workflow_status for visit in ended]
+        )
+        running.refresh_from_db()
+        self.assertEquals(Visit.WORKFLOW_STATUS_PLANNED,
+                          running.workflow_status)
+        self.assertTrue(running.eventtime.has_notified_start)
+        self.assertFalse(running.eventtime.has_notified_end)
+
 
 class ReminderJobTestCase(TestCase, TestMixin):
     def test_reminder_emails_are_sent(self):
@@ -233,6 +359,42 @@ class ReminderJobTestCase(TestCase, TestMixin):
         self.assertEqual(mail.outbox[0].subject, "Mail til lærer")
         self.assertEqual(mail.outbox[0].body, "\n\n\nMail til lærer\n")
 
+    def test_inherited_reminders_are_due(self):
+        ResourceType.create_defaults()
+        UserRole.create_defaults()
+
+        unit = self.create_organizational_unit()
+        template_type = EmailTemplateType.objects.create(
+            key=EmailTemplateType.NOTIFY_GUEST_REMINDER,
+            name_da="gæst notifikation",
+            send_to_unit_teachers=True
+        )
+        autosends = []
+        for (x, enabled) in enumerate([True, False]):
+            product = self.create_product(unit=unit)
+            self.create_autosend(product, template_type, days=3)
+            product.productautosend_set.update(enabled=enabled)
+            visit = self.create_visit(
+                product,
+                start=datetime.utcnow() + timedelta(days=3 + x),
+                end=datetime.utcnow() + timedelta(days=3 + x, hours=1),
+            )
+            autosends.append(self.create_autosend(
+                visit, template_type, inherit=True
+            ))
+
+        # Only the autosend inheriting an enabled product autosend, on
+        # the day three days before its visit
+        job = ReminderJob()
+        start = autosends[0].visit.eventtime.start
+        day = timezone.localtime(start).date() - timedelta(days=3)
+        due = job.get_due_autosends(day)
+        self.assertEquals([autosends[0]], due)
+        self.assertEquals(3, due[0].effective_days)
+        self.assertEquals([], job.get_due_autosends(
+            day + timedelta(days=1)
+        ))
+
 
 class IdleHostroleJobTestCase(TestCase, TestMixin):
     def test_idle_host_role_notifications_are_sent(self):
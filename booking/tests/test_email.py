@@ -1,8 +1,12 @@
 import json
 import re
 from datetime import timedelta
+from unittest.mock import patch
 
-from django.test import TestCase
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from django.utils.datetime_safe import datetime
 from pyquery import PyQuery as pq
 
@@ -511,3 +515,160 @@ class TestEmail(TestMixin, TestCase):
             ]),
             recipients
         )
+
+    @override_settings(QUEUE_EMAILS=True)
+    def test_queued_email(self):
+        from booking.booking_workflows.views import BecomeHostView
+        BecomeHostView.notify_mail_template_type = \
+            EmailTemplateType.notify_host__associated
+        template = self.create_emailtemplate(
+            key=EmailTemplateType.NOTIFY_HOST__ASSOCIATED,
+            unit=self.unit,
+            subject="Test association",
+            body="This is a test"
+        )
+        host = self.create_default_host(unit=self.unit)
+        HostResource.create(host, self.unit)
+        product = self.create_product(
+            unit=self.unit,
+            potential_hosts=host
+        )
+        product.needed_hosts = 1
+        product.save()
+        visit = self.create_visit(product)
+        self.create_autosend(visit, template.type)
+        self.login("/visit/%d/become_host/" % visit.id, host)
+        mail.outbox = []
+        response = self.client.post(
+            "/visit/%d/become_host/" % visit.id,
+            {
+                "confirm": "confirm"
+            }
+        )
+        self.assertEquals(200, response.status_code)
+
+        # The request only queues the message
+        self.assertEquals(0, len(mail.outbox))
+        message = KUEmailMessage.objects.last()
+        self.assertEquals(
+            KUEmailMessage.DELIVERY_QUEUED, message.delivery_status
+        )
+
+        with patch.object(
+            locmem.EmailBackend, 'send_messages',
+            side_effect=Exception("Connection refused")
+        ):
+            self.assertEquals(1, KUEmailMessage.send_queued())
+        message.refresh_from_db()
+        self.assertEquals(
+            KUEmailMessage.DELIVERY_QUEUED, message.delivery_status
+        )
+        self.assertEquals(1, message.delivery_attempts)
+        self.assertEquals("Connection refused", message.delivery_error)
+        self.assertGreater(message.next_attempt, timezone.now())
+        # Not due for another attempt yet
+        self.assertEquals(0, KUEmailMessage.send_queued())
+
+        message.next_attempt = timezone.now()
+        message.save()
+        self.assertEquals(1, KUEmailMessage.send_queued())
+        message.refresh_from_db()
+        self.assertEquals(
+            KUEmailMessage.DELIVERY_SENT, message.delivery_status
+        )
+        self.assertIsNone(message.next_attempt)
+        self.assertEquals(1, len(mail.outbox))
+        self.assertEquals("Test association", mail.outbox[0].subject.strip())
+        self.assertEquals([message.recipients], mail.outbox[0].to)
+
+    def test_template_expand_cache(self):
+        template = self.create_emailtemplate(
+            key=EmailTemplateType.NOTIFY_GUEST__BOOKING_CREATED,
+            unit=self.unit,
+            subject="Hello {{ name }}",
+            body="Dear {{ name }}, {{ unknown }}"
+        )
+        info = EmailTemplate.get_template_object.cache_info()
+        self.assertEquals(
+            "Hello Tester", template.expand_subject({'name': 'Tester'}).strip()
+        )
+        self.assertEquals(
+            "Hello Other", template.expand_subject({'name': 'Other'}).strip()
+        )
+        after = EmailTemplate.get_template_object.cache_info()
+        self.assertEquals(info.misses + 1, after.misses)
+        self.assertEquals(info.hits + 1, after.hits)
+
+        # Placeholders are kept without affecting other rendering
+        self.assertEquals(
+            "Dear Tester, {{ unknown }}",
+            template.expand_body(
+                {'name': 'Tester'}, keep_placeholders=True
+            ).strip()
+        )
+        self.assertEquals(
+            "Dear Tester,", template.expand_body({'name': 'Tester'}).strip()
+        )
+
+        template.subject = "Goodbye {{ name }}"
+        template.save()
+        self.assertEquals(
+            0, EmailTemplate.get_template_object.cache_info().currsize
+        )
+        self.assertEquals(
+            "Goodbye Tester",
+            template.expand_subject({'name': 'Tester'}).strip()
+        )
+
+    def test_template_inheritance(self):
+        child = OrganizationalUnit.objects.create(
+            name="child", type=self.unittype, parent=self.unit
+        )
+        grandchild = OrganizationalUnit.objects.create(
+            name="grandchild", type=self.unittype, parent=child
+        )
+        template_type = EmailTemplateType.get(
+            EmailTemplateType.NOTIFY_GUEST__BOOKING_CREATED
+        )
+        root_template = self.create_emailtemplate(
+            key=template_type.key, subject="root"
+        )
+        unit_template = self.create_emailtemplate(
+            key=template_type.key, unit=self.unit, subject="unit"
+        )
+        other_template = self.create_emailtemplate(
+            key=EmailTemplateType.NOTIFY_GUEST__BOOKING_CREATED_UNTIMED,
+            unit=grandchild
+        )
+
+        with self.assertNumQueries(1):
+            self.assertEquals(
+                unit_template,
+                EmailTemplate.get_template(template_type, grandchild)
+            )
+        self.assertEquals(
+            [unit_template, root_template],
+            EmailTemplate.get_template(template_type, grandchild, True)
+        )
+        self.assertEquals(
+            root_template, EmailTemplate.get_template(template_type, None)
+        )
+        self.assertEquals(
+            [other_template, unit_template, root_template],
+            EmailTemplate.get_templates(grandchild)
+        )
+        self.assertEquals(
+            [other_template], EmailTemplate.get_templates(grandchild, False)
+        )
+
+        with EmailTemplate.cached_template_maps():
+            EmailTemplate.get_template(template_type, grandchild)
+            with self.assertNumQueries(0):
+                EmailTemplate.get_template(template_type, grandchild)
+            child_template = self.create_emailtemplate(
+                key=template_type.key, unit=child, subject="child"
+            )
+            self.assertEquals(
+                child_template,
+                EmailTemplate.get_template(template_type, grandchild)
+            )
@@ -1,14 +1,18 @@
 # encoding: utf-8
 import copy
+import json
 import math
 import re
 from datetime import timedelta
 from decimal import Decimal
 
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import connection
 from django.http import QueryDict
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.utils.datastructures import MultiValueDict
 from django.utils.datetime_safe import datetime
 from pyquery import PyQuery
@@ -22,19 +26,25 @@ from booking.forms import StudentForADayForm
 from booking.forms import StudyProjectForm
 from booking.forms import TeacherProductForm
 from booking.models import EmailTemplateType
+from booking.models import EventTime
 from booking.models import KUEmailMessage
 from booking.models import KUEmailRecipient
 from booking.models import Locality
 from booking.models import OrganizationalUnit
 from booking.models import OrganizationalUnitType
+from booking.models import PendingSearchReindex
 from booking.models import Product
+from booking.models import ProductGymnasieFag
+from booking.models import PublicBookableTime
 from booking.models import ResourceType
 from booking.models import RoomResponsible
 from booking.models import School
 from booking.models import Subject
 from booking.models import SurveyXactEvaluationGuest
 from booking.models import Visit
+from booking.utils import expand_rrule_dates
 from booking.utils import flatten
+from booking.views import SearchView
 from resource_booking.tests.mixins import TestMixin, ParsedNode
 from user_profile.models import UserRole
 
@@ -561,6 +571,202 @@ class TestProduct(TestMixin, TestCase):
             ]}
         )
 
+    def test_public_search_index(self):
+        now = timezone.now()
+        open_product = self.create_product(
+            unit=self.unit, state=Product.ACTIVE, title='open'
+        )
+        specific = self.create_product(
+            unit=self.unit, state=Product.ACTIVE, title='specific',
+            time_mode=Product.TIME_MODE_SPECIFIC
+        )
+        past = self.create_product(
+            unit=self.unit, state=Product.ACTIVE, title='past',
+            time_mode=Product.TIME_MODE_SPECIFIC
+        )
+        self.create_product(
+            unit=self.unit, state=Product.CREATED, title='inactive'
+        )
+        eventtime = EventTime.objects.create(
+            product=specific,
+            start=now + timedelta(days=2),
+            end=now + timedelta(days=2, hours=1)
+        )
+        EventTime.objects.create(
+            product=past,
+            start=now - timedelta(days=2),
+            end=now - timedelta(days=2, hours=-1)
+        )
+
+        def search(t_to=None):
+            view = SearchView()
+            view.request = RequestFactory().get('/search')
+            view.request.user = AnonymousUser()
+            view.is_public = True
+            view.t_from = now
+            view.t_to = t_to
+            # Public searches only show active products
+            return set(
+                view.get_base_queryset().filter(
+                    state=Product.ACTIVE
+                ).values_list('pk', flat=True)
+            )
+
+        with override_settings(PUBLIC_SEARCH_INDEX=True):
+            PublicBookableTime.refresh()
+            indexed = search()
+            self.assertEquals(
+                indexed, set(
+                    PublicBookableTime.product_ids_between(now, None)
+                    .values_list('product_id', flat=True)
+                )
+            )
+            self.assertEquals({open_product.pk, specific.pk}, indexed)
+            self.assertEquals({open_product.pk}, search(now))
+
+            # The index follows changes to the eventtimes
+            eventtime.bookable = False
+            eventtime.save()
+            self.assertEquals({open_product.pk}, search())
+            eventtime.bookable = True
+            eventtime.save()
+            self.assertEquals({open_product.pk, specific.pk}, search())
+
+        # The joined query finds the same products
+        self.assertEquals(indexed, search())
+
+    def test_search_facet_hits(self):
+        subject = Subject.objects.create(
+            name='Fysik', subject_type=Subject.SUBJECT_TYPE_GYMNASIE
+        )
+        products = [
+            self.create_product(
+                unit=self.unit, state=Product.ACTIVE, title='facet%d' % x,
+                product_type=product_type
+            )
+            for (x, product_type) in enumerate([
+                Product.STUDENT_FOR_A_DAY,
+                Product.STUDENT_FOR_A_DAY,
+                Product.OPEN_HOUSE,
+            ])
+        ]
+        for product in products[1:]:
+            ProductGymnasieFag.objects.create(
+                product=product, subject=subject
+            )
+        ProductGymnasieFag.objects.create(
+            product=products[0], subject=Subject.get_all()
+        )
+
+        view = SearchView()
+        view.request = RequestFactory().get(
+            '/search', {'t': [str(Product.OPEN_HOUSE)]}
+        )
+        view.request.user = AnonymousUser()
+        view.is_public = True
+        view.t_from = timezone.now()
+        with self.assertNumQueries(2):
+            facets = view.get_facet_hits()
+        self.assertIs(facets, view.get_facet_hits())
+
+        # The type facet ignores the type filter, the others use it
+        self.assertEquals(
+            {Product.STUDENT_FOR_A_DAY: 2, Product.OPEN_HOUSE: 1},
+            facets['hits']['type']
+        )
+        self.assertEquals(
+            {Product.SECONDARY: 1}, facets['hits']['institution_level']
+        )
+        self.assertEquals({subject.pk: 1}, facets['hits']['gymnasiefag'])
+        self.assertEquals({}, facets['hits']['grundskolefag'])
+        self.assertEquals(2, facets['totals']['gymnasiefag'][subject.pk])
+        self.assertEquals(1, view.count_unsubjected('gymnasiefag'))
+
+    def test_search_reindex(self):
+        # Saving reindexes right away, without saving again
+        product = self.create_product(
+            unit=self.unit, title='Zebrafisk', state=Product.ACTIVE
+        )
+        self.assertFalse(PendingSearchReindex.objects.exists())
+        self.assertTrue(
+            Product.objects.filter(
+                pk=product.pk, search_vector='zebrafisk'
+            ).exists()
+        )
+        visit = self.create_visit(product)
+        visit.save()
+        visit.refresh_from_db()
+        self.assertIn('Zebrafisk', visit.extra_search_text)
+
+        with override_settings(DEFER_SEARCH_INDEXING=True):
+            product.title = 'Søhest'
+            product.save()
+            product.save()
+            self.assertEquals(1, PendingSearchReindex.objects.count())
+            self.assertFalse(
+                Product.objects.filter(
+                    pk=product.pk, search_vector='søhest'
+                ).exists()
+            )
+            visit.save()
+            self.assertEquals(2, PendingSearchReindex.process_pending())
+            self.assertEquals(0, PendingSearchReindex.process_pending())
+        self.assertTrue(
+            Product.objects.filter(
+                pk=product.pk, search_vector='søhest'
+            ).exists()
+        )
+        visit.refresh_from_db()
+        self.assertIn('Søhest', visit.extra_search_text)
+
+    def test_rebuild_searchvectors(self):
+        subject = Subject.objects.create(
+            name='Kemi', subject_type=Subject.SUBJECT_TYPE_GYMNASIE
+        )
+        products = []
+        for x in range(3):
+            product = self.create_product(
+                unit=self.unit, title='rebuild%d' % x
+            )
+            product.tags.create(name='tag%d' % x)
+            ProductGymnasieFag.objects.create(
+                product=product, subject=subject
+            ).display_value()
+            products.append(product)
+        Product.objects.filter(pk__in=[x.pk for x in products]).update(
+            extra_search_text='', search_vector=None
+        )
+
+        def queries_for(products):
+            qs = Product.objects.filter(pk__in=[x.pk for x in products])
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEquals(
+                    len(products), Product.rebuild_searchvectors(qs)
+                )
+            return len(queries)
+
+        # The number of queries does not depend on the number of products
+        self.assertEquals(queries_for(products[:1]), queries_for(products))
+        self.assertTrue(
+            Product.objects.filter(search_vector='tag2 & kemi').exists()
+        )
+        # The bulk loaded relations give the same text as the product's own
+        for product in Product.objects.filter(
+            pk__in=[x.pk for x in products]
+        ):
+            self.assertEquals(
+                product.generate_extra_search_text(),
+                product.extra_search_text
+            )
+
+        progress = []
+        Product.rebuild_searchvectors(
+            Product.objects.filter(pk__in=[x.pk for x in products]),
+            chunk_size=2,
+            progress=lambda done, seconds: progress.append(done)
+        )
+        self.assertEquals([2, 3], progress)
+
     def _test_search_ui(self, products, query_params):
         q = QueryDict('', True)
         q.update(MultiValueDict({
@@ -650,6 +856,143 @@ class TestProduct(TestMixin, TestCase):
                     else:
                         self.assertEquals(1, len(text))
 
+    def test_rrulestr(self):
+        product = self.create_product(unit=self.unit)
+        tz = timezone.pytz.timezone('Europe/Copenhagen')
+        EventTime.objects.create(
+            product=product,
+            start=tz.localize(datetime(2030, 1, 1, 8, 30)),
+            end=tz.localize(datetime(2030, 1, 1, 9, 30))
+        )
+
+        def expand(**params):
+            data = {
+                'rrulestr': "RDATE:20300101T000000,20300105T000000\n"
+                            "RRULE:FREQ=DAILY;UNTIL=20300103T235959",
+                'start_times': "10:00, 08:30",
+                'product_id': product.pk,
+            }
+            data.update(params)
+            response = self.client.post("/jsapi/rrulestr", data)
+            self.assertEquals(200, response.status_code)
+            return json.loads(b''.join(response.streaming_content))
+
+        misses = expand_rrule_dates.cache_info().misses
+        dates = expand()
+        # Every day until the third, the fifth, and not the existing time
+        self.assertEquals("01-01-2030 10:00", dates[-7])
+        self.assertEquals(
+            [
+                "02-01-2030 08:30", "02-01-2030 10:00",
+                "03-01-2030 08:30", "03-01-2030 10:00",
+                "05-01-2030 08:30", "05-01-2030 10:00",
+            ],
+            dates[-6:]
+        )
+        self.assertNotIn("01-01-2030 08:30", dates)
+        self.assertEquals(sorted(set(dates)), sorted(dates))
+
+        # Pages of the same expansion come from the cache
+        self.assertEquals(dates[-3:-1], expand(offset=len(dates) - 3, limit=2))
+        self.assertEquals(misses + 1, expand_rrule_dates.cache_info().misses)
+
+        self.assertEquals(["05-01-2030 10:00"], expand(
+            rrulestr="RDATE:20300105T000000", start_times="10:00",
+            product_id='None'
+        ))
+        response = self.client.post("/jsapi/rrulestr", {
+            'rrulestr': "RDATE:20300105T000000",
+            'start_times': "25:00",
+            'product_id': 'None',
+        })
+        self.assertEquals(400, response.status_code)
+
+        # Malformed rules and pages are rejected before streaming starts
+        for params in (
+            {'rrulestr': "RRULE:FREQ=BOGUS"},
+            {'offset': -1},
+            {'limit': -1},
+        ):
+            data = {
+                'rrulestr': "RDATE:20300105T000000",
+                'start_times': "10:00",
+                'product_id': 'None',
+            }
+            data.update(params)
+            response = self.client.post("/jsapi/rrulestr", data)
+            self.assertEquals(400, response.status_code)
+
+    def test_eventtime_capacity(self):
+        product = self.create_product(
+            unit=self.unit, time_mode=Product.TIME_MODE_SPECIFIC
+        )
+        product.maximum_number_of_visitors = 20
+        product.do_create_waiting_list = True
+        product.waiting_list_length = 10
+        product.save()
+        start = datetime.utcnow() + timedelta(days=10)
+        empty = self.create_visit(product, start, start + timedelta(hours=1))
+        partial = self.create_visit(
+            product, start + timedelta(days=1), start + timedelta(days=1)
+        )
+        full = self.create_visit(
+            product, start + timedelta(days=2), start + timedelta(days=2)
+        )
+        unvisited = EventTime.objects.create(
+            product=product,
+            start=timezone.now() + timedelta(days=20),
+            end=timezone.now() + timedelta(days=20, hours=1)
+        )
+        for (visit, attendees, spot) in [
+            (partial, 15, 0), (full, 20, 0), (full, 6, 1), (full, 4, 2)
+        ]:
+            booking = self.create_booking(visit, self.create_guest(
+                attendee_count=attendees
+            ))
+            booking.waitinglist_spot = spot
+            booking.save()
+
+        # One query for all the times, with the same numbers as the
+        # properties
+        with CaptureQueriesContext(connection) as queries:
+            payload = EventTime.capacity_payload(product.future_times)
+        self.assertEquals(1, len(queries))
+        eventtimes = [
+            empty.eventtime, partial.eventtime, full.eventtime, unvisited
+        ]
+        for eventtime in eventtimes:
+            eventtime = EventTime.objects.get(pk=eventtime.pk)
+            self.assertEquals({
+                'available': eventtime.available_seats,
+                'waitinglist': eventtime.waiting_list_capacity,
+            }, payload[str(eventtime.pk)])
+        self.assertEquals(
+            {'available': 5, 'waitinglist': 10},
+            payload[str(partial.eventtime.pk)]
+        )
+        self.assertEquals(
+            {'available': 0, 'waitinglist': 0},
+            payload[str(full.eventtime.pk)]
+        )
+
+        # Full times are not bookable
+        self.assertEquals(
+            [empty.eventtime.pk, partial.eventtime.pk, unvisited.pk],
+            list(product.bookable_times.order_by('start').values_list(
+                'pk', flat=True
+            ))
+        )
+
+        # Without a limit on the waiting list it is never full
+        product.waiting_list_length = None
+        product.save()
+        payload = EventTime.capacity_payload(product.future_times)
+        self.assertEquals(
+            {'available': 0, 'waitinglist': math.inf},
+            payload[str(full.eventtime.pk)]
+        )
+        self.assertEquals(4, product.bookable_times.count())
+
     def test_potential_teacher(self):
         UserRole.create_defaults()
         ResourceType.create_defaults()
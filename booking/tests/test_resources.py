@@ -1,14 +1,25 @@
 # encoding: utf-8
 import copy
+import json
+from datetime import timedelta
 
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from pyquery import PyQuery as pq
+from recurrence import Recurrence, Rule, DAILY, WEEKLY
 
 from booking.models import OrganizationalUnitType, OrganizationalUnit, \
-    TeacherResource, HostResource, RoomResource
+    TeacherResource, HostResource, RoomResource, Product, Visit
 from booking.resource_based.forms import EditItemResourceForm, \
     EditVehicleResourceForm
+from booking.resource_based.models import AutoassignStrategy
+from booking.resource_based.models import CalendarEvent, EventTime
+from booking.resource_based.models import PendingAvailabilityUpdate
+from booking.resource_based.models import Resource, VisitResource
 from booking.resource_based.models import ResourceType, ResourcePool
+from booking.resource_based.models import ResourceUtilisation
 from resource_booking.tests.mixins import TestMixin, ParsedNode
 from user_profile.models import UserRole
 
@@ -315,6 +326,655 @@ class TestResources(TestMixin, TestCase):
             ParsedNode(query("dl")).extract_dl(True)
         )
 
+    def test_calendar_recalculate_window(self):
+        room = self.create_default_room(
+            locality=self.create_default_locality(unit=self.unit)
+        )
+        calendar = room.resource.calendar
+        start = timezone.now().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+
+        def hours(h):
+            return start + timedelta(hours=h)
+
+        def stored():
+            return list(
+                calendar.calendarcalculatedavailable_set.order_by(
+                    'start'
+                ).values_list('start', 'end')
+            )
+
+        CalendarEvent.objects.create(
+            calendar=calendar, title='open',
+            availability=CalendarEvent.AVAILABLE,
+            start=start, end=hours(10)
+        )
+        self.assertEquals([(start, hours(10))], stored())
+
+        blocker = CalendarEvent.objects.create(
+            calendar=calendar, title='busy',
+            availability=CalendarEvent.NOT_AVAILABLE,
+            start=hours(2), end=hours(3)
+        )
+        self.assertEquals(
+            [(start, hours(2)), (hours(3), hours(10))], stored()
+        )
+
+        # Moving the blocker must free up its old span
+        blocker.start = hours(4)
+        blocker.end = hours(5)
+        blocker.save()
+        self.assertEquals(
+            [(start, hours(4)), (hours(5), hours(10))], stored()
+        )
+
+        blocker.delete()
+        self.assertEquals([(start, hours(10))], stored())
+
+        calendar.recalculate_available()
+        self.assertEquals([(start, hours(10))], stored())
+
+    def test_calendar_free_intervals(self):
+        room = self.create_default_room(
+            locality=self.create_default_locality(unit=self.unit)
+        )
+        calendar = room.resource.calendar
+        start = timezone.now().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+
+        def hours(h):
+            return start + timedelta(hours=h)
+
+        for (first, last, availability) in [
+            (0, 4, CalendarEvent.AVAILABLE),
+            (4, 8, CalendarEvent.AVAILABLE),
+            (1, 2, CalendarEvent.NOT_AVAILABLE),
+            (6, 7, CalendarEvent.NOT_AVAILABLE),
+            (6, 9, CalendarEvent.NOT_AVAILABLE),
+        ]:
+            CalendarEvent.objects.create(
+                calendar=calendar, title='event',
+                availability=availability,
+                start=hours(first), end=hours(last)
+            )
+
+        self.assertEquals(
+            [(start, hours(1)), (hours(2), hours(6))],
+            list(calendar.get_available_intervals(start, hours(10)))
+        )
+        # Adjacent available events are joined
+        self.assertTrue(calendar.is_available_between(hours(3), hours(5)))
+        self.assertFalse(calendar.is_available_between(hours(1), hours(3)))
+        self.assertTrue(calendar.has_available_time(start, hours(10), 240))
+        self.assertFalse(calendar.has_available_time(start, hours(10), 241))
+        self.assertFalse(calendar.has_available_time(start, hours(5), 240))
+
+    def test_availability_matrix(self):
+        locality = self.create_default_locality(unit=self.unit)
+        rooms = [
+            self.create_default_room(name="room%d" % x, locality=locality)
+            for x in range(2)
+        ]
+        resources = [room.resource for room in rooms]
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_ROOM,
+            self.unit,
+            'matrix_pool',
+            *resources
+        )
+        product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_RESOURCE_CONTROLLED
+        )
+        requirement = self.create_resourcerequirement(product, pool, 1)
+        start = timezone.now().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+
+        def hours(h):
+            return start + timedelta(hours=h)
+
+        CalendarEvent.objects.create(
+            calendar=resources[0].calendar, title='open',
+            availability=CalendarEvent.AVAILABLE,
+            start=start, end=hours(8)
+        )
+        eventtime = EventTime.objects.create(
+            product=product, start=hours(1), end=hours(2)
+        )
+        visit = eventtime.make_visit()
+        VisitResource.objects.create(
+            visit=visit,
+            resource=resources[0],
+            resource_requirement=requirement
+        )
+
+        intervals = [(hours(1), hours(2)), (hours(4), hours(5)),
+                     (hours(7), hours(9)), None]
+        matrix = Resource.availability_matrix(resources, intervals)
+        self.assertEquals(
+            {
+                resources[0].pk: [False, True, False, False],
+                resources[1].pk: [False, False, False, False],
+            },
+            matrix
+        )
+        for (idx, interval) in enumerate(intervals[:3]):
+            self.assertEquals(
+                resources[0].is_available_between(*interval),
+                matrix[resources[0].pk][idx]
+            )
+
+        # The visit does not block its own resources
+        matrix = Resource.availability_matrix(
+            resources, intervals, [visit, None, None, None]
+        )
+        self.assertEquals([True, True, False, False], matrix[resources[0].pk])
+        self.assertTrue(resources[0].available_for_visit(visit))
+
+        self.assertEquals(
+            [[], [resources[0].pk]],
+            [
+                [resource.pk for resource in x]
+                for x in pool.available_resources_for(intervals[:2])
+            ]
+        )
+        self.assertEquals(
+            [[]], pool.resources_available_for_visits([visit])
+        )
+
+    def test_autoassign_resources(self):
+        locality = self.create_default_locality(unit=self.unit)
+        rooms = [
+            self.create_default_room(name="room%d" % x, locality=locality)
+            for x in range(3)
+        ]
+        resources = [room.resource for room in rooms]
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_ROOM,
+            self.unit,
+            'autoassign_pool',
+            *resources
+        )
+        product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_RESOURCE_CONTROLLED_AUTOASSIGN
+        )
+        requirement = self.create_resourcerequirement(product, pool, 2)
+        start = timezone.now().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+        for resource in resources:
+            CalendarEvent.objects.create(
+                calendar=resource.calendar, title='open',
+                availability=CalendarEvent.AVAILABLE,
+                start=start, end=start + timedelta(hours=8)
+            )
+
+        def assigned(visit):
+            return set(
+                VisitResource.objects.filter(visit=visit).values_list(
+                    'resource_id', flat=True
+                )
+            )
+
+        strategy = AutoassignStrategy.get('round_robin')
+        first = EventTime.objects.create(
+            product=product,
+            start=start + timedelta(hours=1),
+            end=start + timedelta(hours=2)
+        ).make_visit()
+        first.autoassign_resources(strategy)
+        self.assertEquals({resources[0].pk, resources[1].pk}, assigned(first))
+        # Nothing more is needed
+        first.autoassign_resources(strategy)
+        self.assertEquals(2, VisitResource.objects.filter(visit=first).count())
+
+        # The room that was never assigned comes first
+        second = EventTime.objects.create(
+            product=product,
+            start=start + timedelta(hours=3),
+            end=start + timedelta(hours=4)
+        ).make_visit()
+        second.autoassign_resources(strategy)
+        self.assertEquals({resources[2].pk, resources[0].pk}, assigned(second))
+
+        # Only one room is left at the time of the first visit
+        third = EventTime.objects.create(
+            product=product,
+            start=start + timedelta(hours=1),
+            end=start + timedelta(hours=2)
+        ).make_visit()
+        third.autoassign_resources(strategy)
+        self.assertEquals({resources[2].pk}, assigned(third))
+        third.refresh_from_db()
+        self.assertEquals(
+            Visit.WORKFLOW_STATUS_AUTOASSIGN_FAILED, third.workflow_status
+        )
+        self.assertEquals(
+            EventTime.RESOURCE_STATUS_BLOCKED,
+            EventTime.objects.get(visit=third).resource_status
+        )
+
+    def test_resource_utilisation(self):
+        locality = self.create_default_locality(unit=self.unit)
+        resources = [
+            self.create_default_room(
+                name="room%d" % x, locality=locality
+            ).resource
+            for x in range(3)
+        ]
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_ROOM,
+            self.unit,
+            'utilisation_pool',
+            *resources
+        )
+        product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_RESOURCE_CONTROLLED_AUTOASSIGN
+        )
+        requirement = self.create_resourcerequirement(product, pool, 1)
+        start = timezone.localtime(timezone.now()).replace(
+            hour=8, minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+        for resource in resources:
+            CalendarEvent.objects.create(
+                calendar=resource.calendar, title='open',
+                availability=CalendarEvent.AVAILABLE,
+                start=start, end=start + timedelta(hours=8)
+            )
+
+        first = EventTime.objects.create(
+            product=product,
+            start=start,
+            end=start + timedelta(hours=2)
+        ).make_visit()
+        VisitResource.objects.create(
+            visit=first, resource=resources[0],
+            resource_requirement=requirement
+        )
+        (periods, minutes) = ResourceUtilisation.counters(
+            [resource.pk for resource in resources], start
+        )
+        self.assertEquals(
+            (ResourceUtilisation.PERIOD_WEEK, start.date() - timedelta(
+                days=start.weekday()
+            )),
+            periods[0]
+        )
+        self.assertEquals(120, minutes[resources[0].pk][0])
+        self.assertEquals(120, minutes[resources[0].pk][4])
+        self.assertEquals(0, minutes[resources[1].pk][0])
+
+        # The room without hours is picked over the busy one
+        second = EventTime.objects.create(
+            product=product,
+            start=start + timedelta(hours=3),
+            end=start + timedelta(hours=4)
+        ).make_visit()
+        second.autoassign_resources(AutoassignStrategy.get('least_loaded'))
+        self.assertEquals(
+            [resources[1].pk],
+            list(VisitResource.objects.filter(visit=second).values_list(
+                'resource_id', flat=True
+            ))
+        )
+        self.assertEquals(60, ResourceUtilisation.minutes_at(
+            [resources[1].pk], start
+        )[resources[1].pk]['week'])
+
+        # Cancelling frees the hours again
+        first.cancel_visit()
+        self.assertEquals(0, ResourceUtilisation.minutes_at(
+            [resources[0].pk], start
+        )[resources[0].pk]['week'])
+
+        url = "/resourcepool/%d" % pool.id
+        self.login(url, self.admin)
+        response = self.client.get(url, {'format': 'json'})
+        self.assertEquals(200, response.status_code)
+        data = json.loads(response.content)
+        self.assertEquals(
+            [resource.pk for resource in resources],
+            sorted(x['id'] for x in data['resources'])
+        )
+        response = self.client.get(url)
+        self.assertEquals(200, response.status_code)
+
+    def test_calendar_feed(self):
+        room = self.create_default_room(
+            locality=self.create_default_locality(unit=self.unit)
+        )
+        resource = room.resource
+        start = timezone.localtime(timezone.now()).replace(
+            hour=8, minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+        for (offset, availability) in [
+            (0, CalendarEvent.AVAILABLE),
+            (2, CalendarEvent.NOT_AVAILABLE),
+            (30, CalendarEvent.AVAILABLE),
+        ]:
+            CalendarEvent.objects.create(
+                calendar=resource.calendar, title='event%d' % offset,
+                availability=availability,
+                start=start + timedelta(hours=offset),
+                end=start + timedelta(hours=offset + 1)
+            )
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_ROOM,
+            self.unit,
+            'feed_pool',
+            resource
+        )
+
+        url = "/resource/%d/calendar/feed" % resource.id
+        self.login(url, self.admin)
+        response = self.client.get(url, {
+            'start': start.date().isoformat(),
+            'end': (start.date() + timedelta(days=1)).isoformat()
+        })
+        self.assertEquals(200, response.status_code)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEquals(
+            [
+                (start.isoformat(), True),
+                ((start + timedelta(hours=2)).isoformat(), False),
+            ],
+            [(x['start'], x['available']) for x in data]
+        )
+        self.assertTrue(data[0]['title'].startswith('event0'))
+
+        response = self.client.get(
+            "/resourcepool/%d/calendar/feed" % pool.id, {
+                'start': start.date().isoformat(),
+                'end': (start.date() + timedelta(days=3)).isoformat()
+            }
+        )
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEquals(3, len(data))
+        self.assertEquals([0, 0, 0], [x['calendar'] for x in data])
+
+        response = self.client.get(url, {'start': 'x', 'end': '2020-01-01'})
+        self.assertEquals(400, response.status_code)
+
+    def test_calendar_event_recurrence_cache(self):
+        room = self.create_default_room(
+            locality=self.create_default_locality(unit=self.unit)
+        )
+        start = timezone.now().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+        event = CalendarEvent.objects.create(
+            calendar=room.resource.calendar, title='daily',
+            availability=CalendarEvent.AVAILABLE,
+            start=start, end=start + timedelta(hours=1),
+            recurrences=Recurrence(rrules=[Rule(DAILY)])
+        )
+
+        local_start = timezone.localtime(start)
+
+        # Recurrences keep the local time of day
+        def starts(event):
+            return [
+                timezone.localtime(x.start).date() for x in event.between(
+                    start, start + timedelta(days=40)
+                )
+                if timezone.localtime(x.start).time() == local_start.time()
+            ]
+
+        self.assertEquals(
+            [local_start.date() + timedelta(days=x) for x in range(40)],
+            starts(event)
+        )
+        self.assertIn(event.pk, CalendarEvent.recurrence_cache)
+        # A fresh instance uses the cached expansion
+        self.assertEquals(
+            starts(event), starts(CalendarEvent.objects.get(pk=event.pk))
+        )
+
+        event.recurrences = Recurrence(rrules=[Rule(WEEKLY)])
+        event.save()
+        self.assertEquals(
+            [local_start.date() + timedelta(days=7 * x) for x in range(6)],
+            starts(CalendarEvent.objects.get(pk=event.pk))
+        )
+
+        event.delete()
+        self.assertNotIn(event.pk, CalendarEvent.recurrence_cache)
+
+    @override_settings(DEFER_AVAILABILITY_UPDATES=True)
+    def test_deferred_availability_updates(self):
+        room = self.create_default_room(
+            locality=self.create_default_locality(unit=self.unit)
+        )
+        calendar = room.resource.calendar
+        start = timezone.now().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+
+        event = CalendarEvent.objects.create(
+            calendar=calendar, title='open',
+            availability=CalendarEvent.AVAILABLE,
+            start=start, end=start + timedelta(hours=2)
+        )
+        event.save()
+        self.assertFalse(calendar.calendarcalculatedavailable_set.exists())
+        # Each save queues the span, they are joined when processed
+        self.assertEquals(
+            2,
+            PendingAvailabilityUpdate.objects.filter(
+                calendar=calendar
+            ).count()
+        )
+
+        self.assertEquals(2, PendingAvailabilityUpdate.process_pending())
+        self.assertFalse(PendingAvailabilityUpdate.objects.exists())
+        self.assertEquals(
+            [(start, start + timedelta(hours=2))],
+            list(
+                calendar.calendarcalculatedavailable_set.values_list(
+                    'start', 'end'
+                )
+            )
+        )
+        self.assertEquals(0, PendingAvailabilityUpdate.process_pending())
+
+    @override_settings(DEFER_AVAILABILITY_UPDATES=True)
+    def test_autoassign_with_deferred_availability_updates(self):
+        room = self.create_default_room(
+            locality=self.create_default_locality(unit=self.unit)
+        )
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_ROOM,
+            self.unit,
+            'deferred_pool',
+            room.resource
+        )
+        product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_RESOURCE_CONTROLLED_AUTOASSIGN
+        )
+        self.create_resourcerequirement(product, pool, 1)
+        start = timezone.now().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+        CalendarEvent.objects.create(
+            calendar=room.resource.calendar, title='open',
+            availability=CalendarEvent.AVAILABLE,
+            start=start, end=start + timedelta(hours=8)
+        )
+        PendingAvailabilityUpdate.process_pending()
+
+        first = EventTime.objects.create(
+            product=product,
+            start=start + timedelta(hours=1),
+            end=start + timedelta(hours=3)
+        ).make_visit()
+        first.autoassign_resources()
+        self.assertEquals(1, VisitResource.objects.filter(visit=first).count())
+        # The assignment is queued, not yet in the precalculated availability
+        self.assertTrue(PendingAvailabilityUpdate.objects.exists())
+
+        # The room must not be booked twice
+        second = EventTime.objects.create(
+            product=product,
+            start=start + timedelta(hours=2),
+            end=start + timedelta(hours=4)
+        ).make_visit()
+        second.autoassign_resources()
+        self.assertFalse(VisitResource.objects.filter(visit=second).exists())
+        second.refresh_from_db()
+        self.assertEquals(
+            Visit.WORKFLOW_STATUS_AUTOASSIGN_FAILED, second.workflow_status
+        )
+
+    def test_update_resource_status_for_qs(self):
+        locality = self.create_default_locality(unit=self.unit)
+        rooms = [
+            self.create_default_room(name="room%d" % x, locality=locality)
+            for x in range(2)
+        ]
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_ROOM,
+            self.unit,
+            'status_pool',
+            *[room.resource for room in rooms]
+        )
+        product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_RESOURCE_CONTROLLED
+        )
+        requirement = self.create_resourcerequirement(product, pool, 2)
+        start = timezone.now().replace(
+            minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+
+        # Only one of the rooms is open at the time
+        CalendarEvent.objects.create(
+            calendar=rooms[0].resource.calendar, title='open',
+            availability=CalendarEvent.AVAILABLE,
+            start=start, end=start + timedelta(hours=8)
+        )
+        eventtime = EventTime.objects.create(
+            product=product,
+            start=start + timedelta(hours=1),
+            end=start + timedelta(hours=2)
+        )
+        updated = EventTime.update_resource_status_for_qs(
+            EventTime.objects.filter(pk=eventtime.pk)
+        )
+        self.assertEquals([eventtime.pk], [x.pk for x in updated])
+        eventtime.refresh_from_db()
+        self.assertEquals(
+            EventTime.RESOURCE_STATUS_BLOCKED, eventtime.resource_status
+        )
+
+        # Opening the second room makes the time available
+        CalendarEvent.objects.create(
+            calendar=rooms[1].resource.calendar, title='open',
+            availability=CalendarEvent.AVAILABLE,
+            start=start, end=start + timedelta(hours=8)
+        )
+        eventtime.refresh_from_db()
+        self.assertEquals(
+            EventTime.RESOURCE_STATUS_AVAILABLE, eventtime.resource_status
+        )
+
+        visit = eventtime.make_visit()
+        for room in rooms:
+            VisitResource.objects.create(
+                visit=visit,
+                resource=room.resource,
+                resource_requirement=requirement
+            )
+        eventtime.refresh_from_db()
+        self.assertEquals(
+            EventTime.RESOURCE_STATUS_ASSIGNED, eventtime.resource_status
+        )
+
+        # The per-row calculation agrees with the stored status
+        eventtime.update_availability()
+        self.assertEquals(
+            EventTime.RESOURCE_STATUS_ASSIGNED, eventtime.resource_status
+        )
+
+    def test_times_from_rules(self):
+        room = self.create_default_room(
+            locality=self.create_default_locality(unit=self.unit)
+        )
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_ROOM,
+            self.unit,
+            'rules_pool',
+            room.resource
+        )
+        product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_RESOURCE_CONTROLLED
+        )
+        self.create_resourcerequirement(product, pool, 1)
+        day = timezone.localtime(timezone.now()).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        ) + timedelta(days=1)
+        # The room is only open on the first day
+        CalendarEvent.objects.create(
+            calendar=room.resource.calendar, title='open',
+            availability=CalendarEvent.AVAILABLE,
+            start=day + timedelta(hours=8), end=day + timedelta(hours=16)
+        )
+
+        def intervals(days):
+            return [
+                (day + timedelta(days=x)).strftime("%d.%m.%Y 09:00 - 10:00")
+                for x in range(days)
+            ]
+
+        with CaptureQueriesContext(connection) as few:
+            (created, blocked) = EventTime.bulk_create_from_intervals(
+                product, intervals(2)
+            )
+        self.assertEquals(
+            [
+                EventTime.RESOURCE_STATUS_AVAILABLE,
+                EventTime.RESOURCE_STATUS_BLOCKED
+            ],
+            [x.resource_status for x in created]
+        )
+        self.assertEquals([created[1]], blocked)
+        self.assertEquals(
+            [x.resource_status for x in created],
+            list(EventTime.objects.filter(
+                pk__in=[x.pk for x in created]
+            ).order_by('start').values_list('resource_status', flat=True))
+        )
+        self.assertTrue(created[0].has_specific_time)
+
+        # The number of queries does not grow with the number of times
+        with CaptureQueriesContext(connection) as many:
+            EventTime.bulk_create_from_intervals(product, intervals(20))
+        self.assertEquals(len(few), len(many))
+
+        url = "/product/%d/manage_times/from_rules" % product.pk
+        self.client.force_login(self.admin)
+        response = self.client.post(url, {
+            'start_time': '09:00',
+            'end_time': '10:00',
+            'extra_days': 0,
+            'selecteddate': [day.strftime("%d.%m.%Y")] + intervals(2)[1:],
+        }, follow=True)
+        self.assertEquals(200, response.status_code)
+        messages = [str(x) for x in response.context['messages']]
+        self.assertEquals(2, len(messages))
+        self.assertIn("2 af tidspunkterne", messages[1])
+        self.assertFalse(
+            EventTime.objects.filter(
+                product=product, start=day
+            ).get().has_specific_time
+        )
+
     def test_product_calendar(self):
         # create product
         # create calendar for product
@@ -1,15 +1,17 @@
 # encoding: utf-8
 
 from datetime import timedelta
+from io import StringIO
 
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase
 from django.utils.datetime_safe import datetime
 from pyquery import PyQuery
 
 from booking.models import Product, KUEmailRecipient, EmailTemplateType, \
     RoomResponsible, ResourceType, OrganizationalUnitType, School, \
-    OrganizationalUnit, Locality
+    OrganizationalUnit, Locality, Booking, Visit
 from resource_booking.tests.mixins import TestMixin, ParsedNode
 from user_profile.models import UserRole
 
@@ -353,6 +355,64 @@ class TestVisit(TestMixin, TestCase):
         # comments
         pass
 
+    def test_visit_counters(self):
+        product = self.create_product(unit=self.unit)
+        product.maximum_number_of_visitors = 20
+        product.save()
+        start = datetime.utcnow() + timedelta(days=1)
+        visit = self.create_visit(
+            product, start=start, end=start + timedelta(hours=1)
+        )
+        other_visit = self.create_visit(
+            product, start=start, end=start + timedelta(hours=1)
+        )
+
+        def counters(visit):
+            visit = Visit.objects.get(pk=visit.pk)
+            return (
+                visit.nr_attendees, visit.nr_waiting,
+                visit.nr_cancelled_attendees, visit.booking_count
+            )
+
+        guest = self.create_guest(attendee_count=5)
+        booking = self.create_booking(visit, guest)
+        # The visit the booking was saved with is updated too
+        self.assertEquals(5, visit.nr_attendees)
+        self.assertEquals(15, visit.available_seats)
+
+        waiting = Booking(
+            visit=visit,
+            booker=self.create_guest(attendee_count=3),
+            waitinglist_spot=1
+        )
+        waiting.save()
+        self.assertEquals((5, 3, 0, 2), counters(visit))
+
+        guest.attendee_count = 7
+        guest.save()
+        self.assertEquals((7, 3, 0, 2), counters(visit))
+
+        booking.cancelled = True
+        booking.save()
+        self.assertEquals((0, 3, 7, 2), counters(visit))
+
+        waiting.visit = other_visit
+        waiting.save()
+        self.assertEquals((0, 0, 7, 1), counters(visit))
+        self.assertEquals((0, 3, 0, 1), counters(other_visit))
+
+        waiting.delete()
+        self.assertEquals((0, 0, 0, 0), counters(other_visit))
+
+        self.assertEquals([], Visit.inconsistent_counters())
+        Visit.objects.filter(pk=visit.pk).update(attendees_count=99)
+        self.assertEquals(
+            [(visit.pk, (99, 0, 7, 1), (0, 0, 7, 1))],
+            Visit.inconsistent_counters()
+        )
+        call_command('check_visit_counters', '--fix', stdout=StringIO())
+        self.assertEquals([], Visit.inconsistent_counters())
+
     def test_profile_page(self):
         # create several products with visits, assigned to different users
         # test that the visits show up on the profile page
@@ -36,6 +36,7 @@ from booking.views import CalendarDeleteView
 from booking.views import CalendarEventCreateView
 from booking.views import CalendarEventDeleteView
 from booking.views import CalendarEventUpdateView
+from booking.views import CalendarFeedView
 from booking.views import CalendarView
 from booking.views import CancelledVisitsView
 from booking.views import ChangeVisitAutosendView
@@ -346,6 +347,9 @@ urlpatterns = [
     url(r'^resource/(?P<pk>[0-9]+)/calendar/?$',
         CalendarView.as_view(),
         name='calendar'),
+    url(r'^resource/(?P<pk>[0-9]+)/calendar/feed/?$',
+        CalendarFeedView.as_view(),
+        name='calendar-feed'),
     url(r'^resource/(?P<pk>[0-9]+)/create_calendar/?$',
         CalendarCreateView.as_view(),
         name='calendar-create'),
@@ -373,6 +377,10 @@ urlpatterns = [
         CalendarView.as_view(),
         product_calendar_kwargs,
         name='product-calendar'),
+    url(r'^product/(?P<pk>[0-9]+)/calendar/feed/?$',
+        CalendarFeedView.as_view(),
+        product_calendar_kwargs,
+        name='product-calendar-feed'),
     url(r'^product/(?P<pk>[0-9]+)/calendar-create/?$',
         CalendarCreateView.as_view(),
         product_calendar_kwargs,
@@ -426,6 +434,10 @@ urlpatterns = [
         CalendarView.as_view(),
         resourcepool_calendar_kwargs,
         name='resourcepool-calendar'),
+    url(r'^resourcepool/(?P<pk>[0-9]+)/calendar/feed/?$',
+        CalendarFeedView.as_view(),
+        resourcepool_calendar_kwargs,
+        name='resourcepool-calendar-feed'),
     url(r'^resourcepool/(?P<pool>[0-9]+)/'
         r'calendar/edit-event/(?P<pk>[0-9]+)/?$',
         CalendarEventUpdateView.as_view(),
@@ -2,10 +2,14 @@
 import csv
 import os
 import re
-from itertools import chain
+from bisect import bisect_right
+from datetime import datetime, time
+from functools import lru_cache
+from itertools import chain, islice
 
 import requests
 from bs4 import BeautifulSoup
+from dateutil.rrule import rrulestr
 from django.conf import settings
 from django.contrib.admin.models import LogEntry, DELETION, ADDITION, CHANGE
 from django.contrib.contenttypes.models import ContentType
@@ -282,6 +286,150 @@ def union(*lists):
     return list(set(chain(*lists)))
 
 
+def chunked_pks(queryset, chunk_size):
+    """
+    Stream the primary keys of a queryset with a server side cursor and
+    yield them in lists of at most chunk_size
+    """
+    chunk = []
+    for pk in queryset.order_by('pk').values_list('pk', flat=True).iterator(
+        chunk_size=chunk_size
+    ):
+        chunk.append(pk)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@lru_cache(maxsize=128)
+def expand_rrule_dates(rrulestring, horizon, max_dates=5000):
+    """
+    Expand the RRULE and RDATE lines of rrulestring to a sorted tuple of at
+    most max_dates distinct dates. RRULEs without an UNTIL or COUNT clause
+    stop at horizon, a naive datetime. The same rule is expanded every time
+    a recurrence form changes, so the results are cached.
+    """
+    dates = set()
+    for line in rrulestring.split("\n"):
+        if 'RRULE' in line:
+            if 'UNTIL=' not in line and 'COUNT=' not in line:
+                line += ';UNTIL=%s' % horizon.strftime('%Y%m%dT%H%M%S')
+        elif 'RDATE' not in line:
+            continue
+        dates.update(
+            occurrence.date()
+            for occurrence in islice(rrulestr(line, ignoretz=True), max_dates)
+        )
+    return tuple(sorted(dates)[:max_dates])
+
+
+def parse_start_times(start_times):
+    """
+    Parse a comma separated list of HH:MM times to sorted (hour, minute)
+    tuples. Raises ValueError for anything else.
+    """
+    times = set()
+    for start_time in start_times.split(','):
+        (hour, minute) = start_time.strip().split(':')
+        if not (0 <= int(hour) < 24 and 0 <= int(minute) < 60):
+            raise ValueError(start_time)
+        times.add((int(hour), int(minute)))
+    return sorted(times)
+
+
+def recurrence_datetimes(rrulestring, times, horizon, tz):
+    """
+    Yield the dates of rrulestring at each of the (hour, minute) times as
+    datetimes aware in tz, in order. The dates are expanded once and
+    cached; the combinations with the times are only made as they are
+    consumed.
+    """
+    for date in expand_rrule_dates(rrulestring, horizon):
+        for (hour, minute) in times:
+            yield tz.localize(datetime.combine(date, time(hour, minute)))
+
+
+def merge_intervals(intervals):
+    """
+    Given (start, end) tuples, merge overlapping or adjacent ones and
+    return them sorted by start
+    """
+    merged = []
+    for (start, end) in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class IntervalList(object):
+    """
+    Sorted list of non-overlapping (start, end) intervals, built by merging
+    overlapping or adjacent input intervals. Lookups use binary search.
+    """
+
+    def __init__(self, intervals=()):
+        merged = merge_intervals(x for x in intervals if x[0] < x[1])
+        self.starts = [x[0] for x in merged]
+        self.ends = [x[1] for x in merged]
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _first_ending_after(self, dt):
+        return bisect_right(self.ends, dt)
+
+    def overlaps(self, start, end):
+        """
+        Whether any interval overlaps the span between start and end
+        """
+        idx = self._first_ending_after(start)
+        return idx < len(self.starts) and self.starts[idx] < end
+
+    def covers(self, start, end):
+        """
+        Whether a single interval contains the span between start and end
+        """
+        idx = bisect_right(self.starts, start) - 1
+        return idx >= 0 and self.ends[idx] >= end
+
+    def clip(self, start, end):
+        """
+        The parts of the intervals that lie between start and end
+        """
+        result = []
+        idx = self._first_ending_after(start)
+        while idx < len(self.starts) and self.starts[idx] < end:
+            result.append(
+                (max(self.starts[idx], start), min(self.ends[idx], end))
+            )
+            idx += 1
+        return IntervalList(result)
+
+    def subtract(self, other):
+        """
+        The parts of the intervals that are not covered by other
+        """
+        result = []
+        for (start, end) in self:
+            idx = other._first_ending_after(start)
+            while idx < len(other) and other.starts[idx] < end:
+                if other.starts[idx] > start:
+                    result.append((start, other.starts[idx]))
+                start = max(start, other.ends[idx])
+                idx += 1
+            if start < end:
+                result.append((start, end))
+        return IntervalList(result)
+
+
 def binary_or(*items):
     """
     OR several integers together (handy when they vary in number)
@@ -2,26 +2,38 @@
 
 import json
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from itertools import islice
 from urllib.parse import urlencode
 
-from dateutil.rrule import rrulestr
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.exceptions import EmptyResultSet
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db import transaction
+from django.db.models import BooleanField
+from django.db.models import Case
 from django.db.models import Count
+from django.db.models import Exists
 from django.db.models import F
+from django.db.models import OuterRef
 from django.db.models import Q
 from django.db.models import Sum
+from django.db.models import Value
+from django.db.models import When
 from django.db.models.expressions import RawSQL
 from django.db.models.functions import Coalesce
 from django.forms import HiddenInput
 from django.http import Http404, HttpResponseBadRequest
 from django.http import HttpResponse
 from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
@@ -110,6 +122,7 @@ from booking.models import PostCode
 from booking.models import Product
 from booking.models import ProductGrundskoleFag
 from booking.models import ProductGymnasieFag
+from booking.models import PublicBookableTime
 from booking.models import Room
 from booking.models import RoomResponsible
 from booking.models import School
@@ -119,8 +132,11 @@ from booking.models import SurveyXactEvaluation, SurveyXactEvaluationGuest
 from booking.models import Visit
 from booking.utils import DummyRecipient
 from booking.utils import TemplateSplit
+from booking.utils import expand_rrule_dates
 from booking.utils import full_email
 from booking.utils import merge_dicts
+from booking.utils import parse_start_times
+from booking.utils import recurrence_datetimes
 from user_profile.constants import FACULTY_EDITOR, ADMINISTRATOR
 from user_profile.models import EDIT_ROLES
 
@@ -439,6 +455,7 @@ class SearchView(SearchEngineMixin, BreadcrumbMixin, ListView):
     to_datetime = None
     admin_form = None
     facet_queryset = None
+    facet_hits = None
     needs_num_bookings = False
     sort_grundskole_fag = False
     sort_gymnasie_fag = False
@@ -449,6 +466,14 @@ class SearchView(SearchEngineMixin, BreadcrumbMixin, ListView):
     # Search engine exclusion
     no_index = True
 
+    facet_fields = (
+        'institution_level', 'type', 'gymnasiefag', 'grundskolefag'
+    )
+    subject_facet_tables = {
+        'gymnasiefag': 'booking_productgymnasiefag',
+        'grundskolefag': 'booking_productgrundskolefag',
+    }
+
     boolean_choice = (
         (1, _('Ja')),
         (0, _('Nej')),
@@ -554,7 +579,15 @@ class SearchView(SearchEngineMixin, BreadcrumbMixin, ListView):
                     Q(eventtime__start__lte=next_midnight)
                 )
 
-            if self.is_public:
+            if self.is_public and settings.PUBLIC_SEARCH_INDEX:
+                # The index only holds products with publicly bookable
+                # times, so no joins and no distinct are needed
+                qs = qs.filter(
+                    pk__in=PublicBookableTime.product_ids_between(
+                        self.t_from, self.t_to
+                    )
+                )
+            elif self.is_public:
 
                 # Accept the product if it has bookable eventtimes in our range
                 eventtimes = EventTime.objects.filter(bookable=True)
@@ -612,15 +645,13 @@ class SearchView(SearchEngineMixin, BreadcrumbMixin, ListView):
                 qs = qs.filter(
                     (in_bookable_state & not_resource_blocked & date_cond) |
                     always_bookable
-                )
+                ).distinct()
             else:
-                qs = qs.filter(date_cond)
+                qs = qs.filter(date_cond).distinct()
 
             self.from_datetime = self.t_from or ""
             self.to_datetime = self.t_to or ""
 
-            qs = qs.distinct()
-
             self.base_queryset = qs
 
         return self.base_queryset
@@ -838,33 +869,119 @@ class SearchView(SearchEngineMixin, BreadcrumbMixin, ListView):
 
         return qs
 
-    def make_facet(self, facet_field, choice_tuples, selected,
-                   selected_value='checked="checked"',
-                   add_to_all=None, unsubjected=None):
-
-        hits = {}
-        # Remove filter for the field we want to facetize
-        filters = self.get_filters()
-        new_filter_args = [
-            v for k, v in filters.items()
-            if k.startswith('__') and not k.startswith('__' + facet_field)
-        ]
-        new_filter_kwargs = {
-            k: v for k, v in filters.items()
-            if not k.startswith(facet_field) and not k.startswith('__')
+    # Calculates the hits of all the facets on the page in one query. The
+    # hits of a facet only use the filters that are not on the facet's own
+    # field, so every filter is evaluated once per candidate product as a
+    # boolean column and each facet counts the rows matching the other
+    # filters. Returns a dict with the hits and the unfiltered totals for
+    # each facet field, both as dicts of value => number of products.
+    def get_facet_hits(self):
+        if self.facet_hits is not None:
+            return self.facet_hits
+
+        self.facet_hits = {
+            'hits': {field: {} for field in self.facet_fields},
+            'totals': {field: {} for field in self.facet_fields},
         }
 
-        facet_qs = Product.objects.filter(
-            pk__in=self.get_facet_queryset().filter(
-                *new_filter_args,
-                **new_filter_kwargs
-            )
+        qs = self.get_facet_queryset()
+        match_columns = []
+        annotations = {}
+        for (key, value) in self.get_filters().items():
+            if key.startswith('__'):
+                (field, cond) = (key[2:], value)
+            else:
+                (field, cond) = (key, Q(**{key: value}))
+            name = 'facet_match_%d' % len(match_columns)
+            if field.split('__')[0] in qs.query.annotations:
+                annotations[name] = Case(
+                    When(cond, then=Value(True)),
+                    default=Value(False),
+                    output_field=BooleanField()
+                )
+            else:
+                # Filters on relations must not multiply the rows
+                annotations[name] = Exists(
+                    Product.objects.filter(cond, pk=OuterRef('pk'))
+                )
+            match_columns.append((field, name))
+
+        candidates = qs.annotate(**annotations).order_by().values(
+            'pk', 'institution_level', 'type', *annotations.keys()
+        )
+        try:
+            (candidate_sql, candidate_params) = \
+                candidates.query.sql_with_params()
+        except EmptyResultSet:
+            return self.facet_hits
+
+        def other_filters_match(facet_field):
+            return " AND ".join([
+                '"candidate"."%s"' % name
+                for (field, name) in match_columns
+                if not field.startswith(facet_field)
+            ]) or "TRUE"
+
+        parts = []
+        params = []
+        for field in ('institution_level', 'type'):
+            parts.append('''
+                SELECT
+                    %%s AS "facet",
+                    "candidate"."%s" AS "value",
+                    COUNT(1) FILTER (WHERE %s) AS "hits",
+                    COUNT(1) AS "total"
+                FROM
+                    "candidate"
+                GROUP BY
+                    "candidate"."%s"
+            ''' % (field, other_filters_match(field), field))
+            params.append(field)
+        for (field, table) in self.subject_facet_tables.items():
+            parts.append('''
+                SELECT
+                    %%s AS "facet",
+                    "product_subject"."subject_id" AS "value",
+                    COUNT(DISTINCT "candidate"."id") FILTER (
+                        WHERE %s
+                    ) AS "hits",
+                    COUNT(DISTINCT "candidate"."id") AS "total"
+                FROM
+                    "candidate"
+                    INNER JOIN
+                    "%s" "product_subject" ON (
+                        "product_subject"."product_id" = "candidate"."id"
+                    )
+                GROUP BY
+                    "product_subject"."subject_id"
+            ''' % (other_filters_match(field), table))
+            params.append(field)
+
+        sql = 'WITH "candidate" AS (%s) %s' % (
+            candidate_sql, " UNION ALL ".join(parts)
         )
 
-        qs = facet_qs.values(facet_field).annotate(hits=Count("pk"))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, tuple(candidate_params) + tuple(params))
+            for (facet, value, hits, total) in cursor.fetchall():
+                if hits > 0:
+                    self.facet_hits['hits'][facet][value] = hits
+                self.facet_hits['totals'][facet][value] = total
 
-        for item in qs:
-            hits[item[facet_field]] = item["hits"]
+        return self.facet_hits
+
+    # Number of products in the facet queryset that are marked as being
+    # for all subjects
+    def count_unsubjected(self, facet_field):
+        return self.get_facet_hits()['totals'][facet_field].get(
+            Subject.get_all().pk, 0
+        )
+
+    def make_facet(self, facet_field, choice_tuples, selected,
+                   selected_value='checked="checked"',
+                   add_to_all=None, unsubjected=None):
+
+        hits = dict(self.get_facet_hits()['hits'][facet_field])
 
         # This adds all hits on a certain keys to the hits of all other keys.
         if add_to_all is not None:
@@ -983,9 +1100,7 @@ class SearchView(SearchEngineMixin, BreadcrumbMixin, ListView):
             "gymnasiefag",
             gym_subject_choices,
             gym_selected,
-            unsubjected=self.get_facet_queryset().filter(
-                gymnasiefag=Subject.get_all()
-            ).count()
+            unsubjected=self.count_unsubjected("gymnasiefag")
         )
 
         gs_selected = self.request.GET.getlist("g")
@@ -994,9 +1109,7 @@ class SearchView(SearchEngineMixin, BreadcrumbMixin, ListView):
             "grundskolefag",
             gs_subject_choices,
             gs_selected,
-            unsubjected=self.get_facet_queryset().filter(
-                grundskolefag=Subject.get_all()
-            ).count()
+            unsubjected=self.count_unsubjected("grundskolefag")
         )
 
         context['from_datetime'] = self.from_datetime
@@ -2324,76 +2437,67 @@ class RrulestrView(View):
         exposed as a web service, expanding RRULEs to a list of datetimes.
         In addition, we add RRDATEs and return the sorted list in danish
         date format. If the string doesn't contain an UNTIL clause, we set it
-        to 90 days in the future from datetime.now().
+        to the end of the day 90 days in the future.
         If multiple start_times are present, the Cartesian product of
-        dates x start_times is returned.
+        dates x start_times is returned, leaving out the times the product
+        already has. The optional offset and limit parameters return a page
+        of the list, and the list is streamed rather than built in memory.
         """
         rrulestring = request.POST['rrulestr']
-        now = timezone.now()
         tz = timezone.pytz.timezone('Europe/Copenhagen')
-        dates = []
-        lines = rrulestring.split("\n")
-        times_list = request.POST['start_times'].split(',')
-        product_id = None
-        if request.POST['product_id'] != 'None':
-            product_id = int(request.POST['product_id'])
-        existing_dates_strings = set()
-
-        if product_id is not None:
-            product = Product.objects.get(pk=product_id)
-
-            for visit in product.visit_set.all():
-                for time in visit.eventtime_set.all():
-                    existing_dates_strings.add(
-                        time.start.strftime('%d-%m-%Y %H:%M')
-                    )
-
-        for line in lines:
-            # When handling RRULEs, we don't want to send all dates until
-            # 9999-12-31 to the client, which apparently is rrulestr() default
-            # behaviour. Hence, we set a default UNTIL clause to 90 days in
-            # the future from datetime.now()
-            # Todo: This should probably be handled more elegantly
-            if 'RRULE' in line and 'UNTIL=' not in line:
-                line += ';UNTIL=%s' % (now + timedelta(90))\
-                    .strftime('%Y%m%dT%H%M%S')
-                dates += [
-                    timezone.make_aware(x, tz) for x in rrulestr(
-                        line, ignoretz=True
-                    )
-                ]
-            # RRDATEs are appended to the dates list
-            elif 'RDATE' in line:
-                dates += [
-                    timezone.make_aware(x, tz)for x in rrulestr(
-                        line,
-                        ignoretz=True
-                    )
-                ]
-        # sort the list while still in ISO 8601 format,
-        dates = sorted(set(dates))
-        # Cartesian product: AxB
-        # ['2016-01-01','2016-01-02'] x ['10:00','12:00'] ->
-        # ['2016-01-01 10:00','2016-01-01 12:00',
-        # '2016-01-02 10:00','2016-01-02 12:00']
-        cartesian_dates = \
-            [val.replace(  # parse time format: '00:00'
-                hour=int(_[0:2]),
-                minute=int(_[4:6]),
-                second=0,
-                microsecond=0
-            ) for val in dates for _ in times_list]
 
-        # convert to danish date format strings and off we go...
-        date_strings = [x.strftime('%d-%m-%Y %H:%M') for x in cartesian_dates]
+        # When handling RRULEs, we don't want to send all dates until
+        # 9999-12-31 to the client, which apparently is rrulestr() default
+        # behaviour. The horizon only changes once a day, so the expanded
+        # rules can be cached.
+        horizon = datetime.combine(
+            timezone.localtime(timezone.now()).date() + timedelta(90),
+            time(23, 59, 59)
+        )
 
-        dates_without_existing_dates = \
-            [x for x in date_strings if x not in existing_dates_strings]
-        return HttpResponse(
-            json.dumps(dates_without_existing_dates),
+        try:
+            times = parse_start_times(request.POST['start_times'])
+            offset = int(request.POST.get('offset') or 0)
+            limit = request.POST.get('limit')
+            limit = int(limit) if limit else None
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError(offset, limit)
+            # Expand the rule up front, so a malformed rule is rejected
+            # before streaming starts. The expansion is cached for the
+            # stream to reuse.
+            expand_rrule_dates(rrulestring, horizon)
+        except ValueError:
+            return HttpResponseBadRequest()
+
+        existing = set()
+        if request.POST['product_id'] != 'None':
+            existing = set(EventTime.objects.filter(
+                product_id=int(request.POST['product_id']),
+                start__isnull=False
+            ).values_list('start', flat=True))
+
+        datetimes = (
+            x for x in recurrence_datetimes(rrulestring, times, horizon, tz)
+            if x not in existing
+        )
+        datetimes = islice(
+            datetimes, offset, offset + limit if limit is not None else None
+        )
+        return StreamingHttpResponse(
+            self.stream(datetimes),
             content_type='application/json'
         )
 
+    @staticmethod
+    def stream(datetimes):
+        # convert to danish date format strings and off we go...
+        yield '['
+        separator = ''
+        for x in datetimes:
+            yield separator + json.dumps(x.strftime('%d-%m-%Y %H:%M'))
+            separator = ','
+        yield ']'
+
 
 class PostcodeView(View):
     def get(self, request, *args, **kwargs):
@@ -2444,14 +2548,12 @@ class BookingView(AutologgerMixin, ModalMixin, ProductBookingUpdateView):
         if self.product and self.product.is_guest_time_suggested:
             only_waitinglist = False
         else:
-            only_waitinglist = True
-            for eventtime in self.product.future_times:
-                if eventtime.available_seats > 0:
-                    only_waitinglist = False
-                available_times[str(eventtime.pk)] = {
-                    'available': eventtime.available_seats,
-                    'waitinglist': eventtime.waiting_list_capacity
-                }
+            available_times = EventTime.capacity_payload(
+                self.product.future_times
+            )
+            only_waitinglist = not any(
+                times['available'] != 0 for times in available_times.values()
+            )
 
         context = {
             'product': self.product,
@@ -2545,72 +2647,60 @@ class BookingView(AutologgerMixin, ModalMixin, ProductBookingUpdateView):
                     bookable=False,
                 )
 
-            # If the chosen eventtime does not have a visit, create it now
-            if not eventtime.visit:
-                # if a desired date and time exists, include it on the visit
-                if desired_date is not None and desired_time is not None:
-                    desired_datetime = datetime.combine(
-                        desired_date, desired_time
-                    ).strftime("%d.%m.%Y %H:%M")
-                    eventtime.make_visit(desired_time=desired_datetime)
-                else:
-                    eventtime.make_visit()
-                log_action(
-                    self.request.user,
-                    eventtime.visit,
-                    LOGACTION_CREATE,
-                    _('Besøg oprettet')
+            # If the chosen eventtime does not have a visit, it is created
+            # when the booking is placed. If a desired date and time
+            # exists, include it on the visit
+            visit_kwargs = {}
+            if desired_date is not None and desired_time is not None:
+                visit_kwargs['desired_time'] = datetime.combine(
+                    desired_date, desired_time
+                ).strftime("%d.%m.%Y %H:%M")
+
+            # Save the booking and everything belonging to it in one
+            # transaction, which holds the lock on the event time from
+            # the seats are counted until the booking is committed. The
+            # mails, resource assignment and reindexing are done after it.
+            try:
+                with transaction.atomic():
+                    if 'bookerform' in relevant_forms:
+                        booking.booker = relevant_forms['bookerform'].save()
+
+                    if booking.place(eventtime, **visit_kwargs):
+                        log_action(
+                            self.request.user,
+                            booking.visit,
+                            LOGACTION_CREATE,
+                            _('Besøg oprettet')
+                        )
+                    if 'bookingform' in relevant_forms:
+                        relevant_forms['bookingform'].save_m2m()
+
+                    for formname in [
+                        'gymnasiesubjectform', 'grundskolesubjectform'
+                    ]:
+                        subjectform = relevant_forms.get(formname)
+                        if subjectform:
+                            subjectform.instance = booking
+                            if subjectform.is_valid():
+                                subjectform.save()
+
+                    booking.ensure_statistics()
+
+                    for evaluation in \
+                            self.product.surveyxactevaluation_set.all():
+                        if evaluation is not None:
+                            evaluationguest = SurveyXactEvaluationGuest(
+                                guest=booking.booker,
+                                evaluation=evaluation
+                            )
+                            evaluationguest.save()
+            except ValidationError as e:
+                relevant_forms['bookingform'].add_error(None, e)
+                return self.render_to_response(
+                    self.get_context_data(**forms)
                 )
 
-            booking.visit = eventtime.visit
-
-            available_seats = booking.visit.available_seats
-
-            if 'bookerform' in relevant_forms:
-                booking.booker = relevant_forms['bookerform'].save()
-
-            booking = relevant_forms['bookingform'].save()
-
-            put_in_waitinglist = False
-
-            attendee_count = booking.booker.attendee_count
-
-            if booking.visit.product.do_create_waiting_list and \
-                    attendee_count > available_seats:
-                # Put in waiting list
-                put_in_waitinglist = True
-
-                if booking.visit.waiting_list_closed:
-                    booking.delete()
-                    raise Exception(_(u"Cannot place booking with in waiting "
-                                      u"list; the waiting list is closed"))
-                waitinglist_capacity = \
-                    booking.visit.waiting_list_capacity
-                if attendee_count > waitinglist_capacity:
-                    booking.delete()
-                    raise Exception(_(u"Cannot place booking with "
-                                      u"%(attendee_count)d attendees in "
-                                      u"waiting list; there are only "
-                                      u"%(waitinglist_capacity)d spots") %
-                                    {
-                                        'attendee_count': attendee_count,
-                                        'waitinglist_capacity':
-                                            waitinglist_capacity
-                                    }
-                                    )
-
-                booking.waitinglist_spot = \
-                    booking.visit.next_waiting_list_spot
-            booking.save()
-
-            for formname in ['gymnasiesubjectform', 'grundskolesubjectform']:
-                subjectform = relevant_forms.get(formname)
-                if subjectform:
-                    subjectform.instance = booking
-                    if subjectform.is_valid():
-                        subjectform.save()
-
-            booking.ensure_statistics()
+            put_in_waitinglist = booking.is_waiting
 
             # Flag attention requirement on visit
             booking.visit.needs_attention_since = timezone.now()
@@ -2666,14 +2756,6 @@ class BookingView(AutologgerMixin, ModalMixin, ProductBookingUpdateView):
                     True
                 )
 
-            for evaluation in self.product.surveyxactevaluation_set.all():
-                if evaluation is not None:
-                    evaluationguest = SurveyXactEvaluationGuest(
-                        guest=booking.booker,
-                        evaluation=evaluation
-                    )
-                    evaluationguest.save()
-
             self.object = booking
             self.model = booking.__class__
 
@@ -2978,11 +3060,9 @@ class VisitBookingCreateView(AutologgerMixin, CreateView):
         available_times = {}
 
         if self.product:
-            for eventtime in self.product.future_times:
-                available_times[str(eventtime.pk)] = {
-                    'available': eventtime.available_seats,
-                    'waitinglist': eventtime.waiting_list_capacity
-                }
+            available_times = EventTime.capacity_payload(
+                self.product.future_times
+            )
 
         context = {
             'level_map': Guest.level_map,
@@ -300,11 +300,56 @@ ALLOWED_HOSTS = ["*"]
 #     else:
 #         AUTHENTICATION_BACKENDS.append('djangosaml2.backends.Saml2Backend')
 
+# Queue availability recalculations caused by changes to calendars,
+# resources and visits, and process them in the AvailabilityUpdateJob cron
+# job instead of during the request.
+DEFER_AVAILABILITY_UPDATES = False
+
+# Queue outgoing emails instead of sending them during the request. Queued
+# emails are sent in batches by the EmailOutboxJob cron job, and retried
+# until EMAIL_MAX_ATTEMPTS attempts have failed.
+QUEUE_EMAILS = False
+EMAIL_BATCH_SIZE = 100
+EMAIL_MAX_ATTEMPTS = 6
+
+# Regenerate search texts and vectors of products and visits in batches in
+# the SearchReindexJob cron job, instead of when they are saved.
+DEFER_SEARCH_INDEXING = False
+SEARCH_REINDEX_BATCH_SIZE = 500
+
+# How many started or ended eventtimes the NotifyEventTimeJob cron job
+# claims and flags at a time.
+NOTIFY_EVENTTIME_BATCH_SIZE = 500
+
+# How many guests or emails the anonymization cron jobs anonymize in each
+# UPDATE and transaction.
+ANONYMIZE_BATCH_SIZE = 1000
+
+# How autoassign picks among the free resources for a requirement: 'random',
+# 'round_robin' or 'least_loaded'. See
+# booking.resource_based.models.AutoassignStrategy.
+AUTOASSIGN_STRATEGY = 'random'
+
+# Answer public searches from the PublicBookableTime index instead of
+# joining products with their eventtimes, visits and calendars. Run the
+# rebuild_public_search_index management command before enabling this.
+PUBLIC_SEARCH_INDEX = False
+
+# Look up the visits teachers and hosts can be assigned to in the
+# AssignmentOpportunity index instead of working them out on every
+# dashboard load. Run the rebuild_assignment_index management command
+# before enabling this.
+ASSIGNMENT_OPPORTUNITY_INDEX = False
+
 CRON_CLASSES = [
     "booking.cron.ReminderJob",
     "booking.cron.IdleHostroleJob",
     "booking.cron.RemoveOldMvpJob",
     "booking.cron.NotifyEventTimeJob",
+    "booking.cron.CalculatedAvailableHorizonJob",
+    "booking.cron.AvailabilityUpdateJob",
+    "booking.cron.EmailOutboxJob",
+    "booking.cron.SearchReindexJob",
     "booking.cron.EvaluationReminderJob",
     "booking.cron.AnonymizeGuestsJob",
     "booking.cron.AnonymizeInquirersJob",
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.17 on 2026-10-18 12:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('booking', '0015_resourceutilisation'),
+        ('user_profile', '0002_auto_20190702_1337'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssignmentOpportunity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.IntegerField(choices=[(0, 'Ressource'), (1, 'Potentiel underviser'), (2, 'Potentiel vært')])),
+                ('resource', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.Resource')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('visit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='booking.Visit')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='assignmentopportunity',
+            index=models.Index(fields=['resource', 'visit'], name='user_profil_resourc_bc223c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='assignmentopportunity',
+            index=models.Index(fields=['user', 'source', 'visit'], name='user_profil_user_id_d7024b_idx'),
+        ),
+    ]
@@ -5,7 +5,9 @@ from datetime import timedelta
 from django.conf import settings
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
 from django.db import models
+from django.db import transaction
 from django.db.models import Aggregate
 from django.db.models import Count
 from django.db.models import Q
@@ -411,6 +413,9 @@ class UserProfile(models.Model):
 
     @property
     def can_be_assigned_to_qs(self):
+        if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+            return self.indexed_can_be_assigned_to_qs()
+
         resource = self.get_resource()
         if resource:
             qs1 = booking.models.Visit.objects.raw('''
@@ -525,6 +530,42 @@ class UserProfile(models.Model):
             Q(pk__in=qs1) | Q(pk__in=qs2)
         )
 
+    # The same visits as can_be_assigned_to_qs, looked up in
+    # AssignmentOpportunity
+    def indexed_can_be_assigned_to_qs(self):
+        now = timezone.now()
+        filters = Q(pk__in=[])
+
+        resource = self.get_resource()
+        if resource:
+            filters |= Q(
+                resource=resource,
+                visit__eventtime__start__gt=now
+            )
+
+        if self.is_teacher:
+            source = AssignmentOpportunity.SOURCE_TEACHER
+        elif self.is_host:
+            source = AssignmentOpportunity.SOURCE_HOST
+        else:
+            source = None
+        if source is not None:
+            filters |= Q(
+                Q(visit__eventtime__start__gt=now) |
+                Q(visit__eventtime__start__isnull=True),
+                user=self.user,
+                source=source,
+                visit__eventtime__product__organizationalunit__in=(
+                    self.get_unit_queryset()
+                )
+            )
+
+        return booking.models.Visit.objects.filter(
+            pk__in=AssignmentOpportunity.objects.filter(
+                filters
+            ).values('visit_id')
+        )
+
     @property
     def potentially_assigned_visits(self):
         resource = self.get_resource()
@@ -642,3 +683,211 @@ class EmailLoginURL(models.Model):
             url = reverse(rev_tag)
 
         return cls.create_from_url(user, url, **kwargs)
+
+
+# The visits each teacher or host could be assigned to, either as a resource
+# in a pool that a requirement of the visit still needs resources from, or
+# as a potential teacher or host of a product whose visit still needs
+# teachers or hosts. Whether the visit lies in the future is checked when
+# looking it up, everything else is kept up to date by the signals in
+# user_profile.signals when settings.ASSIGNMENT_OPPORTUNITY_INDEX is set.
+# Rebuild it with the rebuild_assignment_index management command.
+class AssignmentOpportunity(models.Model):
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['resource', 'visit']),
+            models.Index(fields=['user', 'source', 'visit']),
+        ]
+
+    SOURCE_RESOURCE = 0
+    SOURCE_TEACHER = 1
+    SOURCE_HOST = 2
+
+    source_choices = (
+        (SOURCE_RESOURCE, _(u"Ressource")),
+        (SOURCE_TEACHER, _(u"Potentiel underviser")),
+        (SOURCE_HOST, _(u"Potentiel vært")),
+    )
+
+    visit = models.ForeignKey(
+        Visit,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    resource = models.ForeignKey(
+        'booking.Resource',
+        null=True,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(
+        User,
+        null=True,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    source = models.IntegerField(
+        choices=source_choices
+    )
+
+    # Visits the user's list of potential teachers or hosts applies to
+    list_sql = '''
+        SELECT
+            "booking_visit"."id",
+            NULL::integer,
+            "potential"."user_id",
+            %%s
+        FROM
+            "booking_visit"
+            INNER JOIN "booking_eventtime" ON (
+                "booking_eventtime"."visit_id" = "booking_visit"."id"
+            )
+            INNER JOIN "booking_product" ON (
+                "booking_product"."id" = "booking_eventtime"."product_id"
+            )
+            INNER JOIN "booking_product_%(list)s" "potential" ON (
+                "potential"."product_id" = "booking_product"."id"
+            )
+        WHERE
+            %(visit_cond)s
+            AND
+            "booking_visit"."is_multi_sub" = FALSE
+            AND
+            "booking_product"."time_mode" IN (%%s, %%s)
+            AND
+            (
+                SELECT COUNT(1)
+                FROM "booking_visit_%(assigned)s" "assigned"
+                WHERE "assigned"."visit_id" = "booking_visit"."id"
+            ) < COALESCE(
+                "booking_visit"."override_needed_%(assigned)s",
+                "booking_product"."needed_%(assigned)s"
+            )
+            AND
+            NOT EXISTS (
+                SELECT 1
+                FROM "booking_visit_%(assigned)s" "assigned"
+                WHERE
+                    "assigned"."visit_id" = "booking_visit"."id"
+                    AND
+                    "assigned"."user_id" = "potential"."user_id"
+            )
+    '''
+
+    # Pool members of requirements that still lack resources for a visit
+    resource_sql = '''
+        SELECT DISTINCT
+            "booking_visit"."id",
+            "pool"."resource_id",
+            NULL::integer,
+            %%s
+        FROM
+            "booking_visit"
+            INNER JOIN "booking_eventtime" ON (
+                "booking_eventtime"."visit_id" = "booking_visit"."id"
+            )
+            INNER JOIN "booking_resourcerequirement" ON (
+                "booking_resourcerequirement"."product_id" =
+                    "booking_eventtime"."product_id"
+            )
+            INNER JOIN "booking_resourcepool_resources" "pool" ON (
+                "pool"."resourcepool_id" =
+                    "booking_resourcerequirement"."resource_pool_id"
+            )
+        WHERE
+            %(visit_cond)s
+            AND
+            "booking_visit"."is_multi_sub" = FALSE
+            AND
+            (
+                SELECT COUNT(1)
+                FROM "booking_visitresource" "vr"
+                WHERE
+                    "vr"."visit_id" = "booking_visit"."id"
+                    AND
+                    "vr"."resource_requirement_id" =
+                        "booking_resourcerequirement"."id"
+            ) < "booking_resourcerequirement"."required_amount"
+            AND
+            NOT EXISTS (
+                SELECT 1
+                FROM "booking_visitresource" "vr"
+                WHERE
+                    "vr"."visit_id" = "booking_visit"."id"
+                    AND
+                    "vr"."resource_requirement_id" =
+                        "booking_resourcerequirement"."id"
+                    AND
+                    "vr"."resource_id" = "pool"."resource_id"
+            )
+    '''
+
+    # Rebuilds the rows of the given visits, or of all visits if visit_ids
+    # is None, with one DELETE and one INSERT ... SELECT
+    @staticmethod
+    def refresh(visit_ids=None):
+        if visit_ids is not None:
+            visit_ids = [x for x in set(visit_ids) if x is not None]
+            if len(visit_ids) == 0:
+                return
+            visit_cond = '"booking_visit"."id" = ANY(%s)'
+            visit_params = [visit_ids]
+        else:
+            visit_cond = 'TRUE'
+            visit_params = []
+
+        time_modes = [
+            Product.TIME_MODE_SPECIFIC, Product.TIME_MODE_GUEST_SUGGESTED
+        ]
+        parts = [
+            (
+                AssignmentOpportunity.resource_sql % {
+                    'visit_cond': visit_cond,
+                },
+                [AssignmentOpportunity.SOURCE_RESOURCE] + visit_params
+            ),
+            (
+                AssignmentOpportunity.list_sql % {
+                    'list': 'potentielle_undervisere',
+                    'assigned': 'teachers',
+                    'visit_cond': visit_cond,
+                },
+                [AssignmentOpportunity.SOURCE_TEACHER] + visit_params +
+                time_modes
+            ),
+            (
+                AssignmentOpportunity.list_sql % {
+                    'list': 'potentielle_vaerter',
+                    'assigned': 'hosts',
+                    'visit_cond': visit_cond,
+                },
+                [AssignmentOpportunity.SOURCE_HOST] + visit_params +
+                time_modes
+            ),
+        ]
+        sql = '''
+            INSERT INTO "user_profile_assignmentopportunity" (
+                "visit_id", "resource_id", "user_id", "source"
+            )
+        ''' + ' UNION ALL '.join(part for (part, params) in parts)
+        params = []
+        for (part, part_params) in parts:
+            params.extend(part_params)
+
+        with transaction.atomic():
+            stale = AssignmentOpportunity.objects.all()
+            if visit_ids is not None:
+                stale = stale.filter(visit_id__in=visit_ids)
+            stale.delete()
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+
+    @staticmethod
+    def refresh_products(product_ids):
+        AssignmentOpportunity.refresh(
+            booking.models.EventTime.objects.filter(
+                product_id__in=product_ids,
+                visit__isnull=False
+            ).values_list('visit_id', flat=True)
+        )
@@ -1 +1,103 @@
 # encoding: utf-8
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from booking.models import EventTime, Product, Visit
+from booking.models import ResourcePool, ResourceRequirement, VisitResource
+from user_profile.models import AssignmentOpportunity
+
+
+# The pks of the objects on the forward side of a many-to-many change, e.g.
+# the visits when teachers are added to or removed from visits. A reverse
+# clear loses them, so they are stored on the instance before it happens.
+def forward_pks(sender, instance, action, reverse, model, pk_set):
+    if action in ('pre_add', 'pre_remove'):
+        return []
+    if action == 'pre_clear':
+        if not reverse:
+            return []
+        (forward_field,) = [
+            field for field in sender._meta.fields
+            if field.related_model is model
+        ]
+        (reverse_field,) = [
+            field for field in sender._meta.fields
+            if field.related_model is not None and
+            isinstance(instance, field.related_model)
+        ]
+        instance.assignment_opportunity_pks = list(
+            sender.objects.filter(**{
+                reverse_field.attname: instance.pk
+            }).values_list(forward_field.attname, flat=True)
+        )
+        return []
+    if not reverse:
+        return [instance.pk]
+    if action == 'post_clear':
+        return getattr(instance, 'assignment_opportunity_pks', [])
+    return pk_set or []
+
+
+# Keep the AssignmentOpportunity index up to date with the assignments,
+# requirements and lists of potential teachers and hosts it is built from
+@receiver(post_save, sender=VisitResource)
+@receiver(post_delete, sender=VisitResource)
+@receiver(post_save, sender=EventTime)
+def on_visit_assignment_change(sender, instance, **kwargs):
+    if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+        AssignmentOpportunity.refresh([instance.visit_id])
+
+
+@receiver(post_save, sender=Visit)
+def on_visit_save_assignment_index(sender, instance, **kwargs):
+    if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+        AssignmentOpportunity.refresh([instance.pk])
+
+
+@receiver(post_save, sender=ResourceRequirement)
+@receiver(post_delete, sender=ResourceRequirement)
+def on_requirement_change_assignment_index(sender, instance, **kwargs):
+    if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+        AssignmentOpportunity.refresh_products([instance.product_id])
+
+
+@receiver(post_save, sender=Product)
+def on_product_save_assignment_index(sender, instance, **kwargs):
+    if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+        AssignmentOpportunity.refresh_products([instance.pk])
+
+
+@receiver(m2m_changed, sender=Visit.teachers.through)
+@receiver(m2m_changed, sender=Visit.hosts.through)
+def on_visit_staff_change(sender, instance, action, reverse, model, pk_set,
+                          **kwargs):
+    if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+        AssignmentOpportunity.refresh(forward_pks(
+            sender, instance, action, reverse, model, pk_set
+        ))
+
+
+@receiver(m2m_changed, sender=Product.potentielle_undervisere.through)
+@receiver(m2m_changed, sender=Product.potentielle_vaerter.through)
+def on_potential_staff_change(sender, instance, action, reverse, model,
+                              pk_set, **kwargs):
+    if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+        AssignmentOpportunity.refresh_products(forward_pks(
+            sender, instance, action, reverse, model, pk_set
+        ))
+
+
+@receiver(m2m_changed, sender=ResourcePool.resources.through)
+def on_pool_members_change(sender, instance, action, reverse, model, pk_set,
+                           **kwargs):
+    if settings.ASSIGNMENT_OPPORTUNITY_INDEX:
+        pool_ids = forward_pks(
+            sender, instance, action, reverse, model, pk_set
+        )
+        if pool_ids:
+            AssignmentOpportunity.refresh_products(
+                ResourceRequirement.objects.filter(
+                    resource_pool_id__in=pool_ids
+                ).values_list('product_id', flat=True)
+            )
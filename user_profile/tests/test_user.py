@@ -1,15 +1,20 @@
 # encoding: utf-8
 import re
+from datetime import datetime, timedelta
 
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from pyquery import PyQuery as pq
+from pytz import utc
 
 from booking.models import OrganizationalUnit, OrganizationalUnitType, Product
-from booking.resource_based.models import ResourceType
+from booking.resource_based.models import CalendarEvent
+from booking.resource_based.models import ResourceType, TeacherResource
+from booking.resource_based.models import VisitResource
 from resource_booking.tests.mixins import TestMixin
 from user_profile.constants import TEACHER, HOST, FACULTY_EDITOR, COORDINATOR
-from user_profile.models import UserRole
+from user_profile.models import AssignmentOpportunity, UserRole
 
 
 class TestUser(TestMixin, TestCase):
@@ -303,3 +308,115 @@ class TestUser(TestMixin, TestCase):
         self.assertListEqual(
             [self.admin], list(self.admin.userprofile.get_admins())
         )
+
+    @override_settings(ASSIGNMENT_OPPORTUNITY_INDEX=True)
+    def test_assignment_opportunities(self):
+        teacher = self.create_default_teacher(unit=self.unit)
+        profile = teacher.userprofile
+        TeacherResource.create(teacher, self.unit)
+        resource = TeacherResource.for_user(teacher)
+        product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_SPECIFIC,
+            potential_teachers=teacher
+        )
+        product.needed_teachers = 1
+        product.save()
+        start = datetime.utcnow() + timedelta(days=1)
+        visits = [
+            self.create_visit(
+                product,
+                start=start + timedelta(hours=x),
+                end=start + timedelta(hours=x + 1)
+            )
+            for x in range(12)
+        ]
+
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_TEACHER, self.unit, 'teachers',
+            resource
+        )
+        resource_product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_RESOURCE_CONTROLLED
+        )
+        requirement = self.create_resourcerequirement(
+            resource_product, pool, 1
+        )
+        resource_visit = self.create_visit(resource_product, start=start)
+
+        def assignable():
+            with override_settings(ASSIGNMENT_OPPORTUNITY_INDEX=False):
+                legacy = set(
+                    profile.can_be_assigned_to_qs.values_list('pk', flat=True)
+                )
+            indexed = set(
+                profile.can_be_assigned_to_qs.values_list('pk', flat=True)
+            )
+            self.assertEquals(legacy, indexed)
+            return indexed
+
+        all_visits = set(visit.pk for visit in visits + [resource_visit])
+        self.assertEquals(all_visits, assignable())
+
+        visits[0].teachers.add(teacher)
+        self.assertEquals(all_visits - {visits[0].pk}, assignable())
+        teacher.taught_visits.clear()
+        self.assertEquals(all_visits, assignable())
+
+        VisitResource.objects.create(
+            visit=resource_visit, resource=resource,
+            resource_requirement=requirement
+        )
+        self.assertEquals(all_visits - {resource_visit.pk}, assignable())
+
+        # A rebuild gives the same index
+        rows = set(AssignmentOpportunity.objects.values_list(
+            'visit_id', 'resource_id', 'user_id', 'source'
+        ))
+        AssignmentOpportunity.refresh()
+        self.assertEquals(rows, set(AssignmentOpportunity.objects.values_list(
+            'visit_id', 'resource_id', 'user_id', 'source'
+        )))
+
+        self.login("/profile/", teacher)
+        response = self.client.get("/profile/")
+        self.assertEquals(200, response.status_code)
+        self.assertIn(u"Vis alle (12)", response.content.decode('utf-8'))
+
+    @override_settings(ASSIGNMENT_OPPORTUNITY_INDEX=True)
+    def test_assignment_opportunities_after_autoassign(self):
+        teacher = self.create_default_teacher(unit=self.unit)
+        TeacherResource.create(teacher, self.unit)
+        resource = TeacherResource.for_user(teacher)
+        pool = self.create_resourcepool(
+            ResourceType.RESOURCE_TYPE_TEACHER, self.unit, 'teachers',
+            resource
+        )
+        product = self.create_product(
+            unit=self.unit,
+            time_mode=Product.TIME_MODE_RESOURCE_CONTROLLED_AUTOASSIGN
+        )
+        self.create_resourcerequirement(product, pool, 1)
+        start = datetime.utcnow() + timedelta(days=1)
+        resource.make_calendar()
+        CalendarEvent.objects.create(
+            calendar=resource.calendar, title='open',
+            availability=CalendarEvent.AVAILABLE,
+            start=timezone.make_aware(start - timedelta(hours=1), utc),
+            end=timezone.make_aware(start + timedelta(hours=8), utc)
+        )
+        visit = self.create_visit(product, start=start)
+
+        def opportunities():
+            return AssignmentOpportunity.objects.filter(
+                visit=visit, source=AssignmentOpportunity.SOURCE_RESOURCE
+            )
+
+        AssignmentOpportunity.refresh([visit.pk])
+        self.assertTrue(opportunities().exists())
+
+        # Autoassignment bulk creates the assignments
+        visit.autoassign_resources()
+        self.assertEquals(1, visit.visitresource.count())
+        self.assertFalse(opportunities().exists())
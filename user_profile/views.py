@@ -188,15 +188,26 @@ class ProfileView(BreadcrumbMixin, LoginRequiredMixin, TemplateView):
         }
 
         for list in context['lists']:
+            # Count each list once and only load the items that are shown;
+            # the rest are fetched by id when the list is expanded
+            list['count'] = list['queryset'].count()
+            if 'limited_qs' not in list:
+                list['limited_qs'] = list['queryset'][:list['limit']]
+            if list['count'] > list['limit']:
+                list['remaining_ids'] = list['queryset'].prefetch_related(
+                    None
+                ).values_list(
+                    'id', flat=True
+                )[list['limit']:]
             if 'title' in list:
                 if type(list['title']) == dict:
                     if isinstance(list['title']['text'], Promise):
                         list['title']['text'] = \
                             list['title']['text'] % \
-                            {'count': list['queryset'].count()}
+                            {'count': list['count']}
                 elif isinstance(list['title'], Promise):
                     list['title'] = list['title'] % \
-                        {'count': list['queryset'].count()}
+                        {'count': list['count']}
 
         context.update(**kwargs)
         return super(ProfileView, self).get_context_data(**context)